@@ -1,11 +1,39 @@
 let ID_GRP_ANTN = 'list-group_annotations';
 let ID_ITM_ANTN = 'item_annotation';
 let ID_STOR_ANTN_IDX = 'store_clicked-annotation-index';
+let ID_DLD_CSV = 'download_csv';
 
 function get_match_id(str_id, idx) {
   return `${str_id}, ${idx}`;
 }
 
+function set_path_copied(obj, keys, v) {
+  // Copies along the path only, so that the graph sees a new figure while unchanged arrays are shared
+  if (keys.length === 0) {
+    return v;
+  }
+  let [k, ...keys_rest] = keys;
+  let copy;
+  if (Array.isArray(obj)) {
+    copy = obj.slice();
+  } else if (obj === null || obj === undefined) {
+    copy = typeof k === 'number' ? [] : {};
+  } else {
+    copy = Object.assign({}, obj);
+  }
+  copy[k] = set_path_copied(copy[k], keys_rest, v);
+  return copy;
+}
+
+function apply_patch(fig, ptch) {
+  // Per `EcgFigures.get_patch`, e.g. {'data[0].y': ..., 'layout.annotations': ...}, '' for the entire figure
+  for (let [path, v] of Object.entries(ptch)) {
+    let keys = (path.match(/[^.\[\]]+/g) || []).map(t => /^\d+$/.test(t) ? Number(t) : t);
+    fig = set_path_copied(fig, keys, v);
+  }
+  return fig;
+}
+
 window.dash_clientside = Object.assign({}, window.dash_clientside, {
     clientside: {
         update_tag_clicked: function(ns_clicks, ns_clicks_prev) {
@@ -15,6 +43,39 @@ window.dash_clientside = Object.assign({}, window.dash_clientside, {
                 }
             }
             return -1;
+        },
+
+        patch_lead_figures: function(ptch_figs, ptch_antn, ptch_yfix, figs) {
+            let ctx = window.dash_clientside.callback_context;
+            let idxs_lead = ctx.states_list[0].map(s => s.id.index);
+            let ptchs = ctx.triggered.map(t => ctx.inputs[t.prop_id]).filter(p => p);
+            if (ptchs.length === 0) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            return figs.map((fig, i) => {
+                let fig_new = fig;
+                for (let p of ptchs) {
+                    if (idxs_lead[i] in p.figs) {
+                        fig_new = apply_patch(fig_new, p.figs[idxs_lead[i]]);
+                    }
+                }
+                return fig_new === fig ? window.dash_clientside.no_update : fig_new;
+            });
+        },
+
+        patch_thumbnail: function(ptch, fig) {
+            if (!ptch) {
+                throw window.dash_clientside.PreventUpdate;
+            }
+            return apply_patch(fig, ptch.fig);
+        },
+
+        download_export: function(href) {
+            // The export streams from the server, the browser saves it as the response comes in
+            if (href) {
+                document.getElementById(ID_DLD_CSV).click();
+            }
+            return window.dash_clientside.no_update;
         }
     }
 });
@@ -0,0 +1,63 @@
+// Decodes trace arrays sent as base64 little-endian buffers, see `EcgPlot.encode_y`
+// e.g. {dtype: 'i2', bdata: 'AAD//w=='}, which the bundled plotly.js doesn't read by itself
+
+let TYPED_ARRAYS = {
+  i1: Int8Array, u1: Uint8Array, i2: Int16Array, u2: Uint16Array,
+  i4: Int32Array, u4: Uint32Array, f4: Float32Array, f8: Float64Array
+};
+
+function is_typed_array_spec(v) {
+  return v !== null && typeof v === 'object' && typeof v.bdata === 'string' && v.dtype in TYPED_ARRAYS;
+}
+
+function decode_typed_array(v) {
+  let str = atob(v.bdata);
+  let bytes = new Uint8Array(str.length);
+  for (let i = 0; i < str.length; ++i) {
+    bytes[i] = str.charCodeAt(i);
+  }
+  return new TYPED_ARRAYS[v.dtype](bytes.buffer);
+}
+
+function decode_traces(data) {
+  // Shallow copies, so that the figure kept by Dash stays in the encoded form
+  return data.map(trace => {
+    let trace_dec = trace;
+    for (let k of ['x', 'y']) {
+      if (is_typed_array_spec(trace[k])) {
+        if (trace_dec === trace) {
+          trace_dec = Object.assign({}, trace);
+        }
+        trace_dec[k] = decode_typed_array(trace[k]);
+      }
+    }
+    return trace_dec;
+  });
+}
+
+function wrap_plotly(plotly) {
+  for (let nm of ['react', 'newPlot']) {
+    let fn = plotly[nm];
+    plotly[nm] = function(gd, data, ...args) {
+      if (Array.isArray(data)) {
+        data = decode_traces(data);
+      } else if (data !== null && typeof data === 'object' && Array.isArray(data.data)) {  // Figure object
+        data = Object.assign({}, data, {data: decode_traces(data.data)});
+      }
+      return fn.call(this, gd, data, ...args);
+    };
+  }
+  return plotly;
+}
+
+// plotly.js may load before or after this script
+if (window.Plotly) {
+  wrap_plotly(window.Plotly);
+} else {
+  let plotly_wrapped;
+  Object.defineProperty(window, 'Plotly', {
+    configurable: true,
+    get: () => plotly_wrapped,
+    set: v => { plotly_wrapped = wrap_plotly(v); }
+  });
+}
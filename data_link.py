@@ -1,5 +1,10 @@
+import os
 import pathlib
 
-DATA_PATH = pathlib.Path('/Users/stefanh/Documents/UMich/Research/EcgViz/ablation-database-viewer/data')
-CURR = pathlib.Path('/Users/stefanh/Documents/UMich/Research/EcgViz/test_ECG-Signal-Viewer/data')
-
+# Either may be overridden by environment variable, e.g. to point at synthetic records, see `dev_synth_record.py`
+DATA_PATH = pathlib.Path(os.environ.get(
+    'ECG_DATA_PATH', '/Users/stefanh/Documents/UMich/Research/EcgViz/ablation-database-viewer/data'
+))
+CURR = pathlib.Path(os.environ.get(
+    'ECG_CURR_PATH', '/Users/stefanh/Documents/UMich/Research/EcgViz/test_ECG-Signal-Viewer/data'
+))
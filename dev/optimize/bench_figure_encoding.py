@@ -0,0 +1,55 @@
+""" Encode time and bytes on the wire of a 12-lead figure payload, plain JSON lists versus base64 typed arrays
+
+Run from the repository root, `python dev/optimize/bench_figure_encoding.py`
+"""
+import gzip
+import json
+import sys
+import pathlib
+import timeit
+
+import numpy as np
+import pandas as pd
+import plotly
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[2]))
+from ecg_plot import EcgPlot  # noqa: E402
+
+N_LEAD = 12
+N_PT = 4 * EcgPlot.N_COL  # Point budget per lead
+SPL_RATE = 2000
+N_RUN = 20
+
+
+def get_window(seed=0):
+    """ Synthetic ecg-like int16 values, a sinusoid with noise and periodic spikes """
+    rng = np.random.default_rng(seed)
+    t = np.arange(N_PT)
+    vals = np.sin(t / 60)[None, :] * 1000 * (1 + np.arange(N_LEAD)[:, None] / 10) + rng.normal(0, 50, (N_LEAD, N_PT))
+    vals[:, t % 340 == 5] = 3000
+    return vals.astype(np.int16)
+
+
+def get_figs(x_vals, vals, encode):
+    figs = [dict(data=[dict(x=x_vals, y=encode(v), mode='lines')]) for v in vals]
+    return json.dumps(figs, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+def bench(nm, x_vals, vals, encode):
+    payload = get_figs(x_vals, vals, encode)
+    t = timeit.timeit(lambda: get_figs(x_vals, vals, encode), number=N_RUN) / N_RUN
+    n_gz = len(gzip.compress(payload.encode('utf-8')))
+    print(f'{nm:<24}{t * 1000:>12.2f}{len(payload):>12}{n_gz:>12}')
+
+
+if __name__ == "__main__":
+    vals = get_window()
+    counts = np.arange(N_PT) * 8
+    x_ms = counts * (1000 // SPL_RATE) if 1000 % SPL_RATE == 0 else counts * 1000 / SPL_RATE
+    x_pd = pd.to_datetime(pd.Series(counts * (10 ** 6 // SPL_RATE)), unit='us')
+    print(f'{N_LEAD} leads * {N_PT} points')
+    print(f'{"":<24}{"encode (ms)":>12}{"bytes":>12}{"gzip bytes":>12}')
+    bench('pandas x, list y', x_pd, vals, lambda v: v)
+    bench('ms x, list y', x_ms, vals, lambda v: v)
+    bench('ms x, typed array y', x_ms, vals, EcgPlot.to_typed_array)
+    bench('ms x, float32 y', x_ms, vals.astype(np.float32), EcgPlot.to_typed_array)
@@ -0,0 +1,178 @@
+""" Repeatable benchmarks of record reads, figure creation and exports, on a synthetic record per `dev_synth_record`
+
+Results are written as JSON, with the environment and record parameters, to compare across releases,
+e.g. `python dev_bench.py --out bench_v2.json --compare bench_v1.json`, see `--help`
+
+Each benchmark runs `--n-run` times after a warm-up run, setup between runs, e.g. dropping per-plot caches,
+isn't timed. The record and its sidecars, e.g. the manifest and pyramid, are built before timing.
+"""
+
+import os
+import json
+import time
+import argparse
+import pathlib
+import platform
+import tempfile
+import subprocess
+from statistics import median, mean
+
+from dev_synth_record import write_record
+
+
+def get_env():
+    try:
+        rev = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=pathlib.Path(__file__).parent
+        ).stdout.strip()
+    except OSError:
+        rev = ''
+    import numpy as np
+    import pandas as pd
+    import h5py
+    return dict(
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'), git_rev=rev, python=platform.python_version(),
+        platform=platform.platform(), numpy=np.__version__, pandas=pd.__version__, h5py=h5py.__version__
+    )
+
+
+def bench(fn, n_run, setup=None):
+    """
+    :return: Dictionary of run time statistics in milliseconds
+    """
+    tms = []
+    for i in range(n_run + 1):  # The first run warms up
+        if setup is not None:
+            setup()
+        t = time.perf_counter()
+        fn()
+        if i > 0:
+            tms.append((time.perf_counter() - t) * 1e3)
+    return dict(n_run=n_run, ms_min=min(tms), ms_median=median(tms), ms_mean=mean(tms), ms_max=max(tms))
+
+
+def run(path, n_run, skip=()):
+    """ Imported here, for `data_link` to pick up the data directory set by `main`
+
+    :param path: Path to the record
+    :param skip: Names of benchmarks not to run
+    :return: Dictionary of benchmark name to run time statistics, or to the reason it's skipped or failed
+    """
+    from ecg_record import EcgRecord
+    from ecg_plot import EcgPlot
+    from ecg_ui import EcgUi
+    from ecg_session import EcgSession
+    from ecg_export import EcgExport
+    try:
+        from ecg_marker import EcgMarker
+    except ImportError as e:  # e.g. `ecgdetectors`
+        EcgMarker = e
+
+    path_p = path.with_name(f'{path.stem}_preprocessed.hdf5')
+    rec = EcgRecord(path, path_p)  # Builds the sidecars
+    sess = EcgSession('bench')  # Parent of the plot, as `EcgApp` for the current session
+    plt = EcgPlot(rec, sess)
+    sess.rec, sess.plt, sess.ui = rec, plt, EcgUi(rec)
+    sess.cmts.init(rec)
+    sess.exp.set_record(rec, sess.cmts)
+    idxs_lead = list(range(rec.n_lead))
+    strt, end = EcgPlot.DISP_RNG_INIT[0]
+    n_min = rec.spl_rate * 60
+    n_10min = min(n_min * 10, rec.COUNT_END)
+
+    def _clear_tmb():
+        plt._tmb_y_vals.clear()
+
+    def _thumbnail():
+        EcgPlot.Thumbnail(rec, plt).add_trace(idxs_lead)
+
+    benches = dict(
+        record_open=(lambda: EcgRecord(path, path_p).close(), None),
+        get_ecg_samples_10s=(lambda: rec.get_ecg_samples(0, 0, rec.spl_rate * 10), None),
+        get_ecg_samples_display=(
+            lambda: rec.get_ecg_samples(0, strt, end, plt.get_sample_factor(strt, end), agg='extreme'), None
+        ),
+        get_ecg_samples_whole=(
+            lambda: rec.get_ecg_samples(0, step=plt.get_sample_factor(0, rec.COUNT_END), agg='extreme'), None
+        ),
+        get_time_values_display=(lambda: rec.get_time_values(strt, end, plt.get_sample_factor(strt, end)), None),
+        get_time_values_ms_display=(
+            lambda: rec.get_time_values_ms(strt, end, plt.get_sample_factor(strt, end)), None
+        ),
+        get_fig=(lambda: plt.get_fig(0, strt, end), None),
+        get_fig_all_leads=(lambda: [plt.get_fig(idx, strt, end) for idx in idxs_lead], None),
+        thumbnail_add_trace=(_thumbnail, _clear_tmb),
+        export_1min=(lambda: sum(map(len, sess.exp.export(0, n_min, idxs_lead))), None),
+        export_10min=(lambda: sum(map(len, sess.exp.export(0, n_10min, idxs_lead))), None),
+    )
+    for fmt in EcgExport.FMTS:
+        if fmt != 'csv':  # Bytes are compared to the CSV export of the same range
+            benches[f'export_10min_{fmt}'] = (
+                lambda fmt_=fmt: sum(map(len, sess.exp.export(0, n_10min, idxs_lead, fmt_))), None
+            )
+    if isinstance(EcgMarker, ImportError):
+        res = dict(marker_export=dict(skipped=str(EcgMarker)))
+    else:
+        benches['marker_export'] = (lambda: EcgMarker(rec).export(), None)
+        res = dict()
+    for nm, (fn, setup) in benches.items():
+        if nm in skip:
+            continue
+        try:
+            res[nm] = bench(fn, n_run, setup)
+            if nm.startswith('export'):  # Size in bytes, or in characters for CSV
+                res[nm]['n_byte'] = fn()
+            print(f'{nm:<32}{res[nm]["ms_median"]:>12.2f} ms' + (
+                f'{res[nm]["n_byte"] / 2 ** 20:>10.1f} MB' if 'n_byte' in res[nm] else ''
+            ))
+        except Exception as e:  # Recorded, the rest still runs, e.g. an API changed across releases
+            res[nm] = dict(error=f'{type(e).__name__}: {e}')
+            print(f'{nm:<32}{res[nm]["error"]}')
+    plt.close()
+    rec.close()
+    return res
+
+
+def compare(res, res_prev):
+    print(f'{"":<32}{"median (ms)":>12}{"previous":>12}{"ratio":>8}')
+    for nm, r in res.items():
+        r_prev = res_prev.get(nm, dict())
+        if 'ms_median' in r and 'ms_median' in r_prev:
+            print(f'{nm:<32}{r["ms_median"]:>12.2f}{r_prev["ms_median"]:>12.2f}'
+                  f'{r["ms_median"] / r_prev["ms_median"]:>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks on a synthetic record, results written as JSON')
+    parser.add_argument('--out', type=pathlib.Path, default=pathlib.Path('bench.json'))
+    parser.add_argument('--compare', type=pathlib.Path, default=None, help='Results of a previous run')
+    parser.add_argument('--dir', type=pathlib.Path, default=None,
+                        help='Directory of the record & its sidecars, kept across runs; a temporary one by default')
+    parser.add_argument('--duration', type=float, default=1800, help='Duration of the record in seconds')
+    parser.add_argument('--n-lead', type=int, default=12)
+    parser.add_argument('--seg-dur', type=float, nargs=2, default=(30, 120), help='Range of segment durations in s')
+    parser.add_argument('--n-run', type=int, default=10)
+    parser.add_argument('--skip', nargs='*', default=[], help='Names of benchmarks not to run')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        path_dir = args.dir or pathlib.Path(dir_tmp)
+        path_dir.mkdir(parents=True, exist_ok=True)
+        os.environ['ECG_DATA_PATH'] = os.environ['ECG_CURR_PATH'] = str(path_dir)  # Comments & exports go there
+        params = dict(duration=args.duration, n_lead=args.n_lead, seg_dur_rng=list(args.seg_dur))
+        path = path_dir.joinpath(f'synth_{int(args.duration)}s_{args.n_lead}ld.h5')
+        if not path.exists():
+            write_record(path, **params)
+        res = dict(env=get_env(), record=params, results=run(path, args.n_run, set(args.skip)))
+
+    with open(args.out, 'w') as f:
+        json.dump(res, f, indent=2)
+    print(f'Written {args.out}')
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(res['results'], json.load(f)['results'])
+
+
+if __name__ == "__main__":
+    main()
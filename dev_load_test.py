@@ -0,0 +1,354 @@
+""" Headless load test, scripted interactions from concurrent simulated users, without a browser
+
+Each user loads the layout, i.e. a new session, then replays a script of interactions, e.g. select a record,
+apply a template, pan, scroll-zoom, draw a caliper & save a comment.
+Requests are built as the Dash renderer builds them, see `DashClient`,
+and sent to the app in-process, or to a running server with `--url`.
+
+Reports the latency percentiles & throughput per callback, e.g.
+`python dev_load_test.py --n-user 8 --n-iter 3`, or `python dev_load_test.py --url http://host:8050 --record x.h5`
+"""
+
+import os
+import json
+import time
+import argparse
+import pathlib
+import tempfile
+import threading
+import http.client
+from urllib.parse import urlsplit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from dev_synth_record import write_record
+
+
+PATH_LAYOUT = '/_dash-layout'
+PATH_DEPS = '/_dash-dependencies'
+PATH_CB = '/_dash-update-component'
+WILDCARDS = ['ALL', 'MATCH', 'ALLSMALLER']
+
+
+def stringify_id(id_):
+    """ Per the Dash renderer, pattern-matching IDs are keyed by their JSON """
+    return json.dumps(id_, sort_keys=True, separators=(',', ':')) if isinstance(id_, dict) else id_
+
+
+def parse_id(id_str):
+    return json.loads(id_str) if id_str.startswith('{') else id_str
+
+
+class TransportFlask:
+    """ Requests to the app in the same process, through the Flask test client """
+
+    def __init__(self, server):
+        self.client = server.test_client()
+
+    def get(self, path):
+        return self.client.get(path).get_json()
+
+    def post(self, path, body):
+        r = self.client.post(path, json=body)
+        return r.status_code, (r.get_json() if r.status_code == 200 else None)
+
+
+class TransportHttp:
+    """ Requests to a running server, over a kept-alive connection per user """
+
+    def __init__(self, url):
+        u = urlsplit(url)
+        self.prefix = u.path.rstrip('/')
+        self.conn = (http.client.HTTPSConnection if u.scheme == 'https' else http.client.HTTPConnection)(u.netloc)
+
+    def _request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else dict()
+        self.conn.request(method, self.prefix + path, body=body, headers=headers)
+        r = self.conn.getresponse()
+        return r.status, r.read()
+
+    def get(self, path):
+        return json.loads(self._request('GET', path)[1])
+
+    def post(self, path, body):
+        status, data = self._request('POST', path, json.dumps(body))
+        return status, (json.loads(data) if status == 200 else None)
+
+
+class DashClient:
+    """Keeps the props of the components in the layout, and fires the server-side callbacks of changed props,
+    including callbacks chained on their outputs, as the Dash renderer does.
+
+    .. note:: Clientside callbacks are not run, initial callbacks of a page load or of components added are not fired
+    """
+
+    N_CHAIN = 16  # Maximum number of callbacks fired by a single change, guards against cycles
+
+    def __init__(self, transport, on_response):
+        """
+        :param transport: `TransportFlask` or `TransportHttp`
+        :param on_response: Function called with the callback label, status code and latency in seconds
+        """
+        self.tr = transport
+        self.on_response = on_response
+        self.layout = None
+        self.comps = []  # (ID, props) of components with an ID, in layout order, props shared with `layout`
+        self.deps = [d for d in self.tr.get(PATH_DEPS) if d.get('clientside_function') is None]
+        for d in self.deps:
+            d['outputs'] = [
+                dict(id=parse_id(o.rsplit('.', 1)[0]), property=o.rsplit('.', 1)[1])
+                for o in (d['output'][2:-2].split('...') if d['output'].startswith('..') else [d['output']])
+            ]
+            d['label'] = stringify_id(d['outputs'][0]['id']) + '.' + d['outputs'][0]['property']
+            if len(d['outputs']) > 1:
+                d['label'] += f' +{len(d["outputs"]) - 1}'
+            for k in ['inputs', 'state']:
+                for i in d[k]:
+                    i['id'] = parse_id(i['id'])
+
+    def load(self):
+        """ A page load, i.e. a new session """
+        self.layout = self.tr.get(PATH_LAYOUT)
+        self._index()
+
+    def _index(self):
+        self.comps = []
+
+        def _walk(node):
+            if isinstance(node, list):
+                for n in node:
+                    _walk(n)
+            elif isinstance(node, dict) and 'props' in node:
+                if 'id' in node['props']:
+                    self.comps.append((node['props']['id'], node['props']))
+                _walk(node['props'].get('children'))
+        _walk(self.layout)
+
+    def get_props(self, id_):
+        id_ = stringify_id(id_)
+        return next(p for i, p in self.comps if stringify_id(i) == id_)
+
+    @staticmethod
+    def _matches(pattern, id_, match=None):
+        if not isinstance(pattern, dict):
+            return pattern == id_
+        if not isinstance(id_, dict) or pattern.keys() != id_.keys():
+            return False
+        for k, v in pattern.items():
+            if v == ['MATCH'] and match is not None and id_[k] != match[k]:
+                return False
+            if not (v in ([w] for w in WILDCARDS) or v == id_[k]):
+                return False
+        return True
+
+    def _resolve(self, spec, match, with_val=True):
+        """ Concrete IDs & values of an input, state or output, a list for an `ALL` pattern """
+        pattern = spec['id']
+        comps = [(i, p) for i, p in self.comps if self._matches(pattern, i, match)]
+        lst = [
+            dict(id=i, property=spec['property'], **(dict(value=p.get(spec['property'])) if with_val else dict()))
+            for i, p in comps
+        ]
+        if isinstance(pattern, dict) and ['ALL'] in pattern.values():
+            return lst
+        return lst[0] if lst else dict(id=pattern, property=spec['property'])
+
+    def set(self, id_, prop, value):
+        """ A user change of a prop, fires the callbacks with it as input """
+        self.get_props(id_)[prop] = value
+        self._fire([(id_, prop)])
+
+    def click(self, id_):
+        props = self.get_props(id_)
+        self.set(id_, 'n_clicks', (props.get('n_clicks') or 0) + 1)
+
+    def _fire(self, changed):
+        queue = deque(changed)
+        n = 0
+        while queue and n < self.N_CHAIN:
+            id_, prop = queue.popleft()
+            for d in self.deps:
+                if any(i['property'] == prop and self._matches(i['id'], id_) for i in d['inputs']):
+                    n += 1
+                    queue.extend(self._call(d, id_, prop))
+
+    def _call(self, dep, id_, prop):
+        """
+        :return: List of (ID, prop) changed by the response
+        """
+        match = id_ if isinstance(id_, dict) else None
+        outputs = [self._resolve(o, match, with_val=False) for o in dep['outputs']]
+        body = dict(
+            output=dep['output'],
+            outputs=outputs if dep['output'].startswith('..') else outputs[0],
+            inputs=[self._resolve(i, match) for i in dep['inputs']],
+            state=[self._resolve(s, match) for s in dep['state']],
+            changedPropIds=[f'{stringify_id(id_)}.{prop}']
+        )
+        t = time.perf_counter()
+        status, res = self.tr.post(PATH_CB, body)
+        self.on_response(dep['label'], status, time.perf_counter() - t)
+        if status != 200:  # Including 204 on `PreventUpdate`
+            return []
+        changed = []
+        reindex = False
+        for id_str, props in res['response'].items():
+            try:
+                p = self.get_props(parse_id(id_str))
+            except StopIteration:  # Removed by an earlier output
+                continue
+            p.update(props)
+            reindex = reindex or 'children' in props
+            changed += [(parse_id(id_str), k) for k in props]
+        if reindex:
+            self._index()
+        return changed
+
+
+def get_time(s):
+    """ Time stamp on the x axis of a record, at `s` seconds """
+    return f'1970-01-01 {int(s // 3600):02d}:{int(s % 3600 // 60):02d}:{s % 60:06.3f}'
+
+
+def get_review_script(record, template='range(12) -> [1, 12]', n_pan=10, n_zoom=5, n_nudge=5):
+    """ A typical review, with the display range starting at 50s, per `EcgPlot.DISP_RNG_INIT`
+
+    :return: List of steps, each a dictionary of either `id`, `property` & `value` to set,
+    or `click` of the ID to increment `n_clicks` of
+    """
+    gra = dict(type='graph', index=0)
+    steps = [
+        dict(id='record-dropdown', property='value', value=record),
+        dict(id='lead-template-dropdown', property='value', value=template)
+    ]
+    for i in range(1, n_pan + 1):  # Drag on a lead
+        steps.append(dict(id=gra, property='relayoutData', value={
+            'xaxis.range[0]': get_time(i * 2), 'xaxis.range[1]': get_time(i * 2 + 50)
+        }))
+    c = n_pan * 2 + 25
+    for i in range(n_zoom):  # Scroll-zoom in, centered
+        w = 25 / 2 ** (i + 1)
+        steps.append(dict(id=gra, property='relayoutData', value={
+            'xaxis.range[0]': get_time(c - w), 'xaxis.range[1]': get_time(c + w)
+        }))
+    steps += [dict(click='btn_move-forward')] * n_nudge
+    steps.append(dict(id='figure-thumbnail', property='relayoutData', value={
+        'xaxis.range': [get_time(60), get_time(70)]
+    }))
+    steps += [  # Caliper, then a comment on it
+        dict(id=dict(type='graph', index=1), property='relayoutData', value={'shapes': [dict(
+            type='rect', x0=get_time(62), x1=get_time(63), y0=-500, y1=1200
+        )]}),
+        dict(id='text-area_comment', property='value', value='Load test'),
+        dict(click='btn_comment-submit')
+    ]
+    return steps
+
+
+class LoadTest:
+    """ Runs a script from concurrent users, and collects the latency of each callback request """
+
+    def __init__(self, get_transport, script, n_user, n_iter=1, think=0):
+        """
+        :param get_transport: Function returning a new transport, one per user
+        :param script: List of steps, per `get_review_script`
+        :param think: Pause between steps of a user in seconds
+        """
+        self.get_transport = get_transport
+        self.script = script
+        self.n_user = n_user
+        self.n_iter = n_iter
+        self.think = think
+        self.measures = []  # (label, status, latency in seconds)
+        self._lock = threading.Lock()
+        self.t_dur = None
+
+    def _on_response(self, label, status, t):
+        with self._lock:
+            self.measures.append((label, status, t))
+
+    def _run_user(self, _):
+        c = DashClient(self.get_transport(), self._on_response)
+        for _ in range(self.n_iter):
+            c.load()
+            for step in self.script:
+                if 'click' in step:
+                    c.click(step['click'])
+                else:
+                    c.set(step['id'], step['property'], step['value'])
+                if self.think > 0:
+                    time.sleep(self.think)
+
+    def run(self):
+        t = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.n_user) as pool:
+            list(pool.map(self._run_user, range(self.n_user)))  # Raises the first exception of any user
+        self.t_dur = time.perf_counter() - t
+        return self.get_summary()
+
+    def get_summary(self):
+        """
+        :return: Dictionary of callback label to number of requests, errors, rate & latency percentiles in ms
+        """
+        by_label = dict()
+        for label, status, t in self.measures:
+            by_label.setdefault(label, []).append((status, t))
+        res = dict()
+        for label, ms in sorted(by_label.items(), key=lambda kv: -len(kv[1])):
+            tms = np.array([t for _, t in ms]) * 1e3
+            res[label] = dict(
+                n=len(ms), n_error=sum(s not in (200, 204) for s, _ in ms), n_prevent=sum(s == 204 for s, _ in ms),
+                rps=len(ms) / self.t_dur,
+                **{f'ms_p{q}': float(np.percentile(tms, q)) for q in [50, 95, 99]}
+            )
+        return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scripted interactions from concurrent users, latency per callback')
+    parser.add_argument('--url', default=None, help='Of a running server; the app in-process by default')
+    parser.add_argument('--record', default=None, help='Record file name; a synthetic record in-process by default')
+    parser.add_argument('--script', type=pathlib.Path, default=None, help='JSON list of steps; a review by default')
+    parser.add_argument('--n-user', type=int, default=4)
+    parser.add_argument('--n-iter', type=int, default=1, help='Number of times each user replays the script')
+    parser.add_argument('--think', type=float, default=0, help='Pause between steps in seconds')
+    parser.add_argument('--duration', type=float, default=600, help='Of the synthetic record in seconds')
+    parser.add_argument('--out', type=pathlib.Path, default=None, help='Results written as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dir_tmp:
+        if args.url is not None:
+            def get_transport():
+                return TransportHttp(args.url)
+            record = args.record
+        else:
+            os.environ['ECG_DATA_PATH'] = os.environ['ECG_CURR_PATH'] = dir_tmp  # Before `data_link` is imported
+            record = args.record or write_record(pathlib.Path(dir_tmp, 'synth.h5'), args.duration).name
+            from ecg_app import EcgApp
+            server = EcgApp(__name__).app.server
+
+            def get_transport():
+                return TransportFlask(server)
+        if args.script is not None:
+            with open(args.script, 'r') as f:
+                script = json.load(f)
+        else:
+            script = get_review_script(record)
+        lt = LoadTest(get_transport, script, args.n_user, args.n_iter, args.think)
+        res = lt.run()
+
+    print(f'{args.n_user} users * {args.n_iter} iterations, {len(lt.measures)} requests in {lt.t_dur:.2f}s, '
+          f'{len(lt.measures) / lt.t_dur:.1f} requests/s')
+    print(f'{"callback":<48}{"n":>6}{"error":>6}{"204":>6}{"req/s":>8}{"p50 (ms)":>10}{"p95 (ms)":>10}{"p99 (ms)":>10}')
+    for label, r in res.items():
+        print(f'{label[:47]:<48}{r["n"]:>6}{r["n_error"]:>6}{r["n_prevent"]:>6}{r["rps"]:>8.1f}'
+              f'{r["ms_p50"]:>10.1f}{r["ms_p95"]:>10.1f}{r["ms_p99"]:>10.1f}')
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(dict(n_user=args.n_user, n_iter=args.n_iter, duration=lt.t_dur, callbacks=res), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
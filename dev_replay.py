@@ -0,0 +1,116 @@
+""" Replays an interaction trace logged by `EcgTrace`, against the current build, and times each step
+
+A step is a prop set by the user, timed over all the callback requests it fires, including chained ones,
+see `DashClient`. Steps run back to back, or with `--pace`, at the pace of the trace.
+
+In-process, records are read from the data directory of `data_link`, e.g. set by `ECG_DATA_PATH`;
+or `--url` of a running server, e.g.
+`python dev_replay.py sessions/trace/<session ID>.jsonl --out new.json --compare old.json`
+"""
+
+import json
+import time
+import argparse
+import pathlib
+
+import numpy as np
+
+from dev_load_test import DashClient, TransportFlask, TransportHttp
+from ecg_trace import EcgTrace
+
+
+def load_trace(path):
+    """
+    :return: List of steps, per `get_review_script` of `dev_load_test`, with `t`, time in ms into the trace
+    """
+    with open(path, 'r') as f:
+        return [dict(t=ln['t'], id=ln['id'], property=ln['p'], value=ln['v']) for ln in map(json.loads, f) if ln]
+
+
+def replay(client, steps, pace=False):
+    """
+    :return: List of the result of each step, the number of requests fired, and time in ms of all the requests;
+    steps on components not in the layout, e.g. if the build changed, are skipped
+    """
+    res = []
+    tms = []
+    client.on_response = lambda label, status, t: tms.append(t)
+    client.load()
+    t_strt = time.perf_counter()
+    for i, s in enumerate(steps):
+        if pace:
+            time.sleep(max(s['t'] / 1e3 - (time.perf_counter() - t_strt), 0))
+        tms.clear()
+        r = dict(step=i, key=EcgTrace.get_key(s['id'], s['property']))
+        try:
+            client.set(s['id'], s['property'], s['value'])
+            r.update(n_request=len(tms), ms=sum(tms) * 1e3)
+        except StopIteration:
+            r.update(skipped=True)
+        res.append(r)
+    return res
+
+
+def get_summary(res):
+    """
+    :return: Dictionary of step key, e.g. `graph.relayoutData`, to the number of steps & time percentiles in ms
+    """
+    by_key = dict()
+    for r in res:
+        if not r.get('skipped'):
+            by_key.setdefault(r['key'], []).append(r['ms'])
+    return {k: dict(
+        n=len(ms), ms_total=float(np.sum(ms)),
+        **{f'ms_p{q}': float(np.percentile(ms, q)) for q in [50, 95, 99]}
+    ) for k, ms in by_key.items()}
+
+
+def compare(summ, summ_prev):
+    print(f'{"":<40}{"p50 (ms)":>10}{"previous":>10}{"ratio":>8}')
+    for k, r in summ.items():
+        if k in summ_prev:
+            print(f'{k[:39]:<40}{r["ms_p50"]:>10.1f}{summ_prev[k]["ms_p50"]:>10.1f}'
+                  f'{r["ms_p50"] / max(summ_prev[k]["ms_p50"], 1e-9):>8.2f}')
+    tot, tot_prev = (sum(r['ms_total'] for r in s.values()) for s in (summ, summ_prev))
+    print(f'{"total":<40}{tot:>10.1f}{tot_prev:>10.1f}{tot / max(tot_prev, 1e-9):>8.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a session trace, timing each step')
+    parser.add_argument('trace', type=pathlib.Path)
+    parser.add_argument('--url', default=None, help='Of a running server; the app in-process by default')
+    parser.add_argument('--pace', action='store_true', help='Waits between steps as in the trace')
+    parser.add_argument('--verbose', action='store_true', help='Prints each step')
+    parser.add_argument('--out', type=pathlib.Path, default=None, help='Results written as JSON')
+    parser.add_argument('--compare', type=pathlib.Path, default=None, help='Results of a previous replay')
+    args = parser.parse_args()
+
+    if args.url is not None:
+        tr = TransportHttp(args.url)
+    else:
+        from ecg_app import EcgApp
+        tr = TransportFlask(EcgApp(__name__).app.server)
+    steps = load_trace(args.trace)
+    res = replay(DashClient(tr, None), steps, args.pace)
+    summ = get_summary(res)
+
+    if args.verbose:
+        for r in res:
+            print(f'{r["step"]:>6} {r["key"][:39]:<40}' + (
+                'skipped' if r.get('skipped') else f'{r["n_request"]:>4}{r["ms"]:>10.1f} ms'
+            ))
+    print(f'{len(steps)} steps, {sum(r.get("skipped", False) for r in res)} skipped')
+    print(f'{"step":<40}{"n":>6}{"p50 (ms)":>10}{"p95 (ms)":>10}{"p99 (ms)":>10}{"total (ms)":>12}')
+    for k, r in summ.items():
+        print(f'{k[:39]:<40}{r["n"]:>6}{r["ms_p50"]:>10.1f}{r["ms_p95"]:>10.1f}{r["ms_p99"]:>10.1f}'
+              f'{r["ms_total"]:>12.1f}')
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(dict(trace=str(args.trace), summary=summ, steps=res), f, indent=2)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(summ, json.load(f)['summary'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+""" Writes synthetic `.h5` records in the layout of `Ablation Database (ABLDB)` records, as read by `EcgRecord`
+
+Each segment is a `(n_lead, n)` int16 dataset, with the `metadata` JSON attribute of `sample_rate` and `sigheader`;
+the file has the `annotations` JSON attribute, a header and a protocol row, followed by tags.
+
+Signals are ECG-like, a beat of P wave, QRS complex and T wave per lead, with baseline wander, noise
+and the occasional clipped spike, so that decimation, y range and R peak detection see realistic values.
+
+Run `python dev_synth_record.py <path.h5> [--duration 3600] [--n-lead 12] ...`, see `--help`
+"""
+
+import json
+import argparse
+import pathlib
+
+import numpy as np
+import h5py
+
+
+LEAD_NMS = ['I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6']  # Beyond, `CH<i>`
+TAG_TYPES = ['Ablation', 'Pacing', 'Map Point', 'Note']
+TIME_STRT_MS = 1_600_000_000_000  # Epoch time of the header row, tag times are relative to it
+
+
+def get_lead_nms(n_lead):
+    return [LEAD_NMS[i] if i < len(LEAD_NMS) else f'CH{i}' for i in range(n_lead)]
+
+
+def get_seg_lens(n_sample, seg_dur_rng, spl_rate, rng):
+    """
+    :return: Segment lengths in sample counts, of random durations in `seg_dur_rng` seconds, summing to `n_sample`
+    """
+    lo, hi = (int(d * spl_rate) for d in seg_dur_rng)
+    lens = []
+    while sum(lens) < n_sample:
+        lens.append(int(rng.integers(lo, hi + 1)))
+    lens[-1] -= sum(lens) - n_sample
+    return [n for n in lens if n > 0]
+
+
+def get_signal(strt, n, n_lead, spl_rate, rng, bpm=70):
+    """ ECG-like values of all leads, for sample counts `strt` to `strt + n`, continuous across segments
+
+    :return: 2D int16 array, #leads * n
+    """
+    t = np.arange(strt, strt + n) / spl_rate
+    phase = (t * bpm / 60) % 1  # Position within the beat
+
+    def _wave(center, width, amp):
+        return amp * np.exp(-((phase - center) / width) ** 2)
+    beat = _wave(0.2, 0.04, 150) + _wave(0.35, 0.012, 1500) - _wave(0.32, 0.01, 200) + _wave(0.6, 0.06, 350)
+    gains = np.linspace(1, 0.3, n_lead)[:, None] * np.where(np.arange(n_lead) % 4 == 3, -1, 1)[:, None]
+    wander = 200 * np.sin(2 * np.pi * 0.15 * t + np.arange(n_lead)[:, None])
+    vals = gains * beat + wander + rng.normal(0, 30, (n_lead, n))
+    vals[:, rng.random(n) < 1e-5] = np.iinfo(np.int16).max  # Artifacts
+    return np.clip(vals, np.iinfo(np.int16).min, np.iinfo(np.int16).max).astype(np.int16)
+
+
+def get_annotations(dur_ms, n_tag, rng):
+    anns = [
+        dict(type='header', time_ms=TIME_STRT_MS, data=dict()),
+        dict(type='protocol', time_ms=TIME_STRT_MS, data=dict(text='Synthetic'))
+    ]
+    for i, t in enumerate(np.sort(rng.integers(0, dur_ms, n_tag))):
+        typ = TAG_TYPES[i % len(TAG_TYPES)]
+        anns.append(dict(
+            type=typ, time_ms=TIME_STRT_MS + int(t), data=dict(text=f'{typ} {i}') if i % 2 == 0 else dict()
+        ))
+    return anns
+
+
+def write_record(path, duration=600, n_lead=12, spl_rate=2000, seg_dur_rng=(30, 120), n_tag=None, seed=0):
+    """
+    :param path: Path to the `.h5` file written
+    :param duration: Duration of the record in seconds
+    :param n_lead: Number of leads
+    :param spl_rate: Sample rate in Hz
+    :param seg_dur_rng: Range of durations of each segment in seconds, the last segment may be shorter
+    :param n_tag: Number of tags, by default one per minute
+    :param seed: Values are the same given the same parameters and seed
+    :return: `path`
+    """
+    rng = np.random.default_rng(seed)
+    n_sample = int(duration * spl_rate)
+    n_tag = max(int(duration // 60), 1) if n_tag is None else n_tag
+    metadata = json.dumps(dict(
+        sample_rate=spl_rate,
+        sigheader=[dict(name=nm, isNegative=False) for nm in get_lead_nms(n_lead)]
+    ))
+    with h5py.File(path, 'w') as f:
+        f.attrs['annotations'] = json.dumps(get_annotations(duration * 1000, n_tag, rng))
+        strt = 0
+        for i, n in enumerate(get_seg_lens(n_sample, seg_dur_rng, spl_rate, rng)):
+            # Keys sort in the order of segments, as `EcgRecord` joins them in key order
+            dset = f.create_dataset(
+                f'{i:05d}.log', data=get_signal(strt, n, n_lead, spl_rate, rng), chunks=(n_lead, min(n, 2 ** 14))
+            )
+            dset.attrs['metadata'] = metadata
+            strt += n
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Writes a synthetic ABLDB-format .h5 record')
+    parser.add_argument('path', type=pathlib.Path)
+    parser.add_argument('--duration', type=float, default=600, help='Duration in seconds')
+    parser.add_argument('--n-lead', type=int, default=12)
+    parser.add_argument('--spl-rate', type=int, default=2000, help='Sample rate in Hz')
+    parser.add_argument('--seg-dur', type=float, nargs=2, default=(30, 120), help='Range of segment durations in s')
+    parser.add_argument('--n-tag', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_record(args.path, args.duration, args.n_lead, args.spl_rate, args.seg_dur, args.n_tag, args.seed)
+    print(f'Written {args.path}')
@@ -1,14 +1,15 @@
+import flask
 import dash
 import dash_html_components as html
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State, ClientsideFunction
-from dash_extensions import Download
 from dash.exceptions import PreventUpdate
 import plotly.graph_objs as go
 
-from copy import deepcopy
-import concurrent.futures
+import threading
+from urllib.parse import urlencode
+from copy import copy, deepcopy
 from typing import List, Dict
 
 from datetime import datetime
@@ -21,10 +22,15 @@ from dev_helper import *
 
 from ecg_defns_n_util import *
 from ecg_record import EcgRecord
+from ecg_store import EcgStore
 from ecg_plot import EcgPlot
 from ecg_ui import EcgUi
-from ecg_comment import EcgComment
+from ecg_figures import EcgFigures
 from ecg_export import EcgExport
+from ecg_jobs import EcgJobs
+from ecg_session import EcgRecords, EcgSessions, EcgSessionsOnDisk
+from ecg_metrics import EcgMetrics
+from ecg_trace import EcgTrace
 
 
 def __get_curr_time():
@@ -40,6 +46,11 @@ ic.configureOutput(prefix=t_stamp)
 INF = float('inf')
 
 
+def _session_attr(nm):
+    """ Attribute of `EcgApp` held by the session the current callback serves, see `EcgSession` """
+    return property(lambda self: getattr(self.sess, nm), lambda self, v: setattr(self.sess, nm, v))
+
+
 class EcgApp:
     """Handles the Dash web app, interface with potentially multiple records
 
@@ -69,24 +80,40 @@ class EcgApp:
 
     MAX_PRV_LEN = 30  # Maximum number of characters for the comment preview
 
-    def __init__(self, app_name):
-        self.rec = None  # Current record
-        self.plt = None
-        self.ui = EcgUi(None)
-        self.cmts = EcgComment(None)
-        self.exp = EcgExport()
-        self.idxs_lead = []
-        self.disp_rng = EcgPlot.DISP_RNG_INIT
-        self.fig_tmb = None
-        self._yaxis_fixed = False
-        self._marking_on = False
-        self.idx_ann_clicked = None
-        self._shapes = []  # Current shapes drawn, to be synchronized across new leads added
-        self._track_cmt_on = False
-        self._idx_cmt_t = None  # Index of the tracked comment stored internally
+    # Directory to keep sessions in, e.g. for several worker processes, see `EcgSessionsOnDisk`; None for in memory
+    SESS_DIR = None
+    METRICS = False  # Time callbacks by phase, served on `/metrics`, see `EcgMetrics`
+    TRACE_DIR = None  # Directory to log the interactions of each session in, see `EcgTrace`; None for no trace
+    PATH_EXP = '/export'  # Route of the exports, see `EcgExport.FMTS`
+    EXP_DIR = None  # Directory of export artifacts, e.g. shared by several worker processes; None for a temporary one
+
+    # State of the session each callback serves
+    rec = _session_attr('rec')  # Current record
+    plt = _session_attr('plt')
+    ui = _session_attr('ui')
+    cmts = _session_attr('cmts')
+    exp = _session_attr('exp')
+    idxs_lead = _session_attr('idxs_lead')
+    disp_rng = _session_attr('disp_rng')
+    fig_tmb = _session_attr('fig_tmb')
+    plots = _session_attr('plots')  # Lead plots on display
+    _yaxis_fixed = _session_attr('_yaxis_fixed')
+    _marking_on = _session_attr('_marking_on')
+    idx_ann_clicked = _session_attr('idx_ann_clicked')
+    _shapes = _session_attr('_shapes')
+    _track_cmt_on = _session_attr('_track_cmt_on')
+    _idx_cmt_t = _session_attr('_idx_cmt_t')
+    move_offset_counts = _session_attr('move_offset_counts')
+    no_update_add_opns = _session_attr('no_update_add_opns')
 
-        self.move_offset_counts = None  # Runtime optimization, semi-constants dependent to record
-        self.no_update_add_opns = None
+    def __init__(self, app_name):
+        EcgRecords.parn = self
+        self.sessions = EcgSessions() if self.SESS_DIR is None else EcgSessionsOnDisk(self.SESS_DIR)
+        self._local = threading.local()  # Session of the callback served by each thread
+        self.figs = EcgFigures(self.SESS_DIR)  # Partial updates to the lead figures on display, for each session
+        self.metrics = None
+        self.trace = None
+        self.jobs = EcgJobs(self.EXP_DIR)
 
         self.app_name = app_name  # No human-readable meaning, name passed into Dash object
         self.app = dash.Dash(self.app_name, external_stylesheets=[
@@ -117,8 +144,11 @@ class EcgApp:
                     dbc.Tooltip(target=ID_BTN_ADD, hide_arrow=False, placement=TTP_PLCM, offset=TTP_OFST,
                                 children='Add a lead channel'),
                     dbc.Tooltip(target=ID_BTN_EXP, hide_arrow=False, placement=TTP_PLCM, offset=TTP_OFST,
-                                children='Export to csv'),
-                    Download(id=ID_DLD_CSV),
+                                children='Export leads & range on display'),
+                    dbc.Progress(id=ID_PRG_EXP, className=CNM_PRG_EXP_HD, value=0, striped=True, animated=True),
+                    dcc.Store(id=ID_STOR_EXP_JOB),
+                    dcc.Interval(id=ID_ITV_EXP, interval=500, disabled=True),  # Polls the export job
+                    html.A(id=ID_DLD_CSV, download='', hidden=True),  # Link to the export, see `send_export`
 
                     html.Div(id=ID_DIV_PLT_CTRL, children=[
                         html.Button(id=ID_BTN_ADV_BK, className=join(CNM_BTN, CNM_BTN_FIG_OPN), disabled=True,
@@ -162,6 +192,7 @@ class EcgApp:
                     html.Div(id=ID_DIV_OPN, children=[
                         # Sets the record, a separate call back function to make sure execution order
                         dcc.Store(id=ID_STOR_REC),
+                        dcc.Store(id=ID_STOR_SID, data=EcgFigures.new_session_id()),  # New on each page load
                         dcc.Dropdown(
                             id=ID_DPD_RECR, className=CNM_MY_DPD, placeholder='Select patient record file',
                             options=[{L: f'{dev(record_nm)}', V: record_nm}],
@@ -172,6 +203,10 @@ class EcgApp:
                             placeholder='Select lead channel template',
                             options=[{L: f'{dev(tpl_nm)}', V: tpl_nm} for tpl_nm in self.LD_TEMPL],
                             # value=DEV_TML_S  # Dev only, for fast testing
+                        ),
+                        dcc.Dropdown(
+                            id=ID_DPD_EXP_FMT, className=CNM_MY_DPD, clearable=False, value='csv',
+                            options=[{L: f'Export as {fmt.upper()}', V: fmt} for fmt in EcgExport.FMTS]
                         )
                     ]),
                 ]),
@@ -188,9 +223,7 @@ class EcgApp:
                         ]),
                         html.Div(id=ID_DIV_TABS, children=[  # 3 tabs
                             # Tab 1, the lead channels
-                            html.Div(id=ID_DIV_PLTS, children=[  # Which is empty list on init
-                                self.get_fig_layout(idx) for idx in self.idxs_lead
-                            ]),
+                            html.Div(id=ID_DIV_PLTS, children=[]),  # Empty on load, see `EcgFigures`
 
                             # Tab 2, clickable and editable items, comments and tags
                             html.Div(id=ID_DIV_CMT_TG, className=ANM_DIV_CMT_TG_CLPW, children=[
@@ -225,6 +258,10 @@ class EcgApp:
                 dcc.Store(id=ID_STOR_ADD),
                 dcc.Store(id=ID_STOR_RMV),
                 dcc.Store(id=ID_STOR_CH_HT),
+                dcc.Store(id=ID_STOR_PTCH_FIG),
+                dcc.Store(id=ID_STOR_PTCH_ANTN),
+                dcc.Store(id=ID_STOR_PTCH_YFIX),
+                dcc.Store(id=ID_STOR_PTCH_TMB),
 
                 dbc.Alert(
                     id=ID_ALT_MAX_LD, is_open=False, fade=True, duration=4000, dismissable=True, color='danger',
@@ -243,12 +280,76 @@ class EcgApp:
                 ])
             ])
 
-        self.app.layout = _set_layout()
+        self.app.layout = _set_layout  # Called on each page load
+        self.app.server.add_url_rule(self.PATH_EXP, 'export', self.stream_export)
+        self.app.server.add_url_rule(f'{self.PATH_EXP}/<nm>', 'export_artifact', self.send_export)
+        if self.METRICS:
+            self.metrics = EcgMetrics(self.app.server)
+        if self.TRACE_DIR is not None:
+            self.trace = EcgTrace(self.TRACE_DIR)
         self._set_callbacks()
 
     def run(self, debug=False):
         self.app.run_server(debug=debug)
 
+    @property
+    def sess(self):
+        return self._local.sess
+
+    def _callback(self, *args, **kwargs):
+        """ Same as `Dash.callback`, for callbacks on session state
+
+        The session ID is taken in as the last state, and the callback runs on that session, see `EcgSession`
+
+        :param debounce: If True, display range changes wait for a newer one, before taking the session,
+            see `is_range_superseded`
+        """
+        debounce = kwargs.pop('debounce', False)
+        args = list(args)
+        if len(args) < 3:
+            args.append([])
+        elif not isinstance(args[2], list):
+            args[2] = [args[2]]
+        args[2] = args[2] + [State(ID_STOR_SID, D)]
+        if self.trace is not None:
+            self.trace.add_session_outputs(args[0])
+
+        def _wrap(func):
+            def _func(*args_cb):
+                with EcgMetrics.callback():
+                    if not EcgSessions.is_valid_id(args_cb[-1]):
+                        raise PreventUpdate
+                    with EcgMetrics.phase('debounce'):
+                        is_deb = debounce and self.is_range_change()
+                        self._local.n_rndr = self.figs.debounce(args_cb[-1]) if is_deb else None
+                    with self.sessions.use(args_cb[-1]) as sess:
+                        self._local.sess = sess
+                        if self.trace is not None:
+                            self.trace.log(sess.sid)
+                        return func(*args_cb[:-1])
+            return self.app.callback(*args, **kwargs)(_func)
+        return _wrap
+
+    def _callback_static(self, *args, **kwargs):
+        """ Same as `Dash.callback`, for callbacks independent of session state, timed per `EcgMetrics.callback` """
+        def _wrap(func):
+            def _func(*args_cb):
+                with EcgMetrics.callback():
+                    return func(*args_cb)
+            return self.app.callback(*args, **kwargs)(_func)
+        return _wrap
+
+    @staticmethod
+    def is_range_change():
+        """ Whether the callback is triggered by a display range change, on a lead figure or the thumbnail """
+        trig = dash.callback_context.triggered[0]
+        id_ch = EcgUi.get_id(trig['prop_id'])
+        return id_ch == ID_TMB or (id_ch == ID_GRA and isinstance(trig['value'], dict) and EcgUi.K_XS in trig['value'])
+
+    def is_range_superseded(self):
+        """ Whether a newer range change of the session began during the debounce of the callback """
+        return self._local.n_rndr is not None and self.figs.is_superseded(self.sess.sid, self._local.n_rndr)
+
     def get_fig_layout(self, idx, tags=None):
         def _get_lead_fig(idx_lead, tags=None, shapes=None):
             """
@@ -287,33 +388,38 @@ class EcgApp:
             ])
         ])
 
+    @staticmethod
+    def get_plot_fig(plot):
+        """ The figure dictionary of a plot per `get_fig_layout` """
+        return plot.children[0].children[1].children[0].figure
+
     def _set_callbacks(self):
-        self.app.callback(
+        self._callback_static(
             [Output(ID_IC_OPN, CNM),
              Output(ID_DIV_OPN, CNM)],
             Input(ID_BTN_OPN, NC)
         )(self.toggle_div_options)
 
-        self.app.callback(
+        self._callback(
             Output(ID_STOR_REC, D),
             Input(ID_DPD_RECR, V),
             prevent_initial_call=True
         )(self.set_record_init)
 
-        self.app.callback(
+        self._callback_static(
             [Output(ID_DPD_LD_TEMPL, DS),
              Output(ID_BTN_ADD, DS)],
             Input(ID_STOR_REC, D),
             prevent_initial_call=True
         )(self.toggle_record_disable)
 
-        self.app.callback(
+        self._callback(
             Output(ID_GRP_LD_ADD, C),
             Input(ID_STOR_REC, D),
             prevent_initial_call=True
         )(self.set_add_lead_options)
 
-        self.app.callback(
+        self._callback(
             [Output(ID_FD_MN, 'is_in'),
              Output(ID_BTN_ADV_BK, DS),
              Output(ID_BTN_MV_BK, DS),
@@ -331,19 +437,19 @@ class EcgApp:
         )(self.toggle_layout_fade_n_lead_disable)
 
         # Make sure index is updated first before other callbacks update based on `idxs_lead`
-        self.app.callback(
+        self._callback(
             Output(ID_STOR_ADD, D),
             Input(all_(ID_ITM_LD_ADD), NC),
             prevent_initial_call=True
         )(self.update_lead_indices_add)
 
-        self.app.callback(
+        self._callback(
             Output(ID_STOR_RMV, D),
             Input(all_(ID_BTN_LD_RMV), NC),
             prevent_initial_call=True
         )(self.update_lead_indices_remove)
 
-        self.app.callback(
+        self._callback_static(
             Output(ID_MD_ADD, IO),
             [Input(ID_BTN_ADD, NC),
              Input(ID_BTN_MD_CLS, NC)],
@@ -351,7 +457,7 @@ class EcgApp:
             prevent_initial_call=True
         )(self.toggle_modal_display)
 
-        self.app.callback(
+        self._callback(
             Output(ID_ALT_MAX_LD, IO),
             [Input(ID_STOR_ADD, D),
              Input(ID_DPD_LD_TEMPL, V)],
@@ -359,16 +465,16 @@ class EcgApp:
             prevent_initial_call=True
         )(self.toggle_max_lead_error)
 
-        self.app.callback(
+        self._callback(
             Output(all_(ID_DIV_LD), 'style'),
             Input(ID_STOR_CH_HT, D)
         )(self.update_lead_height_styles)
 
-        self.app.callback(
+        self._callback(
             [Output(ID_DIV_PLTS, C),
              Output(all_(ID_ITM_LD_ADD), DS),
-             Output(all_(ID_GRA), F),
-             Output(ID_TMB, F),
+             Output(ID_STOR_PTCH_FIG, D),  # Partial updates only, see `EcgFigures`
+             Output(ID_STOR_PTCH_TMB, D),
              Output(ID_TMLB, C),  # Updates the time duration label
              Output(ID_DIV_CMT_LB, C),  # Updates the comment range label
              Output(ID_TXTA_CMT, DS),
@@ -384,10 +490,8 @@ class EcgApp:
              Input(ID_TMB, 'relayoutData'),
              Input(ID_BTN_ADV_BK, NC),
              Input(ID_BTN_MV_BK, NC),
-             Input(ID_BTN_FIXY, NC),
              Input(ID_BTN_MV_FW, NC),
              Input(ID_BTN_ADV_FW, NC),
-             Input(ID_IC_TG_TG, CNM),  # Ensures `_marking_on` is first toggled
              Input(ID_BTN_CLP_CLR, NC),
              Input(ID_IC_CLP_SYNC, CNM),  # Ensures caliper synchronization is first toggled
              Input(ID_STOR_ADD, D),
@@ -395,15 +499,48 @@ class EcgApp:
              Input(ID_STOR_TG_IDX, D),  # Static tag click
              Input(all_(ID_BDG_CMT_TM), NC),  # Comment timestamp click
              Input(all_(ID_BTN_CMT_RMV), NC)],
-            [State(ID_DIV_PLTS, C),
-             State(all_(ID_ITM_LD_ADD), DS),
-             State(all_(ID_GRA), F),
-             State(ID_TMB, F),
+            [State(all_(ID_ITM_LD_ADD), DS),
              State(ID_STOR_TG_NCS, D)],  # Models the change in number of clicks
-            prevent_initial_call=True
+            prevent_initial_call=True, debounce=True
         )(self.update_lead_options_disable_layout_figures)
 
-        self.app.callback(
+        self._callback(
+            Output(ID_STOR_PTCH_ANTN, D),
+            Input(ID_IC_TG_TG, CNM),  # Ensures `_marking_on` is first toggled
+            prevent_initial_call=True
+        )(self.update_tag_annotations)
+
+        self._callback(
+            Output(ID_STOR_PTCH_YFIX, D),
+            Input(ID_BTN_FIXY, NC),
+            prevent_initial_call=True
+        )(self.update_fix_yaxis)
+
+        self.app.clientside_callback(
+            ClientsideFunction(  # Merges the partial updates into the figures on display
+                namespace='clientside',
+                function_name='patch_lead_figures'
+            ),
+            Output(all_(ID_GRA), F),
+            [Input(ID_STOR_PTCH_FIG, D),
+             Input(ID_STOR_PTCH_ANTN, D),
+             Input(ID_STOR_PTCH_YFIX, D)],
+            State(all_(ID_GRA), F),
+            prevent_initial_call=True
+        )
+
+        self.app.clientside_callback(
+            ClientsideFunction(
+                namespace='clientside',
+                function_name='patch_thumbnail'
+            ),
+            Output(ID_TMB, F),
+            Input(ID_STOR_PTCH_TMB, D),
+            State(ID_TMB, F),
+            prevent_initial_call=True
+        )
+
+        self._callback_static(
             [Output(ID_DIV_CMT_TG, CNM),
              Output(ID_BTN_CMT_TG_TG, CNM),
              Output(ID_IC_CMT_TG_TG, CNM),
@@ -412,7 +549,7 @@ class EcgApp:
             prevent_initial_call=True
         )(self.toggle_tags_n_comments_panel)
 
-        self.app.callback(
+        self._callback(
             Output(ID_GRP_TG, C),
             Input(ID_STOR_REC, D),
             prevent_initial_call=True
@@ -429,13 +566,13 @@ class EcgApp:
             prevent_initial_call=True
         )
 
-        self.app.callback(
+        self._callback_static(
             Output(ID_TXTA_CMT, 'rows'),
             Input(ID_TXTA_CMT, 'value'),
             prevent_initial_call=True
         )(self.update_comment_textarea_height)
 
-        self.app.callback(
+        self._callback(
             [Output(ID_ALT_CMT_SVD, 'is_open'),
              Output(ID_GRP_CMT, C)],
             [Input(ID_DPD_LD_TEMPL, V),
@@ -447,7 +584,7 @@ class EcgApp:
             prevent_initial_call=True
         )(self.update_comments_panel)
 
-        self.app.callback(
+        self._callback_static(
             [Output(mch(ID_CLP_CMT_ITM), IO),
              Output(mch(CNM_CMT_TXTP), CNM),
              Output(mch(ID_BTN_CMT_ITM_TG), CNM)],
@@ -455,13 +592,13 @@ class EcgApp:
             prevent_initial_call=True
         )(self.toggle_whole_comment_item)
 
-        self.app.callback(
+        self._callback_static(
             Output(ID_ALT_CMT_RMV, IO),
             Input(all_(ID_BTN_CMT_RMV), NC),
             prevent_initial_call=True
         )(self.alert_comment_removed)
 
-        self.app.callback(
+        self._callback_static(
             [Output(ID_IC_FIXY, CNM),
              Output(ID_ALT_FIXY, IO),
              Output(ID_ALT_FIXY, C)],
@@ -469,13 +606,13 @@ class EcgApp:
             prevent_initial_call=True
         )(self.update_fix_yaxis_icon)
 
-        self.app.callback(
+        self._callback_static(
             Output(ID_ALT_CLP_CLR, IO),
             Input(ID_BTN_CLP_CLR, NC),
             prevent_initial_call=True
         )(self.show_clear_calipers_alert)
 
-        self.app.callback(
+        self._callback(
             [Output(ID_IC_CLP_SYNC, CNM),
              Output(ID_ALT_CLP_SYNC, IO),
              Output(ID_ALT_CLP_SYNC, C)],
@@ -483,7 +620,7 @@ class EcgApp:
             prevent_initial_call=True
         )(self.update_synchronize_caliper)
 
-        self.app.callback(
+        self._callback(
             [Output(ID_IC_TG_TG, CNM),
              Output(ID_ALT_TG_TG, IO),
              Output(ID_ALT_TG_TG, C)],
@@ -491,12 +628,30 @@ class EcgApp:
             prevent_initial_call=True
         )(self.toggle_show_markings)
 
-        self.app.callback(
-            Output(ID_DLD_CSV, D),
+        self._callback(
+            Output(ID_STOR_EXP_JOB, D),
             Input(ID_BTN_EXP, NC),
+            State(ID_DPD_EXP_FMT, 'value'),
             prevent_initial_call=True
         )(self.export_csv)
 
+        self._callback_static(
+            [Output(ID_PRG_EXP, V), Output(ID_PRG_EXP, 'color'), Output(ID_PRG_EXP, CNM),
+             Output(ID_DLD_CSV, 'href'), Output(ID_ITV_EXP, DS)],
+            [Input(ID_STOR_EXP_JOB, D), Input(ID_ITV_EXP, 'n_intervals')],
+            prevent_initial_call=True
+        )(self.poll_export)
+
+        self.app.clientside_callback(
+            ClientsideFunction(
+                namespace='clientside',
+                function_name='download_export'
+            ),
+            Output(ID_DLD_CSV, NC),
+            Input(ID_DLD_CSV, 'href'),
+            prevent_initial_call=True
+        )
+
     @staticmethod
     def get_last_changed_id_property():
         """Only 1 input change is needed each time
@@ -523,8 +678,12 @@ class EcgApp:
             # Makes sure the following attributes are set first before needed
             path = DATA_PATH.joinpath(record_name)
             path_p = CURR.joinpath(f'{path.stem}_preprocessed.hdf5')  # Preprocessed record
-            self.rec = EcgRecord(path, path_p)
-            self.plt = EcgPlot(self.rec, self)  # A `plot` serves a record
+            if EcgRecord.SHARED:  # Workers attach to the memory-mapped copy, prepared in the background
+                path = EcgRecords.get_shared_path(path)
+            elif EcgStore.is_valid(path):  # Prefer the memory-mapped copy if converted
+                path = EcgStore.get_path(path)
+            self.rec, self.plt = EcgRecords.get(path, path_p)  # A `plot` serves a record, both shared by sessions
+            self.disp_rng = deepcopy(EcgPlot.DISP_RNG_INIT)
             self.ui = EcgUi(self.rec)
             self.cmts.init(self.rec)
             self.exp.set_record(self.rec, self.cmts)
@@ -638,11 +797,11 @@ class EcgApp:
 
     def update_lead_options_disable_layout_figures(
             self, record_name, template, layouts_fig, layout_tmb,
-            n_clicks_adv_bk, n_clicks_mv_bk, n_clicks_fixy, n_clicks_mv_fw, n_clicks_adv_fw,
-            n_clicks_mkg_tg, n_clicks_clpr, cnm_sync,
+            n_clicks_adv_bk, n_clicks_mv_bk, n_clicks_mv_fw, n_clicks_adv_fw,
+            n_clicks_clpr, cnm_sync,
             data_add, data_rmv,
             idx_ann_clicked, ns_clicks_cmt, ns_clicks_cmt_rmv,
-            plots, disables_lead_add, figs_gra: List[Dict[str, Dict]], fig_tmb, ns_clicks_tag):
+            disables_lead_add, ns_clicks_tag):
         """Display lead figures based on current record and template selected, and based on lead selection in modal
 
         Initializes lead selections
@@ -655,10 +814,8 @@ class EcgApp:
         :param layout_tmb: RelayoutData of global preview
         :param n_clicks_adv_bk: Number of clicks for advance back button
         :param n_clicks_mv_bk: Number of clicks for nudge back button
-        :param n_clicks_fixy: Number of clicks for fix-yaxis button
         :param n_clicks_mv_fw: Number of clicks for nudge forward button
         :param n_clicks_adv_fw: Number of clicks for advance forward button
-        :param n_clicks_mkg_tg: Number of clicks for toggle markings button
         :param n_clicks_clpr: Number of clicks for clear caliper measurements
         :param cnm_sync: Class name for caliper synchronization icon
         :param data_add: Tuple info on if adding took place and if so the lead index added
@@ -668,15 +825,12 @@ class EcgApp:
         :param ns_clicks_cmt_rmv: Number of clicks for comment removal
 
         # States
-        :param plots: Div list of of lead currently on plot
         :param disables_lead_add: List of disable boolean states for the add-lead items
-
-        :param figs_gra: Graph object dictionary of actual plot
-        :param fig_tmb: Graph object dictionary of global preview
         :param ns_clicks_tag: List on number of clicks for each tag
 
         .. note:: Previous record and figure overridden
         .. note:: Selections in modal are disabled if corresponding lead is shown
+        .. note:: Figures are updated by the properties changed only, see `EcgFigures`
         """
 
         # Shared output must be in a single function call per Dash callback
@@ -697,26 +851,33 @@ class EcgApp:
             return anns
 
         def _update_figs_annotations():
-            tags = _get_tag_annotations() # Override original values, for potential text annotation removal
-            for i, f in enumerate(figs_gra):
-                f['layout']['annotations'] = tags + self.ui.get_caliper_annotations(self.idxs_lead[i])
+            with EcgMetrics.phase('annotation'):
+                self._set_figs_annotations(figs_gra, idx_ann_clicked)
+            ks_ptch.add(EcgFigures.K_ANTN)
 
         def _clear_figs_shapes():
             self._shapes = []
             for f in figs_gra:
                 f['layout']['shapes'] = []
+            ks_ptch.add(EcgFigures.K_SHP)
 
-        def _update_lead_figures():
+        def _update_lead_figures(cancelable=False):
+            """
+            :param cancelable: If true, dropped when superseded by a newer render of the session, for navigation only
+            """
             strt, end = self.disp_rng[0]
-            sample_factor = self.plt.get_sample_factor(strt, end)
-            x_vals = self.rec.get_time_values(strt, end, sample_factor)
-            lst_args = [(idx_idx, idx_lead, strt, end, sample_factor)  # The strt, end variables here cannot be saved
-                        for idx_idx, idx_lead in enumerate(self.idxs_lead)]
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.MAX_NUM_LD) as executor:
-                executor.map(lambda args: _set_y_vals(*args), lst_args)
-
-            removed, edited_prev = self.ui.update_caliper_annotations_time(
-                strt, end, figs_gra, self.idxs_lead, idx_changed)
+            ks_ptch.update(EcgFigures.KS_NAV)
+            n_rndr = self.figs.begin_render(sid)
+            # A single read across all leads on display
+            xy_vals = self.plt.get_xy_block(self.idxs_lead, strt, end)
+            if cancelable and self.figs.is_superseded(sid, n_rndr):  # The newer range renders instead
+                raise PreventUpdate
+            for idx_idx, (_, y_vals) in enumerate(xy_vals):
+                _set_y_vals(idx_idx, y_vals)
+
+            with EcgMetrics.phase('annotation'):
+                removed, edited_prev = self.ui.update_caliper_annotations_time(
+                    strt, end, figs_gra, self.idxs_lead, idx_changed)
             nonlocal cmt_btn_txt
             if edited_prev:
                 cmt_btn_txt = OVR
@@ -727,34 +888,21 @@ class EcgApp:
                 self._shapes = figs_gra[0]['layout']['shapes']  # Pick any one, shapes already removed
                 self.ui.highlight_mru_caliper_edit(figs_gra, self.idxs_lead)
             _update_figs_annotations()
-            for f in figs_gra:  # Lines up with number of figures plotted
+            for f, (x_vals, _) in zip(figs_gra, xy_vals):  # Lines up with number of figures plotted
                 # Short execution time, no need to multi-process
                 f[D][0]['x'] = x_vals
                 # Without this line, the range displayed can be invalid
                 f['layout']['xaxis']['range'] = x_layout_range  # This has to be the last assignment
 
-        def _set_y_vals(idx_idx, idx_lead, strt, end, sample_factor):
-            y_vals = self.rec.get_ecg_samples(idx_lead, strt, end, sample_factor)
+        def _set_y_vals(idx_idx, y_vals):
             if self._yaxis_fixed:
                 rang = figs_gra[idx_idx]['layout']['yaxis']['range']
-                figs_gra[idx_idx][D][0]['y'] = y_vals
+                figs_gra[idx_idx][D][0]['y'] = self.plt.encode_y(y_vals)
                 figs_gra[idx_idx]['layout']['yaxis']['range'] = rang  # Preserves the original range, by intuition
             else:
-                figs_gra[idx_idx][D][0]['y'] = y_vals
-                figs_gra[idx_idx]['layout']['yaxis']['range'] = self.ui.get_ignore_noise_range(y_vals)
-
-        def _shift_is_out_of_lim(strt, end, offset):
-            """ On advance and nudge navigation controls.
-
-            Checks if doing a shift at edge that collapses start and end into the same time
-            """
-            # Guess no need to show an error alert, users will figure it out
-            if offset < 0 and end + offset < 0:  # Shift back and end timestamp will be 0
-                return True
-            elif offset > 0 and strt + offset > self.rec.COUNT_END:
-                return True
-            else:
-                return False
+                figs_gra[idx_idx][D][0]['y'] = self.plt.encode_y(y_vals)
+                with EcgMetrics.phase('y_range'):
+                    figs_gra[idx_idx]['layout']['yaxis']['range'] = self.ui.get_ignore_noise_range(y_vals)
 
         def _create_comment_range_labels():
             c = self.ui.get_mru_caliper_coords()
@@ -798,11 +946,13 @@ class EcgApp:
             ]
             _update_lead_figures()
             fig_tmb['layout']['xaxis']['range'] = x_layout_range
+            ks_tmb.add(EcgFigures.K_XRNG)
             nonlocal time_label
             time_label = self.ui.count_pr_to_time_label(*self.disp_rng[0])
 
         def _update_caliper(layout, idx_ld, idx_idx_ch):
-            update, edited_prev = self.ui.update_caliper_annotations_shape(layout, idx_ld)
+            with EcgMetrics.phase('annotation'):
+                update, edited_prev = self.ui.update_caliper_annotations_shape(layout, idx_ld)
             nonlocal cmt_btn_txt
             if not edited_prev:
                 self._end_track_comment()
@@ -815,6 +965,7 @@ class EcgApp:
                 cmt_btn_txt = SV
 
             _update_figs_annotations()
+            ks_ptch.add(EcgFigures.K_SHP)
             if self.ui.caliper_is_synchronized():  # Broadcast shape changes to all leads
                 self._shapes = figs_gra[idx_idx_ch]['layout']['shapes']
                 for idx, f in enumerate(figs_gra):
@@ -828,6 +979,12 @@ class EcgApp:
         prop_id_ch = self.get_last_changed_id_property()
         id_ch = self.ui.get_id(prop_id_ch)
 
+        sid = self.sess.sid
+        plots = self.plots  # Div list of lead currently on plot
+        figs_gra: List[Dict[str, Dict]] = [self.get_plot_fig(p) for p in plots]  # Graph object dictionaries
+        fig_tmb = self.fig_tmb.fig if self.fig_tmb is not None else dash.no_update  # Dictionary of global preview
+        ks_ptch = set()  # Paths into the lead figures changed
+        ks_tmb = set()  # Paths into the thumbnail figure changed
         time_label = dash.no_update  # Both dependent on number of leads on plot == 0
         disable_export_btn = dash.no_update
         cmt_rng_label = dash.no_update
@@ -842,13 +999,12 @@ class EcgApp:
             disables_lead_add = [False] * len(disables_lead_add)  # All options are not disabled
             if record_name is not None:
                 fig_tmb = self.fig_tmb.add_trace([], override=True)  # Basically removes all trace without adding
+                ks_tmb.add(EcgFigures.K_FIG)
                 ns_clicks_tag = [0] * self.rec.N_TAG
             else:
-                fig_tmb = dash.no_update
                 ns_clicks_tag = []
             time_label = None
             disable_export_btn = True
-            figs_gra = [dash.no_update] * len(figs_gra)
         elif ID_DPD_LD_TEMPL == id_ch:
             if template is not None:
                 self.idxs_lead = deepcopy(self.LD_TEMPL[template])  # Deepcopy cos idx_lead may mutate
@@ -861,6 +1017,7 @@ class EcgApp:
                 for idx in self.idxs_lead:
                     disables_lead_add[idx] = True
                 fig_tmb = self.fig_tmb.add_trace(deepcopy(self.idxs_lead), override=True)
+                ks_tmb.add(EcgFigures.K_FIG)
                 time_label = self.ui.count_pr_to_time_label(*self.disp_rng[0])
                 disable_export_btn = False
             else:  # Reset layout
@@ -869,9 +1026,9 @@ class EcgApp:
                 disables_lead_add = [False] * len(disables_lead_add)  # All options are not disabled
                 # figs_gra = []  # For same reason below, the remove button case
                 fig_tmb = self.fig_tmb.add_trace([], override=True)  # Basically removes all trace without adding
+                ks_tmb.add(EcgFigures.K_FIG)
                 time_label = None
                 disable_export_btn = True
-            figs_gra = [dash.no_update] * len(figs_gra)
             ns_clicks_tag = dash.no_update
             change_heights = True
             self.ui.clear_measurements()  # Remove all caliper measurements as the easiest solution
@@ -881,14 +1038,19 @@ class EcgApp:
             idx_changed = self.ui.get_pattern_match_index(prop_id_ch)
             idx_idx_ch = self._get_fig_index_by_index(idx_changed)
             l = layouts_fig[idx_idx_ch]
+            if layouts_fig is not None:
+                self.figs.apply_relayout(figs_gra[idx_idx_ch]['layout'], l)
             if layouts_fig is not None and self.ui.K_XS in l:  # Navigation
                 # Execution won't go in if adding a new lead, cos layout doesn't contain KEY_X_S on create
+                if self.is_range_superseded():  # Layout is in sync already, the newer range renders instead
+                    raise PreventUpdate
                 l_c = figs_gra[idx_idx_ch]['layout']
                 self.disp_rng[0] = self.ui.get_x_display_range(l_c)
                 yaxis_rng_ori = l_c['yaxis']['range']
                 fig_tmb['layout']['xaxis']['range'] = x_layout_range = \
                     self.ui.get_x_layout_range(layouts_fig[idx_idx_ch])
-                _update_lead_figures()
+                ks_tmb.add(EcgFigures.K_XRNG)
+                _update_lead_figures(cancelable=True)
                 l_c['yaxis']['range'] = yaxis_rng_ori
                 plots = dash.no_update
                 disables_lead_add = self.no_update_add_opns
@@ -905,10 +1067,13 @@ class EcgApp:
         elif ID_TMB == id_ch:  # Changes in thumbnail figure have to be range change
             # Workaround: At first app start, ID_TMB is in changed_id for unknown reason
             if self.rec is not None:
+                if layout_tmb is not None:
+                    self.figs.apply_relayout(fig_tmb['layout'], layout_tmb)
+                if self.is_range_superseded():
+                    raise PreventUpdate
                 self.disp_rng[0] = self.ui.get_x_display_range(fig_tmb['layout'])
                 x_layout_range = fig_tmb['layout']['xaxis']['range']
-                _update_lead_figures()
-                fig_tmb = dash.no_update
+                _update_lead_figures(cancelable=True)
                 plots = dash.no_update
                 disables_lead_add = self.no_update_add_opns
                 time_label = self.ui.time_range_to_time_label(*x_layout_range)
@@ -918,23 +1083,6 @@ class EcgApp:
             else:
                 raise PreventUpdate
 
-        elif ID_BTN_FIXY == id_ch:
-            self._yaxis_fixed = not self._yaxis_fixed
-            for f in figs_gra:
-                f['layout']['yaxis']['fixedrange'] = n_clicks_fixy % 2 == 1
-                fig_tmb = dash.no_update
-                plots = dash.no_update
-                disables_lead_add = self.no_update_add_opns
-            ns_clicks_tag = dash.no_update
-        elif ID_IC_TG_TG == id_ch:
-            if self.rec is not None:
-                _update_figs_annotations()
-                plots = dash.no_update
-                disables_lead_add = self.no_update_add_opns
-                fig_tmb = dash.no_update
-                ns_clicks_tag = dash.no_update
-            else:
-                raise PreventUpdate
         elif ID_BTN_CLP_CLR == id_ch or ID_IC_CLP_SYNC == id_ch:
             if self.rec is None:  # Toggle without a record selected
                 raise PreventUpdate
@@ -947,7 +1095,6 @@ class EcgApp:
             disable_comment = not self.ui.has_measurement()
             plots = dash.no_update
             disables_lead_add = self.no_update_add_opns
-            fig_tmb = dash.no_update
             ns_clicks_tag = dash.no_update
             cmt_btn_txt = SV  # As of now, edits to comment would be towards a new one
             txt_cmt = ''
@@ -970,19 +1117,17 @@ class EcgApp:
 
         elif self.move_offset_counts is not None and id_ch in self.move_offset_counts:
             # The keys: [ID_BTN_ADV_BK, ID_BTN_MV_BK, ID_BTN_MV_FW, ID_BTN_ADV_FW] by construction
-            offset_count = self.move_offset_counts[id_ch]
-            strt, end = self.disp_rng[0]
-            if not _shift_is_out_of_lim(strt, end, offset_count):
-                strt += offset_count
-                end += offset_count
-                strt, end = self.rec.keep_range(strt), self.rec.keep_range(end)
+            rng = self.get_moved_range(*self.disp_rng[0], self.move_offset_counts[id_ch])
+            if rng is not None:
+                strt, end = rng
                 self.disp_rng[0] = [strt, end]
                 x_layout_range = [
                     self.rec.count_to_pd_time(strt),
                     self.rec.count_to_pd_time(end)
                 ]
-                _update_lead_figures()
+                _update_lead_figures(cancelable=True)
                 fig_tmb['layout']['xaxis']['range'] = x_layout_range
+                ks_tmb.add(EcgFigures.K_XRNG)
                 plots = dash.no_update
                 disables_lead_add = self.no_update_add_opns
                 time_label = self.ui.time_range_to_time_label(*x_layout_range)
@@ -1000,7 +1145,7 @@ class EcgApp:
                 plots.append(self.get_fig_layout(idx_add, anns))
                 disables_lead_add[idx_add] = True
                 fig_tmb = self.fig_tmb.add_trace([idx_add], override=False)
-                figs_gra = [dash.no_update] * len(figs_gra)
+                ks_tmb.add(EcgFigures.K_FIG)
                 if len(self.idxs_lead) == 1:  # from 0 to 1 lead
                     time_label = self.ui.count_pr_to_time_label(*self.disp_rng[0])
                     disable_export_btn = False
@@ -1011,6 +1156,7 @@ class EcgApp:
         elif ID_STOR_RMV == id_ch:
             idx_idx_rmv, idx_rmv = data_rmv  # There will always be something to remove
             self.fig_tmb.remove_trace(idx_idx_rmv, idx_rmv)
+            ks_tmb.add(EcgFigures.K_FIG)
             # Clear all potential caliper measurements on this lead before removal, to update MRU
             idxs_lead = deepcopy(self.idxs_lead)
             idxs_lead.insert(idx_idx_rmv, idx_rmv)
@@ -1020,7 +1166,6 @@ class EcgApp:
                 cmt_rng_label = _create_comment_range_labels()
             del plots[idx_idx_rmv]
             disables_lead_add[idx_rmv] = False
-            figs_gra = [dash.no_update] * len(figs_gra)
             # Surprisingly when I have the line below, Dash gives weird exception, instead of not having this line
             # del figs_gra[idx_idx_changed]'
             if len(self.idxs_lead) == 0:  # from 1 to 0 lead
@@ -1036,20 +1181,15 @@ class EcgApp:
             if not (strt <= count <= end):  # Navigate to point of annotation
                 _shift_range((end - strt) // 2)
             else:  # Annotation clicked on is within display range
-                fig_tmb = dash.no_update
-                n_update = [dash.no_update] * len(figs_gra)
                 anns = figs_gra[0]['layout']['annotations']  # Get current annotations on display with arbitrary figure
                 l = len(anns)
-                if l == 0:
-                    figs_gra = n_update
-                else:
+                if l != 0:
                     strt_idx = anns[0]['idx']
                     if strt_idx <= idx_ann_clicked <= strt_idx + l - 1:
                         idx = bisect_left(list(range(strt_idx, strt_idx + l)), idx_ann_clicked)
                         for f in figs_gra:
                             f['layout']['annotations'][idx]['bgcolor'] = ANTN_BG_CLR_CLK
-                    else:
-                        figs_gra = n_update
+                        ks_ptch.add(EcgFigures.K_ANTN)
             plots = dash.no_update
             disables_lead_add = self.no_update_add_opns
         elif ID_BDG_CMT_TM == id_ch and not all(v == 0 for v in ns_clicks_cmt):
@@ -1070,21 +1210,26 @@ class EcgApp:
             cmt_btn_txt = OVR
 
             plots = dash.no_update
-            fig_tmb = dash.no_update
             disables_lead_add = self.no_update_add_opns
         elif id_ch == ID_BTN_CMT_RMV:
             cmt_btn_txt = SV
 
             plots = dash.no_update
             disables_lead_add = self.no_update_add_opns
-            figs_gra = [dash.no_update] * len(figs_gra)
-            fig_tmb = dash.no_update
             ns_clicks_tag = dash.no_update
         else:
             raise PreventUpdate
         self.idx_ann_clicked = idx_ann_clicked
+        if plots is not dash.no_update:
+            self.plots = plots
+        if self.idxs_lead and (EcgFigures.K_Y in ks_ptch or plots is not dash.no_update):
+            self._prefetch()
+        ptch_figs = self.figs.get_figs_patch(figs_gra, self.idxs_lead, ks_ptch) if ks_ptch else dash.no_update
+        if EcgFigures.K_FIG in ks_tmb:
+            ks_tmb = [EcgFigures.K_FIG]
+        ptch_tmb = self.figs.get_fig_patch(fig_tmb, ks_tmb) if ks_tmb else dash.no_update
         return (
-            plots, disables_lead_add, figs_gra, fig_tmb,
+            plots, disables_lead_add, ptch_figs, ptch_tmb,
             time_label, cmt_rng_label,
             disable_comment, disable_comment, disable_export_btn,
             ns_clicks_tag,
@@ -1092,6 +1237,51 @@ class EcgApp:
             cmt_btn_txt, txt_cmt
         )
 
+    def get_moved_range(self, strt, end, offset):
+        """ On advance and nudge navigation controls.
+
+        :return: The display range shifted by `offset`, None if doing a shift at edge that collapses start and end
+        into the same time
+        """
+        # Guess no need to show an error alert, users will figure it out
+        if offset < 0 and end + offset < 0:  # Shift back and end timestamp will be 0
+            return None
+        elif offset > 0 and strt + offset > self.rec.COUNT_END:
+            return None
+        else:
+            return [self.rec.keep_range(strt + offset), self.rec.keep_range(end + offset)]
+
+    def _prefetch(self):
+        """ Reads ahead the display ranges a nudge or advance away, nearest first """
+        if self.plt.prefetch is not None:
+            rngs = [self.get_moved_range(*self.disp_rng[0], offset)
+                    for offset in sorted(self.move_offset_counts.values(), key=abs)]
+            self.plt.prefetch.schedule(self.sess.sid, self.idxs_lead, [rng for rng in rngs if rng is not None])
+
+    def _set_figs_annotations(self, figs_gra, idx_ann_clicked):
+        """ Static tag and caliper measurement annotations, overrides original values for potential removal """
+        if self.rec is not None and self._marking_on:
+            tags = self.ui.get_tags(*(self.disp_rng[0]), idx_ann_clicked)
+        else:
+            tags = []
+        for i, f in enumerate(figs_gra):
+            f['layout']['annotations'] = tags + self.ui.get_caliper_annotations(self.idxs_lead[i])
+
+    def update_tag_annotations(self, cnm_tg):
+        """ Shows or hides static tags on the lead figures, by annotations only """
+        if self.rec is None:
+            raise PreventUpdate
+        figs_gra = [self.get_plot_fig(p) for p in self.plots]
+        self._set_figs_annotations(figs_gra, self.idx_ann_clicked)
+        return self.figs.get_figs_patch(figs_gra, self.idxs_lead, [EcgFigures.K_ANTN])
+
+    def update_fix_yaxis(self, n_clicks):
+        self._yaxis_fixed = not self._yaxis_fixed
+        figs_gra = [self.get_plot_fig(p) for p in self.plots]
+        for f in figs_gra:
+            f['layout']['yaxis']['fixedrange'] = n_clicks % 2 == 1
+        return self.figs.get_figs_patch(figs_gra, self.idxs_lead, [EcgFigures.K_YFIX])
+
     @staticmethod
     def toggle_tags_n_comments_panel(n_clicks):
         if n_clicks % 2 == 0:
@@ -1241,9 +1431,73 @@ class EcgApp:
         else:
             return join(CNM_TG_TG, ANM_BTN_TG_TG_ROTS), True, 'Static tags hidden'
 
-    def export_csv(self, n_clicks):
+    def export_csv(self, n_clicks, fmt):
+        """ Starts exporting the range & leads on display in the background, in the format selected, see `EcgJobs`
+
+        :return: Export job, polled by `poll_export`
+        """
         strt, end = self.disp_rng[0]
-        return self.exp.export(strt, end, self.idxs_lead)
+        fmt = fmt or 'csv'
+        return dict(
+            key=self.jobs.submit(self.exp, strt, end, list(self.idxs_lead), fmt), fmt=fmt,
+            nm=self.exp.get_file_name(strt, end, self.idxs_lead, fmt),
+            n=n_clicks  # A new link for each click
+        )
+
+    def poll_export(self, job, n_intervals):
+        """
+        :return: Progress bar value, color & class name, link to the artifact once done, and whether polling stops
+        """
+        st = self.jobs.status(job['key'], job['fmt'])
+        if st['done']:
+            href = self.app.get_relative_path(f'{self.PATH_EXP}/{job["key"]}.{job["fmt"]}') + '?' + urlencode(dict(
+                nm=job['nm'], n=job['n']
+            ))
+            return 100, 'primary', CNM_PRG_EXP_HD, href, True
+        elif 'error' in st:
+            return 100, 'danger', '', dash.no_update, True
+        else:
+            return round(st['progress'] * 100), 'primary', '', dash.no_update, False
+
+    def send_export(self, nm):
+        """ Serves the artifact of an export job, see `EcgJobs` """
+        key, _, fmt = nm.partition('.')
+        if not EcgJobs.PATN_KEY.fullmatch(key) or fmt not in EcgExport.FMTS:
+            flask.abort(404)
+        path = self.jobs.get_path(key, fmt)
+        if not os.path.exists(path):
+            flask.abort(404)
+        return flask.send_file(path, mimetype=EcgExport.FMTS[fmt], as_attachment=True,
+                               attachment_filename=flask.request.args.get('nm', nm))
+
+    def stream_export(self):
+        """ Serves the export of a session, streamed as it's written, see `EcgExport.export`
+
+        For direct links, e.g. scripts; the UI exports in the background, see `export_csv`
+        """
+        args = flask.request.args
+        sid = args.get('sid')
+        if not EcgSessions.is_valid_id(sid):
+            flask.abort(404)
+        with self.sessions.lock(sid):  # Tags & comments are taken as of the request, the rows are streamed after
+            sess = self.sessions.find(sid)
+            if sess is None or sess.rec is None:
+                flask.abort(404)
+            fmt = args.get('fmt', 'csv')
+            try:
+                strt, end = (sess.rec.keep_range(int(args[k])) for k in ['strt', 'end'])
+                idxs_lead = [int(idx) for idx in args['leads'].split(',') if idx]
+            except (KeyError, ValueError):
+                flask.abort(400)
+            if fmt not in EcgExport.FMTS:
+                flask.abort(400)
+            idxs_lead = [idx for idx in idxs_lead if 0 <= idx < sess.rec.n_lead]
+            exp = copy(sess.exp)  # The session may move on to another record while streaming
+            chunks = exp.export(strt, end, idxs_lead, fmt)
+            fl_nm = exp.get_file_name(strt, end, idxs_lead, fmt)
+        return flask.Response(chunks, mimetype=EcgExport.FMTS[fmt], headers={
+            'Content-Disposition': f'attachment; filename="{fl_nm}"'
+        })
 
     @staticmethod
     def example():
@@ -0,0 +1,179 @@
+import os
+import re
+import csv
+import glob
+import pathlib
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from ecg_record import EcgRecord
+from ecg_comment import EcgComment
+from ecg_export import EcgExport
+
+
+def _init_worker():
+    EcgRecord.USE_PYR = False  # Exports read at full resolution, no sidecar built for the pyramid
+    EcgRecord.N_PROC = 0  # Records are the parallelism
+
+
+def _export_record(path, path_out, prefix, leads, rngs, tag_type, around, fmt):
+    """ Run by each worker process, for a single record
+
+    :param prefix: Path of the files written relative to `path_out`, without index, tag & extension, per `get_prefixes`
+    :return: List of manifest rows
+    """
+    rec = EcgRecord(pathlib.Path(path), None)
+    try:
+        exp = EcgExport()
+        exp.set_record(rec, EcgComment(rec, read_only=True))  # Comments stored by the app, if any
+        idxs_lead = EcgBatch.get_leads(rec, leads)
+        os.makedirs(os.path.join(path_out, os.path.dirname(prefix)), exist_ok=True)
+        rows = []
+        for i, (strt, end, tag) in enumerate(EcgBatch.get_ranges(rec, rngs, tag_type, around)):
+            fl_nm = f'{prefix}_{i:04d}' + (f'_{re.sub(r"[^0-9A-Za-z]+", "-", tag)}' if tag else '') + f'.{fmt}'
+            with open(os.path.join(path_out, fl_nm), 'wb') as f:
+                exp.write(f, strt, end, idxs_lead, fmt)
+            rows.append(dict(
+                record=str(path), file=fl_nm, tag=tag, strt=strt, end=end,
+                time_strt=str(rec.count_to_pd_delta(strt)), time_end=str(rec.count_to_pd_delta(end)),
+                leads=' '.join(rec.lead_nms[idx] for idx in idxs_lead), n_byte=os.path.getsize(f.name), error=''
+            ))
+        return rows
+    finally:
+        rec.close()
+
+
+class EcgBatch:
+    """Exports ranges across many records at once, on a pool of processes, one record per task, see `EcgExport`.
+
+    Ranges are either absolute, as time since the start of the record,
+    or windows around each static annotation/tag of a type, e.g. every `Ablation`.
+    A manifest, `manifest.csv`, lists every file written, with its record, range, leads and tag, or the error of a
+    record that failed.
+
+    Files of each record are written in its folder relative to the folder common to all records, see `get_prefixes`.
+
+    Run `python ecg_batch.py '<glob of records>'... --out <dir> --around Ablation 5 --leads I II V1`, see `--help`
+    """
+
+    NM_MANIFEST = 'manifest.csv'
+    COLS_MANIFEST = ['record', 'file', 'tag', 'strt', 'end', 'time_strt', 'time_end', 'leads', 'n_byte', 'error']
+
+    @staticmethod
+    def get_paths(patns):
+        """
+        :param patns: Glob patterns of record files
+        :return: Sorted paths matched, without duplicates
+        """
+        return sorted({p for patn in patns for p in glob.glob(os.path.expanduser(patn), recursive=True)})
+
+    @staticmethod
+    def get_prefixes(paths):
+        """ Names of the files exported per record, unique as paths are, e.g. `a/x.h5` & `b/x.h5` => `a/x` & `b/x`
+
+        :param paths: Paths to the records
+        :return: List of paths relative to the output directory, in POSIX form, without index, tag & extension
+        :raises ValueError: If records in the same folder share a name, e.g. `x.h5` & `x.hdf5`
+        """
+        paths = [pathlib.Path(p).resolve() for p in paths]
+        root = pathlib.Path(os.path.commonpath([p.parent for p in paths])) if paths else None
+        prefixes = [p.parent.relative_to(root).joinpath(p.stem).as_posix() for p in paths]
+        dups = sorted({pre for pre in prefixes if prefixes.count(pre) > 1})
+        if dups:
+            raise ValueError(f'Records export to the same file names: {", ".join(dups)}')
+        return prefixes
+
+    @staticmethod
+    def get_leads(rec, leads):
+        """
+        :param leads: List of lead names or indices as strings; all leads if empty
+        :return: Lead indices present in the record, in the order given
+        """
+        if not leads:
+            return list(range(rec.n_lead))
+        idxs = [int(ld) if ld.isdigit() else rec.lead_nms.index(ld) if ld in rec.lead_nms else -1 for ld in leads]
+        return [idx for idx in idxs if 0 <= idx < rec.n_lead]
+
+    @staticmethod
+    def get_ranges(rec, rngs=(), tag_type=None, around=None):
+        """
+        :param rngs: List of 2-tuple of start & end times since the start of the record, e.g. `('1min', '0:02:30')`
+        :param tag_type: Regular expression on the type of tags, matched in full ignoring case
+        :param around: Seconds before & after each tag matched
+        :return: List of 3-tuple of inclusive start & end sample counts, and the tag type or None, clipped to the record
+        """
+        ret = []
+        for strt, end in rngs:
+            ret.append((rec.pd_delta_to_count(pd.Timedelta(strt)), rec.pd_delta_to_count(pd.Timedelta(end)), None))
+        if tag_type is not None:
+            patn = re.compile(tag_type, re.IGNORECASE)
+            n = round(around * rec.spl_rate)
+            for typ, t_ms, _ in rec.tags:
+                if patn.fullmatch(typ):
+                    count = rec.ms_to_count(t_ms)
+                    ret.append((count - n, count + n, typ))
+        return [
+            (rec.keep_range(strt), rec.keep_range(end), tag) for strt, end, tag in ret
+            if end >= 0 and strt <= rec.COUNT_END and strt <= end
+        ]
+
+    @staticmethod
+    def run(paths, path_out, leads=(), rngs=(), tag_type=None, around=10, fmt='csv', n_proc=None):
+        """
+        :param paths: Paths to the records
+        :param path_out: Directory the exports & manifest are written to
+        :param leads: Per `get_leads`
+        :param rngs: Per `get_ranges`
+        :param fmt: One of `EcgExport.FMTS`
+        :param n_proc: Number of worker processes, the number of CPUs by default
+        :return: Path to the manifest
+        """
+        prefixes = EcgBatch.get_prefixes(paths)  # Before any file is written
+        os.makedirs(path_out, exist_ok=True)
+        path_mnf = os.path.join(path_out, EcgBatch.NM_MANIFEST)
+        # Spawn instead of fork, as HDF5 state in the parent process isn't safe to inherit
+        with ProcessPoolExecutor(
+                max_workers=n_proc, mp_context=mp.get_context('spawn'), initializer=_init_worker
+        ) as pool, open(path_mnf, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=EcgBatch.COLS_MANIFEST)
+            writer.writeheader()
+            futures = {
+                pool.submit(
+                    _export_record, str(p), str(path_out), pre, list(leads), list(rngs), tag_type, around, fmt
+                ): p for p, pre in zip(paths, prefixes)
+            }
+            for fut in as_completed(futures):  # Written as each record finishes
+                try:
+                    rows = fut.result()
+                except Exception as e:  # The rest of the records still export, e.g. on a corrupt file
+                    rows = [dict(record=str(futures[fut]), error=f'{type(e).__name__}: {e}')]
+                writer.writerows(rows)
+                f.flush()
+                print(f'{futures[fut]}: {"failed" if rows and rows[0]["error"] else f"{len(rows)} exports"}')
+        return path_mnf
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Exports ranges across records, in parallel, with a manifest')
+    parser.add_argument('records', nargs='+', help='Glob patterns of record files, e.g. `data/**/*.h5`')
+    parser.add_argument('--out', type=pathlib.Path, required=True, help='Directory the exports are written to')
+    parser.add_argument('--leads', nargs='*', default=[], help='Lead names or indices; all leads by default')
+    parser.add_argument('--range', nargs=2, action='append', default=[], metavar=('START', 'END'), dest='rngs',
+                        help='Times since the start of each record, e.g. `--range 1min 0:02:30`; repeatable')
+    parser.add_argument('--around', nargs=2, default=None, metavar=('TAG_TYPE', 'SECONDS'),
+                        help='Window of seconds before & after each tag of a type, a regular expression')
+    parser.add_argument('--fmt', default='csv', choices=list(EcgExport.FMTS))
+    parser.add_argument('--n-proc', type=int, default=None, help='Number of processes, the number of CPUs by default')
+    args = parser.parse_args()
+
+    tag_type, around = (args.around[0], float(args.around[1])) if args.around is not None else (None, None)
+    paths = EcgBatch.get_paths(args.records)
+    print(f'{len(paths)} records')
+    try:
+        path_mnf = EcgBatch.run(paths, args.out, args.leads, args.rngs, tag_type, around, args.fmt, args.n_proc)
+    except ValueError as e:  # Name collisions, nothing written
+        parser.error(str(e))
+    print(f'Written {path_mnf}')
@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EcgCache:
+    """ Byte-bounded, least-recently-used cache of decoded blocks of 2D datasets, e.g. `EcgRecord` segments
+
+    Each block is the values of a single row, i.e. lead, over `SZ_BLK` consecutive samples,
+    keyed by (dataset key, row index, block index).
+    Dataset keys are tuples led by the key of their owner, e.g. a record, so that a single cache serves all records.
+    Navigating back and forth around the same region is then served from memory.
+    """
+
+    SZ_BLK = 2 ** 14  # Number of samples in a block
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: Maximum total size of blocks kept, least recently used blocks are evicted beyond
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.n_hit = 0
+        self.n_miss = 0
+        self._blks = OrderedDict()
+        self._lock = threading.Lock()  # Callbacks may read concurrently
+
+    def __len__(self):
+        return len(self._blks)
+
+    def get(self, key):
+        """
+        :return: The cached value, None if not present
+        """
+        with self._lock:
+            v = self._blks.get(key)
+            if v is None:
+                self.n_miss += 1
+            else:
+                self.n_hit += 1
+                self._blks.move_to_end(key)
+            return v
+
+    def put(self, key, v):
+        with self._lock:
+            if key in self._blks:
+                self.n_bytes -= self._blks.pop(key).nbytes
+            self._blks[key] = v
+            self.n_bytes += v.nbytes
+            while self.n_bytes > self.max_bytes and self._blks:
+                self.n_bytes -= self._blks.popitem(last=False)[1].nbytes
+
+    def drop(self, owner):
+        """ Removes the blocks of all datasets of `owner`, e.g. of a record closed """
+        with self._lock:
+            for key in [key for key in self._blks if key[0][0] == owner]:
+                self.n_bytes -= self._blks.pop(key).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._blks.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        return dict(n_hit=self.n_hit, n_miss=self.n_miss, n_blk=len(self._blks), n_bytes=self.n_bytes)
+
+    def read(self, dset, key, rows, strt, end, step=1):
+        """ Same values as `dset[rows, strt:end:step]`, where missing blocks are read in 1 go across rows
+
+        Blocks are cached at full resolution, strided after.
+        Reads larger than half the budget bypass the cache, so that a single pass doesn't flush it, strided by `dset`
+
+        :param dset: 2D dataset, #rows * #samples
+        :param key: Identifies `dset` among all datasets cached, led by the key of its owner
+        :param rows: Index of the row, or increasing list of indices
+        :param strt: Start index, inclusive
+        :param end: End index, exclusive, None for end of `dset`
+        """
+        end = dset.shape[1] if end is None else min(end, dset.shape[1])
+        is_single = np.isscalar(rows)
+        lst_rows = [rows] if is_single else rows
+        if end <= strt or (end - strt) * len(lst_rows) * dset.dtype.itemsize > self.max_bytes // 2:
+            return dset[rows, strt:end:step]
+
+        sz = self.SZ_BLK
+        b_strt, b_end = strt // sz, (end - 1) // sz + 1
+        blks = dict()
+        for b in range(b_strt, b_end):
+            miss = []
+            for r in lst_rows:
+                v = self.get((key, r, b))
+                if v is None:
+                    miss.append(r)
+                else:
+                    blks[r, b] = v
+            if miss:
+                for r, v in zip(miss, dset[miss, b * sz:(b + 1) * sz]):
+                    self.put((key, r, b), v)
+                    blks[r, b] = v
+        vals = np.stack([np.concatenate([blks[r, b] for b in range(b_strt, b_end)]) for r in lst_rows])
+        vals = vals[:, strt - b_strt * sz:end - b_strt * sz:step]
+        return vals[0] if is_single else vals
@@ -1,5 +1,7 @@
 import os
 import json
+import sqlite3
+import threading
 
 from bisect import bisect_left
 
@@ -19,21 +21,37 @@ class EcgComment:
     which encodes python's natural sorted order for each object
 
     the x values are in terms of integer ECG sample counts
+
+    Comments of all records are stored in a single SQLite database in write-ahead log mode, indexed by record,
+    lead and sample count, each edit is a single-row write.
+    Comments previously stored in `<record>_comments.json` are imported once, the JSON file is left as is.
     """
 
+    NM_DB = 'comments.sqlite'
+    _local = threading.local()  # Connection to the database of each thread, by path
+
+    SQL_SELECT = 'SELECT x_c, y_c, x0, y0, lead, msg FROM comments WHERE record = ?'
+
     def init(self, record):
         """ Update internal comments/Load potential previous comments on record change """
         self.nm = record.nm
-        self.path = CURR.joinpath(f'{self.nm}_comments.json')
-        if not os.path.exists(self.path) or os.stat(self.path).st_size == 0:
-            with open(self.path, 'w') as f:
-                json.dump([], f, indent=4)
-        f = open(self.path, 'r')
-        self.lst = json.load(f)
+        self.path = CURR.joinpath(self.NM_DB)
+        path_json = CURR.joinpath(f'{self.nm}_comments.json')
+        if self.read_only:
+            lst = self._read(path_json)
+        else:
+            conn = self._get_conn()
+            self._migrate(conn, path_json)
+            lst = conn.execute(self.SQL_SELECT, (self.nm,))
+        self.lst = sorted(map(list, lst))  # Sorting in Python is faster than `ORDER BY`
         self.n_cmts = len(self.lst)  # Number of comments
-        f.close()
 
-    def __init__(self, record):
+    def __init__(self, record, read_only=False):
+        """
+        :param read_only: If true, comments are read if stored, without creating or writing to the database,
+            e.g. for batch exports; edits are kept in memory only
+        """
+        self.read_only = read_only
         self.nm = None
         self.path = None
         self.lst = None
@@ -47,6 +65,77 @@ class EcgComment:
     def __getitem__(self, key):
         return self.lst[key]
 
+    def _get_conn(self):
+        """ Connections are kept per thread, and not pickled along with sessions """
+        conns = self._local.__dict__.setdefault('conns', dict())
+        if self.path not in conns:
+            conn = sqlite3.connect(self.path)
+            conn.execute('PRAGMA journal_mode=WAL')  # Appends to the log instead of rewriting pages in place
+            conn.execute('PRAGMA busy_timeout=5000')  # Other processes writing, e.g. several workers
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS comments (
+                    record TEXT NOT NULL, lead INTEGER NOT NULL,
+                    x_c INTEGER NOT NULL, y_c, x0 INTEGER NOT NULL, y0, msg TEXT NOT NULL,
+                    PRIMARY KEY (record, lead, x_c, y_c, x0, y0)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS migrated (record TEXT PRIMARY KEY);
+            """)
+            conns[self.path] = conn
+        return conns[self.path]
+
+    def _read(self, path_json):
+        """ Comments of the record stored, opening the database read-only, from the JSON file if not migrated """
+        if self.path.exists():
+            try:
+                conn = sqlite3.connect(f'{self.path.as_uri()}?mode=ro', uri=True)
+                try:
+                    if conn.execute('SELECT 1 FROM migrated WHERE record = ?', (self.nm,)).fetchone() is not None:
+                        return conn.execute(self.SQL_SELECT, (self.nm,)).fetchall()
+                finally:
+                    conn.close()
+            except sqlite3.Error:  # e.g. No read access, taken as not migrated
+                pass
+        return self._read_json(path_json)
+
+    @staticmethod
+    def _read_json(path_json):
+        if os.path.exists(path_json) and os.stat(path_json).st_size > 0:
+            with open(path_json, 'r') as f:
+                return json.load(f)
+        return []
+
+    def _migrate(self, conn, path_json):
+        """ Imports the comments of the record from the JSON file of previous versions, once """
+        if conn.execute('SELECT 1 FROM migrated WHERE record = ?', (self.nm,)).fetchone() is not None:
+            return
+        lst = self._read_json(path_json)
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(self.nm, cmt[4], cmt[0], cmt[1], cmt[2], cmt[3], cmt[5]) for cmt in lst]
+            )
+            conn.execute('INSERT OR IGNORE INTO migrated VALUES (?)', (self.nm,))
+
+    def _write(self, comment):
+        """ Inserts the comment, or updates its message """
+        if self.read_only:
+            return
+        with self._get_conn() as conn:
+            conn.execute(
+                'INSERT INTO comments VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (record, lead, x_c, y_c, x0, y0) DO UPDATE SET msg = excluded.msg',
+                (self.nm, comment[4], *comment[:4], comment[5])
+            )
+
+    def _delete(self, comment):
+        if self.read_only:
+            return
+        with self._get_conn() as conn:
+            conn.execute(
+                'DELETE FROM comments WHERE record = ? AND lead = ? AND x_c = ? AND y_c = ? AND x0 = ? AND y0 = ?',
+                (self.nm, comment[4], *comment[:4])
+            )
+
     def update_comment(self, comment):
         """
         Can potentially modify an existing comment, or add a new one
@@ -62,33 +151,30 @@ class EcgComment:
             # The case where there's a previous comment made on this caliper,
             # and the new message is lexicographically larger
             idx -= 1
-            self.lst[idx-1][-1] = comment[-1]
+            self.lst[idx][-1] = comment[-1]
         else:
             self.lst.insert(idx, comment)
             self.n_cmts += 1
-        self.flush()
+        self._write(comment)
         return idx
 
     def override_comment(self, comment, idx):
         """ Remove the comment at index, insert the new comment, and return the index of the new comment
 
         Maintains sorted order """
+        self._delete(self.lst[idx])
         del self.lst[idx]
         idx = bisect_left(self.lst, comment)
         self.lst.insert(idx, comment)  # Number of comments stay the same
+        self._write(comment)
         return idx
 
     def remove_comment(self, idx):
         """ User responsible that `idx` is a valid index """
+        self._delete(self.lst[idx])
         del self.lst[idx]
         self.n_cmts -= 1
 
-    def flush(self):
-        """ Writes all changes made to comments into original JSON file """
-        config = open(self.path, 'w')
-        json.dump(self.lst, config, indent=4)
-        config.close()
-
     def get_comment_list(self, idxs_lead, strt=-1, end=-1, verbose=False):
         """ Get the list of comments in sorted order
         If strt and end are specified as sample counts, only those comments within range are returned
@@ -69,6 +69,11 @@ ID_IC_OPN = 'ic_options'
 ID_DPD_RECR = 'record-dropdown'
 ID_DPD_LD_TEMPL = 'lead-template-dropdown'
 ID_STOR_REC = 'store_record-change'
+ID_STOR_SID = 'store_session-id'  # Keys the state held on the server for each browser session
+ID_STOR_PTCH_FIG = 'store_figure-patch'  # Partial updates to lead figures, merged clientside, see `EcgFigures`
+ID_STOR_PTCH_ANTN = 'store_annotation-patch'
+ID_STOR_PTCH_YFIX = 'store_yaxis-fix-patch'
+ID_STOR_PTCH_TMB = 'store_thumbnail-patch'
 
 ID_DIV_TABS = 'div_tabs'  # Parent of lead channel plots and the annotation panel
 ID_DIV_PLTS = 'div_plots'
@@ -99,6 +104,11 @@ CNM_IC_ADD = 'fas fa-plus'
 ID_BTN_EXP = 'btn_csv-export'
 CNM_IC_EXP = 'fas fa-file-export'
 ID_DLD_CSV = 'download_csv'
+ID_DPD_EXP_FMT = 'dropdown_export-format'
+ID_STOR_EXP_JOB = 'store_export-job'  # Export running in the background, see `EcgJobs`
+ID_ITV_EXP = 'interval_export-progress'
+ID_PRG_EXP = 'progress_export'
+CNM_PRG_EXP_HD = 'progress_export-hidden'  # Shown while an export runs
 
 ID_MD_ADD = 'modal_add'
 ID_MDHD_ADD = 'modal-header_add'
@@ -313,4 +323,5 @@ TPL.layout.annotationdefaults = dict(
 )
 
 CLP_CH = Enum('CaliperChange', 'Add Remove Edit')  # Caliper change
-CLP_SYNC = Enum('LeadSynchronization', 'Synchronized Independent')  # 2 possible caliper types
+# 2 possible caliper types, looked up by name on unpickling, see `EcgSessionsOnDisk`
+CLP_SYNC = Enum('LeadSynchronization', 'Synchronized Independent', module=__name__, qualname='CLP_SYNC')
@@ -1,96 +1,266 @@
-import pandas as pd
-# from bisect import bisect_left
+import io
+import csv
+import json
+import zipfile
+import tempfile
 
-from dash_extensions.snippets import send_data_frame
+import numpy as np
+import h5py
 
-import json
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional, Parquet export not offered
+    pa = pq = None
 
 # from icecream import ic
 from ecg_defns_n_util import *
 
 
 class EcgExport:
-    """ Handles export current lead channel and range of data on display to CSV """
+    """ Handles export current lead channel and range of data on display, to CSV or binary formats
+
+    Samples are read & written chunk by chunk from the record, so memory is bounded regardless of the range exported,
+    e.g. a whole procedure at full resolution.
+
+    Binary formats keep the samples as stored, in the data type of the record,
+    with the sample rate & start count to derive time;
+    tags & comments are kept as JSON metadata, see `export`.
+    """
+
+    N_CHUNK = 2 ** 15  # Number of samples, i.e. rows, read & written at a time
+    SZ_BLOCK = 2 ** 20  # Size in bytes of each block of a binary file streamed
+    FMTS = {  # Export format => MIME type
+        'csv': 'text/csv',
+        'hdf5': 'application/x-hdf5',
+        'npz': 'application/octet-stream',
+        **({'parquet': 'application/vnd.apache.parquet'} if pa is not None else dict())
+    }
 
     def __init__(self):
         self.rec = None
         self.cmts = None
-        self._MAX_EXP_COUNT = None
+        self._tag_counts = None  # Sample count of each tag, for placing tags by `searchsorted`
+        self._tag_types = None
 
     def set_record(self, record, comments):
         self.rec = record
         self.cmts = comments
-        self._MAX_EXP_COUNT = self.rec.spl_rate * 2 * 60
+        self._tag_counts = record.ms_to_count(np.array(record.tags_tm, dtype=np.int64))
+        self._tag_types = np.array([t[0] for t in record.tags], dtype=object)
 
-    def export(self, strt, end, idxs_lead):
-        """
-        At maximum, allow users to export 2 minutes of data as a benchmark.
+    def get_file_name(self, strt, end, idxs_lead, fmt='csv'):
+        title = f'ECG export, idxs {idxs_lead}, [{self.rec.count_to_str(strt)}-{self.rec.count_to_str(end)}]'
+        return f'{title}.{fmt}'
 
-        If start and end values specified goes within 2 *2 min, all data within range are exported;
-        otherwise, function still works but will take steps/samples of the data (due to integer division)
+    def export(self, strt, end, idxs_lead, fmt='csv', on_progress=None):
+        """
+        All samples in the inclusive range
 
+        For CSV, one row per sample, columns are the row index, time, each lead, static annotations/`tag`s across all
+        leads, and the manual annotations/`comment`s of each lead.
         Each comment is stored at the time stamp of sample count as a list element through JSOn string,
         each comment is a 5-element list of <x.center>, <y.center>, <x.0>, <y.0>, <msg>
+
+        For binary formats, the samples are a #leads * #samples array of the record's data type, `ecg` in HDF5 & `.npz`;
+        or a column per lead & `time_us` in Parquet.
+        Tags are a JSON list of [<row>, <type>], comments a JSON dictionary of lead name to per-row list as in CSV
+
+        .. note:: Tags & comments are taken as of the call, the rows are read as the generator is consumed
+
+        :param fmt: One of `FMTS`
+        :param on_progress: Called with the fraction of samples written after each chunk, e.g. for `EcgJobs`
+        :return: Generator of CSV text chunks, or of bytes of the binary file
         """
-        def _find_row(count):
-            """ Given a count, find which row index would the count be in """
-            return (count - strt) // step
-        step = 1  # Grabs all samples by default
-        if end - strt > self._MAX_EXP_COUNT:
-            step = (end - strt) // self._MAX_EXP_COUNT
-        df = pd.DataFrame(
-            merge_d(
-                {'time': self.rec.get_time_values_delta(strt, end, step)},
-                {self.rec.lead_nms[idx]: self.rec.get_ecg_samples(idx, strt, end, step) for idx in idxs_lead}
+        if fmt == 'csv':
+            return self._csv_chunks(
+                strt, end, idxs_lead, self._get_tags(strt, end), self._get_comments(strt, end, idxs_lead), on_progress
             )
+        return self._file_blocks(self._get_write(strt, end, idxs_lead, fmt, on_progress))
+
+    def write(self, f, strt, end, idxs_lead, fmt='csv', on_progress=None):
+        """ Writes the export per `export` to a file, without the copy through a temporary file of binary formats
+
+        :param f: Binary file object
+        """
+        self.get_write(strt, end, idxs_lead, fmt, on_progress)(f)
+
+    def get_write(self, strt, end, idxs_lead, fmt='csv', on_progress=None):
+        """ Per `write`, with tags & comments taken as of the call, e.g. for an export run later by `EcgJobs`
+
+        :return: Function writing the export given a binary file object
+        """
+        if fmt != 'csv':
+            return self._get_write(strt, end, idxs_lead, fmt, on_progress)
+        chunks = self.export(strt, end, idxs_lead, fmt, on_progress)
+
+        def _write(f):
+            for chunk in chunks:
+                f.write(chunk.encode())
+        return _write
+
+    def _get_write(self, strt, end, idxs_lead, fmt, on_progress):
+        """
+        :return: Function writing the binary export given a binary file object, tags & comments taken as of the call
+        """
+        write = dict(hdf5=self._write_hdf5, npz=self._write_npz, parquet=self._write_parquet)[fmt]
+        tags = self._get_tags(strt, end)
+        cmts = self._get_comments(strt, end, idxs_lead)
+        meta = dict(
+            lead_nms=[self.rec.lead_nms[idx] for idx in idxs_lead], sample_rate=self.rec.spl_rate, strt=strt,
+            time_strt_us=int(self.rec._count_to_us(strt)),
+            tags=json.dumps(tags), comments=json.dumps({self.rec.lead_nms[idx]: c for idx, c in zip(idxs_lead, cmts)})
         )
-        t = 'tag'
-        df[t] = ''  # Append static annotation/`tag`s as the next column, across all leads
-        idx_strt, idx_end = self.rec.get_tag_indices(strt, end)
-        for i in range(idx_strt, idx_end):
-            typ, t_ms, _ = self.rec.tags[i]
-            row = _find_row(self.rec.ms_to_count(t_ms))
-            ori = df.at[row, t]
-            df.at[row, t] = typ if ori == '' else f'{ori}; {typ}'
-        for idx_ld in idxs_lead:  # Dependent on each lead
-            col_nm = f'comment_{self.rec.lead_nms[idx_ld]}'
-            df[col_nm] = ''  # Append manual annotations/`comment`s column
-            _, lst = self.cmts.get_comment_list([idx_ld], strt, end, verbose=True)
-            # prev_count = -1
-            # n_same = 0  # Number of comments at the same time stamp
-            # lst_same = []
-            # for cmt in lst:
-            #     x_c, y_c, x0, y0, _, msg = cmt
-            #     if x_c == prev_count:
-            #         n_same += 1
-            #         lst_same.append([x_c, y_c, x0, y0, msg])
-            #     else:
-            #         row = find_row(x_c)
-            #     prev_count = x_c
-            #     # Last comment at the same count
-            # TODO: Not the most memory-efficient way
-
-            def _get_comments():
-                d = dict()
-                for cmt in lst:
-                    count = cmt[0]
-                    # cmt = cmt[:4] + cmt[5:]  # Remove the lead index element
-                    d_cmt = dict(
-                        xc=str(self.rec.count_to_pd_delta(cmt[0])),
-                        yc=cmt[1],
-                        x0=str(self.rec.count_to_pd_delta(cmt[2])),
-                        y0=cmt[3],
-                        msg=cmt[-1]
-                    )
-                    if count in d:
-                        d[count].append(d_cmt)
-                    else:
-                        d[count] = [d_cmt]
-                return d
-
-            for count, cmts in _get_comments().items():
-                df.at[_find_row(count), col_nm] = json.dumps(cmts)
+        return lambda f: write(f, strt, end, idxs_lead, meta, on_progress)
 
-        title = f'ECG export, idxs {idxs_lead}, [{self.rec.count_to_str(strt)}-{self.rec.count_to_str(end)}]'
-        df.style.set_caption(title)
-        return send_data_frame(df.to_csv, filename=f'{title}.csv')
+    @staticmethod
+    def _group(rows, vals):
+        """
+        :param rows: Sorted array of row of each value
+        :return: Unique rows, and the list of values of each
+        """
+        rows_uniq, idxs = np.unique(rows, return_index=True)
+        idxs = idxs.tolist() + [len(rows)]
+        return rows_uniq.tolist(), [vals[i:j].tolist() for i, j in zip(idxs[:-1], idxs[1:])]
+
+    @staticmethod
+    def _us_to_str(us):
+        """ Vectorized `str` of `pd.Timedelta`, e.g. `0 days 00:01:02.500000`, `0 days 00:01:02` """
+        secs, us = np.divmod(us, 10 ** 6)
+        mins, secs = np.divmod(secs, 60)
+        hrs, mins = np.divmod(mins, 60)
+        days, hrs = np.divmod(hrs, 24)
+        return [
+            ('%d days %02d:%02d:%02d.%06d' % t) if t[-1] else ('%d days %02d:%02d:%02d' % t[:-1])
+            for t in zip(*(a.tolist() for a in [days, hrs, mins, secs, us]))
+        ]
+
+    def _get_tags(self, strt, end):
+        """
+        :return: List of [<row>, <type>] of tags in range
+        """
+        idx_strt, idx_end = np.searchsorted(self._tag_counts, [strt, end + 1])
+        return [[row, typ] for row, typ in zip(
+            (self._tag_counts[idx_strt:idx_end] - strt).tolist(), self._tag_types[idx_strt:idx_end].tolist()
+        )]
+
+    def _get_comments(self, strt, end, idxs_lead):
+        """
+        :return: List of dictionary of row to list of comments, per lead
+        """
+        d_ld = {idx_ld: dict() for idx_ld in idxs_lead}  # Dependent on each lead
+        _, lst = self.cmts.get_comment_list(idxs_lead, strt, end, verbose=True)
+        lst = [cmt for cmt in lst if strt <= cmt[0] <= end]
+        if lst:
+            counts, _, counts_x0, _, _, _ = (np.array(a) for a in zip(*lst))
+            xcs = self._us_to_str(self.rec._counts_to_us(counts))
+            x0s = self._us_to_str(self.rec._counts_to_us(counts_x0))
+            for row, xc, x0, (_, yc, _, y0, idx_ld, msg) in zip((counts - strt).tolist(), xcs, x0s, lst):
+                d_ld[idx_ld].setdefault(row, []).append(dict(xc=xc, yc=yc, x0=x0, y0=y0, msg=msg))
+        return [d_ld[idx_ld] for idx_ld in idxs_lead]
+
+    def _chunks(self, strt, end, idxs_lead, on_progress=None):
+        """
+        :return: Generator of start & end sample counts, inclusive, and values of each chunk, #leads * #samples
+        """
+        for strt_ch in range(strt, end + 1, self.N_CHUNK):
+            end_ch = min(strt_ch + self.N_CHUNK - 1, end)
+            if idxs_lead:
+                vals = self.rec.get_ecg_block(idxs_lead, strt_ch, end_ch)
+            else:
+                vals = np.empty((0, end_ch - strt_ch + 1), dtype=self.rec.dtype)
+            yield strt_ch, end_ch, vals
+            if on_progress is not None:
+                on_progress((end_ch - strt + 1) / (end - strt + 1))
+
+    def _csv_chunks(self, strt, end, idxs_lead, tags, cmts, on_progress):
+        def _join(txts):
+            """ Text of the annotation columns, quoted as needed """
+            f = io.StringIO()
+            csv.writer(f, lineterminator='').writerow(txts)
+            return f.getvalue()
+
+        n_col_ann = 1 + len(idxs_lead)
+        anns = dict()  # Row => Annotation columns, for the few rows annotated
+        if tags:
+            rows, typs = zip(*tags)
+            for row, grp in zip(*self._group(np.array(rows), np.array(typs, dtype=object))):
+                anns.setdefault(row, [''] * n_col_ann)[0] = '; '.join(grp)
+        for i_ld, d in enumerate(cmts):
+            for row, lst in d.items():
+                anns.setdefault(row, [''] * n_col_ann)[1 + i_ld] = json.dumps(lst)
+        rows_ann = np.array(sorted(anns), dtype=np.int64) + strt  # Sample counts, to find the rows in each chunk
+        anns = {row: _join(txts) for row, txts in anns.items()}
+
+        # Row index, then time in the format of `pd.Timedelta`, then each lead, then empty annotation columns
+        fmt_val = '%d' if np.issubdtype(self.rec.dtype, np.integer) else '%r'  # Floats in full precision
+        fmt = ','.join(['%d', '%d days %02d:%02d:%02d.%06d'] + [fmt_val] * len(idxs_lead)) + ',' * n_col_ann
+
+        yield ','.join([',time'] + [self.rec.lead_nms[idx] for idx in idxs_lead] + ['tag'] + [
+            f'comment_{self.rec.lead_nms[idx]}' for idx in idxs_lead
+        ]) + '\n'
+        for strt_ch, end_ch, vals in self._chunks(strt, end, idxs_lead, on_progress):
+            counts = np.arange(strt_ch, end_ch + 1)
+            secs, us = np.divmod(self.rec._counts_to_us(counts), 10 ** 6)
+            mins, secs = np.divmod(secs, 60)
+            hrs, mins = np.divmod(mins, 60)
+            days, hrs = np.divmod(hrs, 24)
+            # Formatting rows of Python ints is faster than `np.savetxt`
+            lines = [fmt % r for r in zip(*(c.tolist() for c in [counts - strt, days, hrs, mins, secs, us, *vals]))]
+            idx_strt, idx_end = np.searchsorted(rows_ann, [strt_ch, end_ch + 1])
+            for count in rows_ann[idx_strt:idx_end].tolist():
+                i = count - strt_ch
+                lines[i] = f'{lines[i][:-n_col_ann]},{anns[count - strt]}'
+            lines.append('')
+            yield '\n'.join(lines)
+
+    def _file_blocks(self, write):
+        """ Binary formats need a seekable file, written in full to a temporary file then streamed
+
+        :param write: Function writing the export given a binary file object
+        """
+        with tempfile.TemporaryFile() as f:
+            write(f)
+            f.seek(0)
+            for block in iter(lambda: f.read(self.SZ_BLOCK), b''):
+                yield block
+
+    def _write_hdf5(self, f, strt, end, idxs_lead, meta, on_progress):
+        with h5py.File(f, 'w') as f_h5:
+            dset = f_h5.create_dataset(
+                'ecg', shape=(len(idxs_lead), end - strt + 1), dtype=self.rec.dtype,
+                chunks=(len(idxs_lead), min(self.N_CHUNK, end - strt + 1)) if idxs_lead else None
+            )
+            for strt_ch, end_ch, vals in self._chunks(strt, end, idxs_lead, on_progress):
+                dset[:, strt_ch - strt:end_ch - strt + 1] = vals
+            for k, v in meta.items():
+                dset.attrs[k] = v
+
+    def _write_npz(self, f, strt, end, idxs_lead, meta, on_progress):
+        """ Samples are written to the `.npy` member in Fortran order, i.e. all leads of a sample at a time,
+        as chunks of consecutive samples are read """
+        with zipfile.ZipFile(f, 'w') as zf:
+            with zf.open('ecg.npy', 'w', force_zip64=True) as f_npy:
+                np.lib.format.write_array_header_1_0(f_npy, dict(
+                    descr=np.lib.format.dtype_to_descr(self.rec.dtype), fortran_order=True,
+                    shape=(len(idxs_lead), end - strt + 1)
+                ))
+                for _, _, vals in self._chunks(strt, end, idxs_lead, on_progress):
+                    f_npy.write(vals.astype(self.rec.dtype, copy=False).T.tobytes())
+            for k, v in meta.items():
+                with zf.open(f'{k}.npy', 'w') as f_npy:
+                    np.lib.format.write_array(f_npy, np.asarray(v))
+
+    def _write_parquet(self, f, strt, end, idxs_lead, meta, on_progress):
+        """ A row group per chunk, metadata on the schema """
+        lead_nms = meta['lead_nms']
+        typ = pa.from_numpy_dtype(self.rec.dtype)
+        schema = pa.schema(
+            [('time_us', pa.int64())] + [(nm, typ) for nm in lead_nms],
+            metadata={k: json.dumps(v) if not isinstance(v, str) else v for k, v in meta.items()}
+        )
+        with pq.ParquetWriter(f, schema) as writer:
+            for strt_ch, end_ch, vals in self._chunks(strt, end, idxs_lead, on_progress):
+                cols = [pa.array(self.rec._counts_to_us(np.arange(strt_ch, end_ch + 1)), pa.int64())]
+                cols += [pa.array(v.astype(self.rec.dtype, copy=False), typ) for v in vals]
+                writer.write_table(pa.Table.from_arrays(cols, schema=schema))
@@ -0,0 +1,140 @@
+import os
+import re
+import time
+import uuid
+import threading
+from itertools import count
+from collections import OrderedDict
+
+
+class EcgFigures:
+    """Partial updates to the lead plots on display, held on the server for each browser session, see `EcgSession`.
+
+    So that callbacks take in the `relayoutData` deltas only,
+    instead of the browser uploading every figure, with all its data, on each interaction.
+
+    The plots of a session are the layout children per `EcgApp.get_fig_layout`, in the order on display,
+    each holding the figure dictionary of its lead, modified in place.
+
+    Changes are sent to the browser as patches, paths into the figure and their new values,
+    merged into the figures by clientside callbacks, see `assets/client_side_callbacks.js`
+    """
+
+    N_SESSION = 64  # Maximum number of sessions tracked for renders in memory, least recently used are dropped beyond
+    # Seconds a range change waits for a newer one in the same session, e.g. during scroll-zoom, before rendering
+    DEBOUNCE = 0.04
+
+    # Paths into a figure for patches
+    K_FIG = ''  # The entire figure
+    K_X = 'data[0].x'
+    K_Y = 'data[0].y'
+    K_XRNG = 'layout.xaxis.range'
+    K_YRNG = 'layout.yaxis.range'
+    K_YFIX = 'layout.yaxis.fixedrange'
+    K_ANTN = 'layout.annotations'
+    K_SHP = 'layout.shapes'
+    KS_NAV = [K_X, K_Y, K_XRNG, K_YRNG, K_ANTN, K_SHP]  # On display range change
+    EXT_RNDR = '.rndr'
+
+    def __init__(self, path_dir=None):
+        """
+        :param path_dir: Directory renders are counted in, a file per session, so that a newer range
+            served by another worker process supersedes too, e.g. that of `EcgSessionsOnDisk`; in memory by default
+        """
+        self.path_dir = path_dir
+        self._lock = threading.Lock()
+        self._n_ptch = count()  # So that consecutive patches of same content still trigger
+        self._n_rndr = OrderedDict()  # Session ID => Sequence number of the latest render started
+
+    @staticmethod
+    def new_session_id():
+        return uuid.uuid4().hex
+
+    def begin_render(self, sid):
+        """
+        :return: Sequence number of the render, superseded once another render of the session begins
+        """
+        if self.path_dir is not None:
+            fd = os.open(self._get_path(sid), os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            try:
+                os.write(fd, b'.')  # Appends are atomic, so the offset after is unique to the render
+                return os.lseek(fd, 0, os.SEEK_CUR)
+            finally:
+                os.close(fd)
+        with self._lock:
+            n = self._n_rndr[sid] = self._n_rndr.get(sid, 0) + 1
+            self._n_rndr.move_to_end(sid)
+            while len(self._n_rndr) > self.N_SESSION:
+                self._n_rndr.popitem(last=False)
+            return n
+
+    def is_superseded(self, sid, n):
+        if self.path_dir is not None:
+            try:
+                return os.stat(self._get_path(sid)).st_size != n
+            except FileNotFoundError:  # Session expired
+                return True
+        return self._n_rndr.get(sid) != n
+
+    def _get_path(self, sid):
+        return self.path_dir.joinpath(f'{sid}{self.EXT_RNDR}')
+
+    def debounce(self, sid):
+        """ Coalesces a burst of range changes, so that only the last one of the session is rendered
+
+        Called before the callback takes the session, so that the changes of a burst wait concurrently
+
+        :return: Sequence number of the render, superseded if another render of the session began within `DEBOUNCE`
+        """
+        n = self.begin_render(sid)
+        time.sleep(self.DEBOUNCE)
+        return n
+
+    def get_figs_patch(self, figs, idxs_lead, keys):
+        """
+        :param figs: Figure dictionaries
+        :param idxs_lead: Lead index of each figure
+        :param keys: Paths into each figure that changed
+        :return: Patch of the figures, keyed by lead index
+        """
+        return dict(n=next(self._n_ptch), figs={idx: self.get_patch(f, keys) for idx, f in zip(idxs_lead, figs)})
+
+    def get_fig_patch(self, fig, keys):
+        return dict(n=next(self._n_ptch), fig=self.get_patch(fig, keys))
+
+    @staticmethod
+    def get_patch(fig, keys):
+        """
+        :return: Dictionary of path to value
+        """
+        def _get(k):
+            v = fig
+            for key in EcgFigures._parse_path(k):
+                v = v[key]
+            return v
+        return {k: _get(k) for k in keys}
+
+    @staticmethod
+    def _parse_path(k):
+        """ e.g. 'data[0].y' => ['data', 0, 'y'] """
+        return [int(t) if t.isdigit() else t for t in re.findall(r'[^.\[\]]+', k)]
+
+    @staticmethod
+    def apply_relayout(layout, relayout):
+        """ Brings a figure layout in sync with the browser, as plotly.js modifies its copy in place
+
+        :param layout: Layout of the figure held on the server
+        :param relayout: `relayoutData` of the graph, e.g. {'xaxis.range[0]': ..., 'shapes[2].x0': ...}
+        """
+        for k, v in relayout.items():
+            keys = EcgFigures._parse_path(k)
+            d = layout
+            for key, key_nxt in zip(keys[:-1], keys[1:]):
+                if isinstance(d, dict) and key not in d:
+                    d[key] = [] if isinstance(key_nxt, int) else dict()
+                if isinstance(d[key], tuple):  # e.g. Range as computed
+                    d[key] = list(d[key])
+                d = d[key]
+            if isinstance(d, list) and keys[-1] >= len(d):
+                d.extend([None] * (keys[-1] + 1 - len(d)))
+            d[keys[-1]] = v
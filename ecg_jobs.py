@@ -0,0 +1,148 @@
+import os
+import re
+import copy
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class EcgJobs:
+    """Runs exports in the background, to files kept as a cache of artifacts, see `EcgExport.export`.
+
+    A job is named by a digest of its record, leads, range, format and the comments in range,
+    so repeated exports of the same view are served from the file written before.
+    Progress & artifacts are files in a directory, `<key>.json` & `<key>.<format>`,
+    so that any worker process can poll a job or serve its artifact.
+
+    .. note:: Exports are at full resolution, i.e. step of 1 in `EcgRecord.get_ecg_samples`
+    """
+
+    N_WORKER = 2  # Number of exports run at a time, per process
+    SZ_MAX = 2 ** 32  # Total size in bytes of artifacts kept, least recently used are removed beyond
+    EXT_PROG = '.json'
+    TTL_PROG = 3600  # Seconds a progress file is kept without update, e.g. the error of a failed job
+    PATN_KEY = re.compile(r'[0-9a-f]{40}')
+
+    def __init__(self, path_dir=None):
+        """
+        :param path_dir: Directory of progress & artifact files, as `pathlib.Path`; a temporary one by default
+        """
+        self.path_dir = path_dir if path_dir is not None else tempfile.mkdtemp(prefix='ecg-export-')
+        os.makedirs(self.path_dir, exist_ok=True)
+        self.pool = ThreadPoolExecutor(max_workers=self.N_WORKER, thread_name_prefix='ecg-export')
+        self._keys_run = set()  # Keys of jobs running in this process
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def get_path(self, key, fmt):
+        return os.path.join(self.path_dir, f'{key}.{fmt}')
+
+    def _get_path_prog(self, key):
+        return os.path.join(self.path_dir, f'{key}{self.EXT_PROG}')
+
+    @staticmethod
+    def get_key(exp, strt, end, idxs_lead, fmt, step=1):
+        """
+        :param exp: `EcgExport` of the session
+        """
+        _, cmts = exp.cmts.get_comment_list(idxs_lead, strt, end, verbose=True)
+        st = os.stat(exp.rec.path)
+        return hashlib.sha1(json.dumps(
+            [str(exp.rec.path), st.st_size, st.st_mtime_ns, idxs_lead, strt, end, fmt, step, cmts]
+        ).encode()).hexdigest()
+
+    def submit(self, exp, strt, end, idxs_lead, fmt):
+        """ Starts the export unless its artifact is cached or it's running already
+
+        :return: Key of the job
+        """
+        key = self.get_key(exp, strt, end, idxs_lead, fmt)
+        path = self.get_path(key, fmt)
+        if os.path.exists(path):
+            os.utime(path)  # Recently used
+            return key
+        with self._lock:
+            if key in self._keys_run:
+                return key
+            self._keys_run.add(key)
+        self._write_progress(key, dict(progress=0))
+        # Tags & comments are taken now, as keyed; the copy keeps the record, as the session may move on meanwhile
+        write = copy.copy(exp).get_write(strt, end, idxs_lead, fmt, on_progress=self._get_on_progress(key))
+        self.pool.submit(self._run, key, fmt, write)
+        return key
+
+    def status(self, key, fmt):
+        """
+        :return: Dictionary of `done`, and `progress` in [0, 1] or `error` while not done
+        """
+        if os.path.exists(self.get_path(key, fmt)):
+            return dict(done=True)
+        try:
+            with open(self._get_path_prog(key), 'r') as f:
+                return dict(done=False, **json.load(f))
+        except (OSError, ValueError):  # Not started, or read as it's written
+            return dict(done=False, progress=0)
+
+    def _write_progress(self, key, d):
+        with open(self._get_path_prog(key), 'w') as f:
+            json.dump(d, f)
+
+    def _get_on_progress(self, key):
+        pct_last = [0]
+
+        def _on_progress(p):
+            if int(p * 100) != pct_last[0]:  # Written once per percent
+                pct_last[0] = int(p * 100)
+                self._write_progress(key, dict(progress=p))
+        return _on_progress
+
+    def _run(self, key, fmt, write):
+        path = self.get_path(key, fmt)
+        f = tempfile.NamedTemporaryFile(dir=self.path_dir, suffix='.tmp', delete=False)
+        try:
+            with f:
+                write(f)
+            os.replace(f.name, path)  # Whole artifacts only, for other processes too
+        except Exception as e:
+            if os.path.exists(f.name):
+                os.remove(f.name)
+            self._write_progress(key, dict(error=f'{type(e).__name__}: {e}'))
+        else:
+            try:
+                os.remove(self._get_path_prog(key))
+            except FileNotFoundError:  # Removed by another process running the same job
+                pass
+        finally:
+            with self._lock:
+                self._keys_run.discard(key)
+        self._evict()
+
+    def _evict(self):
+        """ Removes the least recently used artifacts beyond `SZ_MAX`, and progress files not updated for `TTL_PROG` """
+        t = time.time()
+        fls = []
+        for e in os.scandir(self.path_dir):
+            if not e.is_file() or e.name.endswith('.tmp'):
+                continue
+            if not e.name.endswith(self.EXT_PROG):
+                fls.append(e)
+            elif t - e.stat().st_mtime > self.TTL_PROG:  # Failed, or its process is gone
+                try:
+                    os.remove(e.path)
+                except OSError:
+                    pass
+        fls.sort(key=lambda e: e.stat().st_mtime)
+        sz = sum(e.stat().st_size for e in fls)
+        for e in fls:
+            if sz <= self.SZ_MAX:
+                break
+            sz -= e.stat().st_size
+            try:
+                os.remove(e.path)
+            except OSError:  # Removed by another process
+                pass
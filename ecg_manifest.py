@@ -0,0 +1,71 @@
+import os
+import json
+import threading
+
+import numpy as np
+
+
+class EcgManifest:
+    """Index of an ABLDB record, cached next to it as `<record>_manifest.npz`.
+
+    Holds the segment keys & lengths, cumulative offsets, lead names, sample rate and parsed tags,
+    so that reopening a record doesn't walk every segment or parse the annotation JSON.
+
+    Keyed by the record's path, size and modification time, rebuilt if any of them changes.
+    """
+
+    POSTFIX = 'manifest'
+
+    @staticmethod
+    def get_path(path_rec):
+        return path_rec.with_name(f'{path_rec.stem}_{EcgManifest.POSTFIX}.npz')
+
+    @staticmethod
+    def get(path_rec, record):
+        """
+        :param path_rec: Path to the record
+        :param record: The opened record, `h5py.File` or `EcgStore`, only read if the manifest is rebuilt
+        :return: Dictionary of numpy arrays
+        """
+        path = EcgManifest.get_path(path_rec)
+        stat = os.stat(path_rec)
+        key = [str(path_rec.resolve()), stat.st_size, stat.st_mtime_ns]
+        if os.path.exists(path):
+            try:
+                with np.load(path) as f:
+                    if f['key'].tolist() == [str(v) for v in key]:
+                        return dict(f)
+            except Exception:  # e.g. Truncated by a crash in a previous version, rebuilt
+                pass
+        mnf = EcgManifest.build(record)
+        mnf['key'] = np.array(key, dtype=str)
+        path_tmp = path.with_name(f'{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp.npz')
+        try:
+            np.savez(path_tmp, **mnf)
+            os.replace(path_tmp, path)  # Atomic, readers see either the previous or the whole manifest
+        except OSError:  # e.g. Read-only data folder, the manifest is still used for this session
+            if path_tmp.exists():
+                os.remove(path_tmp)
+        return mnf
+
+    @staticmethod
+    def build(record):
+        keys = list(record.keys())  # keys to each segment compiled in the record
+        counts = np.array([record[k].shape[1] for k in keys], dtype=np.int64)
+        # Following properties are the same across different segments, as far as EcgApp is concerned.
+        metadata = json.loads(record[keys[0]].attrs['metadata'])
+
+        annotations = json.loads(record.attrs['annotations'])
+        strt_ms = annotations[0]['time_ms']
+        anns = annotations[2:]  # Skip the first 2 rows, header and protocol respectively
+        return dict(
+            seg_keys=np.array(keys, dtype=str),
+            sample_counts=counts,
+            sample_counts_acc=np.cumsum(counts),
+            spl_rate=np.array(metadata['sample_rate']),
+            lead_nms=np.array([lead['name'] for lead in metadata['sigheader']], dtype=str),
+            is_negative=np.array([lead['isNegative'] for lead in metadata['sigheader']], dtype=bool),
+            tag_types=np.array([ann['type'] for ann in anns], dtype=str),
+            tag_tms=np.array([ann['time_ms'] - strt_ms for ann in anns], dtype=np.int64),
+            tag_txts=np.array([ann['data']['text'] if 'text' in ann['data'] else '' for ann in anns], dtype=str)
+        )
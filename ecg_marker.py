@@ -142,7 +142,7 @@ class EcgMarker:
         idxs_r = self.r_peak_indices(idx_ld_r, ecg_vals)
         ic(idxs_r.shape)
         fl_nm = f'{self.rec.nm}_{postfix}.hdf5'
-        path = f'data/{fl_nm}'
+        path = CURR.joinpath(fl_nm)  # Where `EcgApp` looks for it
         ic(path)
         open(path, 'a').close()  # Create file in OS
         fl = h5py.File(path, 'w')
@@ -155,5 +155,7 @@ class EcgMarker:
         fl.close()
 
     @staticmethod
-    def example(record=EcgRecord(DATA_PATH.joinpath(record_nm), CURR.joinpath(record_p_nm))):
+    def example(record=None):
+        if record is None:  # Not as a default argument, which would open the record on import
+            record = EcgRecord(DATA_PATH.joinpath(record_nm), CURR.joinpath(record_p_nm))
         return EcgMarker(record)
@@ -0,0 +1,130 @@
+import io
+import csv
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+import flask
+
+
+class EcgMetrics:
+    """Opt-in timing of each Dash callback request, broken into phases, with request & response sizes.
+
+    A measurement starts and ends with the Flask request, phases are timed by `phase` blocks
+    in the code path, e.g. `EcgRecord` reads, attributed to the measurement of the thread serving the request.
+    Blocks run outside of a measured request, e.g. prefetch, and blocks nested in a block of the same phase,
+    are not counted.
+
+    The last `N_MEASURE` measurements are kept, served as a summary on `/metrics` and as CSV on `/metrics.csv`
+    """
+
+    N_MEASURE = 4096  # Size of the ring buffer
+    PHASES = [
+        'read',  # Record & pyramid reads
+        'decim',  # Decimation into points on display
+        'time_axis',  # x values
+        'y_range',  # Automatic y axis ranges
+        'annotation',  # Tags & caliper measurements
+        'debounce',  # Waiting for a newer display range change, see `EcgFigures.debounce`
+        'session',  # Waiting on the session lock, loading & saving the session, see `EcgSessions.use`
+        'serialization'  # Encoding y values & the response, after the callback returns
+    ]
+    COLS = ['t', 'output', 'trigger', 'status', 'ms_total', 'ms_callback'] + \
+        [f'ms_{p}' for p in PHASES] + ['sz_request', 'sz_response']
+    PATH_CB = '/_dash-update-component'
+
+    _local = threading.local()  # The measurement of the request a thread serves
+
+    def __init__(self, server):
+        """
+        :param server: Flask server of the Dash app
+        """
+        self.measures = deque(maxlen=self.N_MEASURE)
+        server.before_request(self._before)
+        server.after_request(self._after)
+        server.add_url_rule('/metrics', 'metrics', self.get_summary)
+        server.add_url_rule('/metrics.csv', 'metrics_csv', self.get_csv)
+
+    @staticmethod
+    @contextmanager
+    def phase(nm):
+        m = getattr(EcgMetrics._local, 'measure', None)
+        if m is None or nm in m['active']:
+            yield
+            return
+        m['active'].add(nm)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            m[f'ms_{nm}'] += (time.perf_counter() - t) * 1e3
+            m['active'].discard(nm)
+
+    @staticmethod
+    @contextmanager
+    def callback():
+        """ Marks the duration of the callback, session taken included, the rest of the request is serialization """
+        m = getattr(EcgMetrics._local, 'measure', None)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            if m is not None:
+                m['ms_callback'] = (time.perf_counter() - t) * 1e3
+
+    def _before(self):
+        req = flask.request
+        if req.path != self.PATH_CB:
+            return
+        body = req.get_json(silent=True) or dict()
+        m = dict.fromkeys(self.COLS, 0.0)
+        m.update(
+            t=time.time(), output=body.get('output', ''), trigger=','.join(body.get('changedPropIds', [])),
+            sz_request=req.content_length or 0, active=set(), t_strt=time.perf_counter()
+        )
+        EcgMetrics._local.measure = m
+
+    def _after(self, response):
+        m = getattr(EcgMetrics._local, 'measure', None)
+        if m is None:
+            return response
+        EcgMetrics._local.measure = None
+        m['ms_total'] = (time.perf_counter() - m.pop('t_strt')) * 1e3
+        if m['ms_callback'] > 0:
+            m['ms_serialization'] += m['ms_total'] - m['ms_callback']
+        m['status'] = response.status_code
+        m['sz_response'] = 0 if response.is_streamed else len(response.get_data())
+        del m['active']
+        self.measures.append(m)
+        return response
+
+    def get_summary(self):
+        """
+        :return: JSON response, for each callback output, the number of requests,
+        percentiles of total time, mean time of each phase and mean sizes
+        """
+        by_output = dict()
+        for m in list(self.measures):
+            by_output.setdefault(m['output'], []).append(m)
+        res = dict()
+        for output, ms in by_output.items():
+            tot = np.array([m['ms_total'] for m in ms])
+            res[output] = dict(
+                n=len(ms),
+                **{f'ms_total_p{q}': float(np.percentile(tot, q)) for q in [50, 95, 99]},
+                **{k: float(np.mean([m[k] for m in ms])) for k in self.COLS[5:]}
+            )
+        return flask.jsonify(res)
+
+    def dump_csv(self, f):
+        """ Writes the measurements kept into a text file object """
+        w = csv.DictWriter(f, fieldnames=self.COLS)
+        w.writeheader()
+        w.writerows(list(self.measures))
+
+    def get_csv(self):
+        f = io.StringIO()
+        self.dump_csv(f)
+        return flask.Response(f.getvalue(), mimetype='text/csv')
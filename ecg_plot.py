@@ -1,11 +1,16 @@
+import base64
+import threading
+
 import numpy as np
 import pandas as pd
 
-import concurrent.futures
 # from typing import Dict
 from enum import Enum
 
 from ecg_defns_n_util import *
+from ecg_prefetch import EcgPrefetch
+from ecg_sidecar import EcgSidecar
+from ecg_metrics import EcgMetrics
 
 
 class EcgPlot:
@@ -23,29 +28,147 @@ class EcgPlot:
     _DISPLAY_SCALE_T = 30  # #continuous time stamps to display in 1rem
     _DISPLAY_SCALE_ECG = 20  # magnitude of ecg in a 1rem
     SP_RT_READABLE = 250  # Sufficient frequency (Hz) for human differentiable graphing
+    # x values as milliseconds since epoch, shown as time by the date axis, instead of pandas time stamps
+    TM_MS = True
+    # 'stride' keeps every `sample_factor`-th sample,
+    # 'm4' keeps the first, minimum, maximum and last sample in each pixel column, so that peaks are never dropped
+    DECIM = 'm4'
+    # y values as base64 little-endian int16 or float32 buffers, decoded into typed arrays by `assets/typed_array.js`
+    BDATA = True
+    PREFETCH = True  # Read ahead the display ranges a nudge or advance away, see `EcgPrefetch`
+    N_COL = _DISPLAY_WIDTH * 16  # #pixel columns for 'm4' given 16px in 1rem, at most 4 points per column per lead
 
     def __init__(self, record, parent):
         self.rec = record
         self.parn = parent
         self.min_sample_step = self.rec.spl_rate // self.SP_RT_READABLE
+        self.prefetch = EcgPrefetch(self) if self.PREFETCH else None
+        self._tmb_y_vals = dict()  # Lead index => Encoded thumbnail y values, shared by all sessions on the record
+        self._lock_tmb = threading.Lock()
+
+    def __reduce__(self):
+        from ecg_session import EcgRecords  # Deferred, for `ecg_session` imports this module
+        return EcgRecords.get_plot, (self.rec.path, self.rec.path_p)
+
+    def close(self):
+        if self.prefetch is not None:
+            self.prefetch.close()
 
     def get_xy_vals(self, idx_lead, strt, end):
         """
         :return: plotly line plot's x, y data points, based on current display range
+        """
+        return self.get_xy_block([idx_lead], strt, end)[0]
 
+    def get_xy_block(self, idxs_lead, strt, end, use_prefetch=True):
+        """ Plotly line plot's data points of multiple leads at once, decimated per `DECIM`
+
+        .. note:: The sample factor keeps the number of points within the display width,
+        so the record answers from the coarsest pyramid level that meets it, see `EcgPyramid`
         .. seealso:: `ecg_record.get_samples`
+
+        :param idxs_lead: List of lead indices, in any order
+        :param use_prefetch: If true, served from the values read ahead if available
+        :return: List of (x, y) 2-tuples, in the order of `idxs_lead`
         """
-        # Always take data as samples instead of entire channel, sample at at least increments of min_sample_step
-        sample_factor = self.get_sample_factor(strt, end)
-        return self.rec.get_time_values(strt, end, sample_factor), \
-            self.rec.get_ecg_samples(idx_lead, strt, end, sample_factor)
+        if not idxs_lead:
+            return []
+        if use_prefetch and self.prefetch is not None:
+            xy_vals = self.prefetch.get(idxs_lead, strt, end)
+            if xy_vals is not None:
+                return xy_vals
+        if self.DECIM == 'm4':
+            w = -(-(end - strt + 1) // self.N_COL)  # #samples in a column
+            counts, vals = self.rec.get_ecg_envelope(idxs_lead, strt, end, max(w // 2, 1))
+            with EcgMetrics.phase('decim'):
+                kept = self.decimate_m4(counts, vals, strt, w)
+            with EcgMetrics.phase('time_axis'):
+                return [(self.counts_to_time_values(c), v) for c, v in kept]
+        else:
+            # Always take data as samples instead of entire channel, sample at at least increments of min_sample_step
+            sample_factor = self.get_sample_factor(strt, end)
+            with EcgMetrics.phase('time_axis'):
+                x_vals = self.get_time_values(strt, end, sample_factor)
+            # Extremes of each `sample_factor` samples if the pyramid is built, so that peaks are kept
+            vals = self.rec.get_ecg_block(idxs_lead, strt, end, sample_factor, agg='extreme')
+            return [(x_vals, y_vals) for y_vals in vals]
+
+    @staticmethod
+    def decimate_m4(counts, vals, strt, w):
+        """ Keeps the first, minimum, maximum and last value within each column of `w` samples, vectorized across leads
+
+        Extremes are kept exactly, at most 4 values per column
+
+        :param counts: Non-decreasing sample counts, 1D array shared across leads, or 2D array per lead
+        :param vals: 2D array of ecg values, #leads * #counts
+        :param strt: Sample count at the start of the first column
+        :param w: Number of samples in a column
+        :return: List of 2-tuples of sample counts and ecg values kept, for each lead
+        """
+        n_lead, n = vals.shape
+        counts = np.broadcast_to(counts, vals.shape)
+        col = (counts - strt) // w
+        # Columns of all leads flattened, increasing since each lead is in order
+        col = (col + np.arange(n_lead)[:, np.newaxis] * (int(col.max(initial=0)) + 1)).ravel()
+        counts, vals = counts.ravel(), vals.ravel()
+        n_all = counts.size
+        bnd = np.flatnonzero(np.diff(col, prepend=-1))  # Start index of each non-empty column
+        lens = np.diff(bnd, append=n_all)
+        idxs = np.arange(n_all)
+
+        def _idx_first_of(ext):
+            """ Index of the first occurrence of the extreme value in each column """
+            is_ext = vals == np.repeat(ext, lens)
+            return np.minimum.reduceat(np.where(is_ext, idxs, n_all), bnd)
+
+        keep = np.stack([
+            bnd,
+            _idx_first_of(np.minimum.reduceat(vals, bnd)),
+            _idx_first_of(np.maximum.reduceat(vals, bnd)),
+            bnd + lens - 1
+        ], axis=-1)
+        keep = np.sort(keep, axis=-1).ravel()  # Columns are disjoint, so increasing overall
+        keep = keep[np.diff(keep, prepend=-1) != 0]
+        return [(counts[k], vals[k]) for k in np.split(keep, np.searchsorted(keep, np.arange(1, n_lead) * n))]
+
+    def get_time_values(self, strt, end, step):
+        if self.TM_MS:
+            return self.rec.get_time_values_ms(strt, end, step)
+        else:
+            return self.rec.get_time_values(strt, end, step)
+
+    def encode_y(self, y_vals):
+        """ The y values of a plotly trace, per `BDATA` """
+        with EcgMetrics.phase('serialization'):
+            return self.to_typed_array(y_vals) if self.BDATA else y_vals
+
+    @staticmethod
+    def to_typed_array(vals):
+        """ Plotly's typed array specification, of int16 if the values fit, float32 otherwise
+
+        :return: Dictionary of data type code and base64 encoded bytes
+        """
+        vals = np.asarray(vals)
+        i2 = np.iinfo(np.int16)
+        if np.issubdtype(vals.dtype, np.integer) and (vals.size == 0 or i2.min <= vals.min() and vals.max() <= i2.max):
+            dtype = 'i2'
+        else:
+            dtype = 'f4'
+        return dict(dtype=dtype, bdata=base64.b64encode(vals.astype(f'<{dtype}', copy=False).tobytes()).decode('ascii'))
+
+    def counts_to_time_values(self, counts):
+        """ Time stamps of arbitrary sample counts, per `TM_MS` """
+        if self.TM_MS:
+            return self.rec._counts_to_ms(counts)
+        else:
+            return pd.to_datetime(pd.Series(self.rec._counts_to_us(counts)), unit='us')
 
     def get_fig(self, idx_lead, strt, end, annotations=None, shapes=None, yaxis_fixed=False):
         time_vals, ecg_vals = self.get_xy_vals(idx_lead, strt, end)
         return dict(
             data=[dict(
                 x=time_vals,
-                y=ecg_vals,
+                y=self.encode_y(ecg_vals),
                 mode='lines',
                 line=dict(
                     color=CLR_PLT,
@@ -64,7 +187,8 @@ class EcgPlot:
                 hoverdistance=0,
                 hoverinfo=None,
                 xaxis=dict(
-                    range=[time_vals[0], time_vals.iat[-1]],
+                    type='date',
+                    range=self.display_range_to_layout_range([strt, end]),
                 ),
                 yaxis=dict(
                     range=self.parn.ui.get_ignore_noise_range(ecg_vals),
@@ -77,6 +201,39 @@ class EcgPlot:
             )
         )
 
+    def get_thumbnail_y_vals(self, idxs_lead, strt, end, step):
+        """ Thumbnail y values with noise stripped, per `encode_y`, computed once by the process for each lead
+
+        If the record is `SHARED`, read from a memory-mapped sidecar with all leads, built once across processes
+
+        :return: List of encoded values, in the order of `idxs_lead`
+        """
+        with self._lock_tmb:
+            idxs = [idx for idx in idxs_lead if idx not in self._tmb_y_vals]
+            if idxs:
+                if self.rec.SHARED and self.rec.is_store:  # Not for the .h5 file read while the store is prepared
+                    path = self.rec.path.with_name(f'{self.rec.path.stem}_thumbnail.npy')
+                    key = EcgSidecar.get_key(self.rec.path, strt=strt, end=end, step=step)
+                    EcgSidecar.get(path, key, lambda p: self._build_thumbnail(p, strt, end, step))
+                    y_vals = np.load(path, mmap_mode='r')[idxs]
+                else:
+                    vals = self.rec.get_ecg_block(idxs, strt, end, step, agg='extreme')
+                    y_vals = [self._strip_noise(v) for v in vals]
+                for idx, v in zip(idxs, y_vals):
+                    self._tmb_y_vals[idx] = self.encode_y(v)
+            return [self._tmb_y_vals[idx] for idx in idxs_lead]
+
+    def _build_thumbnail(self, path, strt, end, step):
+        vals = self.rec.get_ecg_block(list(range(self.rec.n_lead)), strt, end, step, agg='extreme')
+        arr = np.lib.format.open_memmap(path, mode='w+', dtype=vals.dtype, shape=vals.shape)
+        for idx, v in enumerate(vals):
+            arr[idx] = self._strip_noise(v)
+        arr.flush()
+
+    def _strip_noise(self, vals):
+        rang = self.parn.ui.get_ignore_noise_range(vals, z=3)
+        return self.parn.ui.strip_noise(vals, rang[0], rang[1]).astype(vals.dtype, copy=False)
+
     class Thumbnail:
         """ Encapsulates the plotly figure dummy used for global thumbnail preview
 
@@ -94,15 +251,15 @@ class EcgPlot:
             self.end = self.rec.COUNT_END
             self.sample_factor = self.parn.get_sample_factor(self.strt, self.end)
 
-            self.x_vals = self.rec.get_time_values(self.strt, self.end, self.sample_factor)
+            self.x_vals = self.parn.get_time_values(self.strt, self.end, self.sample_factor)
             self.fig = self._get_fig_skeleton()
             self.idxs_lead = []
-            # Has the corresponding y_vals been computed before
-            self.been_computed = [False for i in range(self.num_leads)]
-            self.lst_y_vals = [[] for i in range(self.num_leads)]
 
         def _get_fig_skeleton(self):
-            tag_times = np.vectorize(lambda t: pd.to_datetime(t, unit='ms'))([0] + self.rec.tags_tm)
+            if self.parn.TM_MS:  # Tag times are already in milliseconds
+                tag_times = np.array([0] + self.rec.tags_tm)
+            else:
+                tag_times = np.vectorize(lambda t: pd.to_datetime(t, unit='ms'))([0] + self.rec.tags_tm)
             tag_y = np.full(tag_times.size, self.Y_TAG)
             tag_y[0] = 0  # Prepended dummy variable that's needed to push up the tags
             fig = dict(
@@ -123,6 +280,7 @@ class EcgPlot:
                 layout=dict(
                     margin=dict(l=0, r=0, t=0, b=0),
                     xaxis=dict(
+                        type='date',
                         rangeslider=dict(
                             visible=True,
                             bgcolor=DEFAULT_BG,
@@ -142,44 +300,20 @@ class EcgPlot:
         def _get_yaxis_code(i):
             return f'y{i}' if i > 0 else 'y'
 
-        def _get_y_vals(self, idx_lead):
-            return self.rec.get_ecg_samples(idx_lead, self.strt, self.end, self.sample_factor)
-
         def add_trace(self, idxs_lead_add, override=False):
-            """
-            ..note:: Modifies argument list passed in
-            """
             if override:
                 for idx in self.idxs_lead:
                     if idx not in idxs_lead_add:
                         self._remove_trace(idx)
                 self.idxs_lead = []
 
-            idx = 0
-            while idx < len(idxs_lead_add):
-                idx_lead = idxs_lead_add[idx]
-                if self.been_computed[idx_lead]:
-                    del idxs_lead_add[idx]
-                    if idx_lead not in self.idxs_lead:
-                        self.fig['data'][idx_lead]['x'] = self.x_vals
-                        self.fig['data'][idx_lead]['y'] = self.lst_y_vals[idx_lead]
-                        self.idxs_lead.append(idx_lead)
-                else:
-                    idx += 1
-            # Only compute lead channels not computed before
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.parn.parn.MAX_NUM_LD) as executor:
-                res_y_vals = executor.map(self._get_y_vals, idxs_lead_add)
-                res_y_vals = list(res_y_vals)
-            # By construction, must be mutually exclusive with `idxs_lead` if override is False
-            for idx, idx_lead in enumerate(idxs_lead_add):
+            idxs_lead_add = [idx for idx in idxs_lead_add if idx not in self.idxs_lead]
+            # Only lead channels not computed before by any session are read, in a single read
+            y_vals = self.parn.get_thumbnail_y_vals(idxs_lead_add, self.strt, self.end, self.sample_factor)
+            for idx_lead, v in zip(idxs_lead_add, y_vals):
                 self.idxs_lead.append(idx_lead)
-                y_vals = res_y_vals[idx]
-                # rang = self.parn.parn.ui.get_ignore_noise_range(y_vals)
-                rang = self.parn.parn.ui.get_ignore_noise_range(y_vals, z=3)
-                y_vals = self.parn.parn.ui.strip_noise(y_vals, rang[0], rang[1])
                 self.fig['data'][idx_lead]['x'] = self.x_vals
-                self.fig['data'][idx_lead]['y'] = self.lst_y_vals[idx_lead] = y_vals
-                self.been_computed[idx_lead] = True
+                self.fig['data'][idx_lead]['y'] = v
 
             self.fig['layout']['xaxis']['range'] = \
                 self.parn.display_range_to_layout_range(self.parn.parn.disp_rng[0])
@@ -0,0 +1,104 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class EcgPrefetch:
+    """Reads ahead the plot data of display ranges next to the current one, in the background, for `EcgPlot`.
+
+    Nudge and advance move the display range by fixed offsets,
+    so after each render the ranges at those offsets are loaded for all leads on display, into a bounded cache.
+
+    The plot is shared by all sessions on the record, so schedules & caches are kept per session:
+    each schedule supersedes the previous one of the same session only, windows not yet loaded are dropped,
+    and a session evicts its own entries only. Lookups are served from the entries of any session.
+    """
+
+    N_MAX = 128  # Maximum number of (lead, range) entries kept per session, least recently used are evicted beyond
+    N_SESSION = 16  # Maximum number of sessions tracked, least recently scheduled are dropped beyond
+
+    def __init__(self, plot):
+        """
+        :param plot: The `EcgPlot` to load data for
+        """
+        self.plt = plot
+        self.n_hit = 0
+        self.n_miss = 0
+        self._sessions = OrderedDict()  # Session ID => `_EcgPrefetchSession`
+        self._lock = threading.Lock()  # Guards all state, across sessions
+        # A single thread, `h5py` reads are serialized regardless, and foreground reads come first
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ecg-prefetch')
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            n_entry = sum(len(s.vals) for s in self._sessions.values())
+            return dict(n_hit=self.n_hit, n_miss=self.n_miss, n_entry=n_entry, n_session=len(self._sessions))
+
+    def get(self, idxs_lead, strt, end):
+        """
+        :return: List of (x, y) 2-tuples per `EcgPlot.get_xy_block`, None unless loaded for all leads
+        """
+        keys = [(idx, strt, end) for idx in idxs_lead]
+        with self._lock:
+            ret = []
+            for k in keys:
+                sess = next((s for s in self._sessions.values() if k in s.vals), None)
+                if sess is None:
+                    self.n_miss += 1
+                    return None
+                sess.vals.move_to_end(k)
+                ret.append(sess.vals[k])
+            self.n_hit += 1
+            return ret
+
+    def schedule(self, sid, idxs_lead, rngs):
+        """ Starts loading the ranges in the background, in the order given
+
+        :param sid: ID of the session, see `EcgSession`
+        :param idxs_lead: Leads on display
+        :param rngs: List of [start, end] sample count ranges
+        """
+        req = (tuple(idxs_lead), tuple(tuple(r) for r in rngs))
+        with self._lock:
+            if sid not in self._sessions:
+                self._sessions[sid] = _EcgPrefetchSession()
+                while len(self._sessions) > self.N_SESSION:
+                    for f in self._sessions.popitem(last=False)[1].futures:
+                        f.cancel()
+            self._sessions.move_to_end(sid)
+            sess = self._sessions[sid]
+            if req == sess.req_last:  # e.g. Caliper edits
+                return
+            sess.req_last = req
+            sess.gen += 1
+            for f in sess.futures:
+                f.cancel()
+            sess.futures = [
+                self.pool.submit(self._load, sess, sess.gen, list(idxs_lead), strt, end) for strt, end in rngs
+            ]
+
+    def _load(self, sess, gen, idxs_lead, strt, end):
+        with self._lock:
+            if gen != sess.gen:  # The user has moved on
+                return
+            idxs = [idx for idx in idxs_lead if (idx, strt, end) not in sess.vals]
+        if idxs:
+            xy_vals = self.plt.get_xy_block(idxs, strt, end, use_prefetch=False)
+            with self._lock:
+                for idx, xy in zip(idxs, xy_vals):
+                    sess.vals[idx, strt, end] = xy
+                while len(sess.vals) > self.N_MAX:
+                    sess.vals.popitem(last=False)
+
+
+class _EcgPrefetchSession:
+    """ Read-ahead state of a single session, guarded by the lock of `EcgPrefetch` """
+
+    def __init__(self):
+        self.vals = OrderedDict()  # (lead index, start, end) => (x, y)
+        self.gen = 0  # Incremented on each schedule, tasks of previous schedules stop on mismatch
+        self.futures = []
+        self.req_last = None
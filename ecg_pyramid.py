@@ -0,0 +1,280 @@
+import os
+import json
+
+import h5py
+import numpy as np
+
+from ecg_sidecar import EcgSidecar
+
+
+class EcgPyramid:
+    """Multi-resolution summary of an `EcgRecord`, stored in a sidecar .hdf5 file next to the record.
+
+    Level `k` groups every 2^k consecutive samples of each lead into a bucket,
+    bucket `j` covers sample counts [j * 2^k, (j+1) * 2^k).
+    The minimum, maximum and mean of each bucket are kept, for all leads, so that a zoomed-out view
+    is answered by reading a few buckets, instead of a strided scan over all segments which drops peaks.
+    The offsets of the minimum & maximum within the bucket are kept too, so that extremes are placed exactly.
+
+    Each level is stored as a group named by `k`, with `min`, `max`, `mean`, `idx_min` and `idx_max` datasets
+    of shape #leads * #buckets
+
+    Optionally copied into a directory of memory-mapped arrays, shared by worker processes, see `Mmap`
+    """
+
+    LVL_MIN = 3  # Finest level stored, buckets of 8 samples, matches `EcgPlot.min_sample_step` at 2000Hz
+    N_BKT_MIN = 256  # Stop adding coarser levels once the number of buckets falls below
+    SZ_CHUNK = 2 ** 18  # Number of samples or buckets processed at a time on build, even so that bucket pairs align
+    POSTFIX = 'pyramid'
+    NMS = ['min', 'max', 'mean', 'idx_min', 'idx_max']
+    VERSION = 2  # Format of the sidecar, sidecars of other versions are rebuilt
+
+    def __init__(self, path, cache=None, key=None):
+        """
+        :param path: Path to the sidecar file, or the directory per `Mmap`
+        :param cache: Optional `EcgCache` for bucket reads
+        :param key: Key of the record in `cache`
+        """
+        self.file = EcgPyramid.Mmap(path) if path.is_dir() else h5py.File(path, 'r')
+        self.cache = cache
+        self.key = key
+        self.lvls = [int(k) for k in self.file.attrs['levels']]
+        self.step_min = 1 << self.lvls[0]
+
+    @staticmethod
+    def get_path(path_rec):
+        """ The sidecar file lies in the same folder as the record """
+        return path_rec.with_name(f'{path_rec.stem}_{EcgPyramid.POSTFIX}.hdf5')
+
+    class Mmap:
+        """ Mirrors the subset of `h5py.File` used, on a directory of `<level>_<name>.npy` arrays, memory-mapped """
+
+        def __init__(self, path):
+            with open(path.joinpath('levels.json'), 'r') as f:
+                lvls = json.load(f)
+            self.attrs = dict(levels=lvls)
+            self._grps = {
+                str(k): {nm: np.load(path.joinpath(f'{k}_{nm}.npy'), mmap_mode='r') for nm in EcgPyramid.NMS}
+                for k in lvls
+            }
+
+        def __getitem__(self, key):
+            return self._grps[key]
+
+    @staticmethod
+    def _is_valid(path, stat):
+        if not os.path.exists(path):
+            return False
+        with h5py.File(path, 'r') as f:
+            return f.attrs.get('version') == EcgPyramid.VERSION and \
+                f.attrs.get('src_size') == stat.st_size and f.attrs.get('src_mtime') == stat.st_mtime_ns
+
+    @staticmethod
+    def is_built(path_rec, mmap=False):
+        """ Whether the sidecar, and its memory-mapped copy if `mmap`, are up to date with the record """
+        path = EcgPyramid.get_path(path_rec)
+        return EcgPyramid._is_valid(path, os.stat(path_rec)) and (
+            not mmap or EcgSidecar.is_valid(path.with_suffix(''), EcgSidecar.get_key(path))
+        )
+
+    @staticmethod
+    def get(rec, path_rec, mmap=False, build=True):
+        """ Opens the sidecar of the record, (re)builds it first if missing or outdated
+
+        :param mmap: If true, opens the memory-mapped copy, made once from the sidecar, see `Mmap`
+        :param build: If false, the sidecar is only opened if up to date
+        :return: The pyramid, or None if the sidecar can't be written or isn't built
+        """
+        path = EcgPyramid.get_path(path_rec)
+        stat = os.stat(path_rec)
+        if not build and not EcgPyramid.is_built(path_rec, mmap):
+            return None
+        try:
+            if not EcgPyramid._is_valid(path, stat):
+                with EcgSidecar.lock(path):
+                    if not EcgPyramid._is_valid(path, stat):  # Not built by another process meanwhile
+                        path_tmp = path.with_name(f'{path.stem}.{os.getpid()}.tmp')
+                        EcgPyramid.build(rec, path_tmp, stat)
+                        os.replace(path_tmp, path)
+            if mmap:
+                path_mm = EcgSidecar.get(
+                    path.with_suffix(''), EcgSidecar.get_key(path), lambda p: EcgPyramid.to_mmap(path, p)
+                )
+                return EcgPyramid(path_mm)  # Pages are shared through the OS page cache already
+        except OSError:  # e.g. Read-only data folder
+            return None
+        return EcgPyramid(path, rec.cache, rec.key_cache)
+
+    @staticmethod
+    def to_mmap(path, path_dir):
+        """ Copies each dataset of the sidecar into a `.npy` array, per `Mmap` """
+        os.makedirs(path_dir)
+        with h5py.File(path, 'r') as f:
+            lvls = [int(k) for k in f.attrs['levels']]
+            for k in lvls:
+                for nm in EcgPyramid.NMS:
+                    dset = f[str(k)][nm]
+                    arr = np.lib.format.open_memmap(
+                        path_dir.joinpath(f'{k}_{nm}.npy'), mode='w+', dtype=dset.dtype, shape=dset.shape
+                    )
+                    for strt in range(0, dset.shape[1], EcgPyramid.SZ_CHUNK):
+                        arr[:, strt:strt + EcgPyramid.SZ_CHUNK] = dset[:, strt:strt + EcgPyramid.SZ_CHUNK]
+                    arr.flush()
+                    del arr
+        with open(path_dir.joinpath('levels.json'), 'w') as f:
+            json.dump(lvls, f)
+
+    @staticmethod
+    def build(rec, path, stat):
+        """ Writes the pyramid of all leads in `rec`, a single sequential pass over the record
+
+        Coarser levels are reduced from the previous level, read back in chunks
+        """
+        n = rec.COUNT_END + 1
+        lvls = [EcgPyramid.LVL_MIN]
+        while (n >> lvls[-1]) >= 2 * EcgPyramid.N_BKT_MIN:
+            lvls.append(lvls[-1] + 1)
+        with h5py.File(path, 'w') as f:
+            f.attrs['levels'] = lvls
+            f.attrs['version'] = EcgPyramid.VERSION
+            f.attrs['src_size'] = stat.st_size
+            f.attrs['src_mtime'] = stat.st_mtime_ns
+            dtype = rec.dtype
+            for k in lvls:
+                shape = (rec.n_lead, -(-n >> k))  # Ceiling, the last bucket may be partial
+                grp = f.create_group(str(k))
+                grp.create_dataset('min', shape=shape, dtype=dtype)
+                grp.create_dataset('max', shape=shape, dtype=dtype)
+                grp.create_dataset('mean', shape=shape, dtype=np.float32)
+                grp.create_dataset('idx_min', shape=shape, dtype=np.uint32)  # Offset within the bucket
+                grp.create_dataset('idx_max', shape=shape, dtype=np.uint32)
+
+            EcgPyramid._build_base(rec, f[str(lvls[0])], lvls[0])
+            for k_prev, k in zip(lvls[:-1], lvls[1:]):
+                EcgPyramid._build_level(f[str(k_prev)], f[str(k)], n, k_prev)
+
+    @staticmethod
+    def _build_base(rec, grp, k):
+        sz = 1 << k
+        idx_bkt = 0
+        carry = None  # Samples left over from previous segment that don't fill a bucket
+
+        def _write(vals):
+            nonlocal idx_bkt
+            n_spl = vals.shape[1]
+            n_bkt = -(-n_spl // sz)
+            if n_spl % sz != 0:  # Pad with the last value, which doesn't change min & max
+                vals = np.pad(vals, ((0, 0), (0, n_bkt * sz - n_spl)), mode='edge')
+            vals = vals.reshape(vals.shape[0], n_bkt, sz)
+            # The first occurrence, never in the padding
+            idx_mn, idx_mx = vals.argmin(axis=-1), vals.argmax(axis=-1)
+            grp['min'][:, idx_bkt:idx_bkt + n_bkt] = np.take_along_axis(vals, idx_mn[..., None], axis=-1)[..., 0]
+            grp['max'][:, idx_bkt:idx_bkt + n_bkt] = np.take_along_axis(vals, idx_mx[..., None], axis=-1)[..., 0]
+            grp['idx_min'][:, idx_bkt:idx_bkt + n_bkt] = idx_mn
+            grp['idx_max'][:, idx_bkt:idx_bkt + n_bkt] = idx_mx
+            # Mean of the potentially partial last bucket excludes the padding
+            sums = vals.sum(axis=-1, dtype=np.float64)
+            sums[:, -1] -= (n_bkt * sz - n_spl) * vals[:, -1, -1]
+            grp['mean'][:, idx_bkt:idx_bkt + n_bkt] = sums / np.minimum(sz, n_spl - np.arange(n_bkt) * sz)
+            idx_bkt += n_bkt
+
+        for key in rec._seg_keys:
+            dset = rec.record[key]
+            for strt in range(0, dset.shape[1], EcgPyramid.SZ_CHUNK):
+                vals = dset[:, strt:strt + EcgPyramid.SZ_CHUNK]
+                if carry is not None:
+                    vals = np.concatenate([carry, vals], axis=1)
+                n_full = vals.shape[1] - vals.shape[1] % sz
+                carry = vals[:, n_full:] if n_full < vals.shape[1] else None
+                if n_full > 0:
+                    _write(vals[:, :n_full])
+        if carry is not None:
+            _write(carry)
+
+    @staticmethod
+    def _build_level(grp_prev, grp, n, k_prev):
+        """ Each bucket merges 2 consecutive buckets of the previous level
+
+        :param n: Total number of samples in the record
+        :param k_prev: The previous level
+        """
+        n_prev = grp_prev['min'].shape[1]
+        for strt in range(0, n_prev, EcgPyramid.SZ_CHUNK):
+            end = min(strt + EcgPyramid.SZ_CHUNK, n_prev)
+            mn, mx, avg = grp_prev['min'][:, strt:end], grp_prev['max'][:, strt:end], grp_prev['mean'][:, strt:end]
+            idx_mn, idx_mx = grp_prev['idx_min'][:, strt:end], grp_prev['idx_max'][:, strt:end]
+            # Weight means by number of samples in bucket, only the very last bucket of a level can be partial
+            wt = np.minimum(1 << k_prev, n - np.arange(strt, end) * (1 << k_prev)).astype(np.float64)
+            bnd = np.arange(0, end - strt, 2)
+            snd = np.minimum(bnd + 1, end - strt - 1)  # The last bucket of a level may have no pair
+            idx = strt // 2
+            # Ties are kept in the first bucket, for the first occurrence
+            is_snd = mn[:, snd] < mn[:, bnd]
+            grp['min'][:, idx:idx + bnd.size] = np.where(is_snd, mn[:, snd], mn[:, bnd])
+            grp['idx_min'][:, idx:idx + bnd.size] = np.where(is_snd, idx_mn[:, snd] + (1 << k_prev), idx_mn[:, bnd])
+            is_snd = mx[:, snd] > mx[:, bnd]
+            grp['max'][:, idx:idx + bnd.size] = np.where(is_snd, mx[:, snd], mx[:, bnd])
+            grp['idx_max'][:, idx:idx + bnd.size] = np.where(is_snd, idx_mx[:, snd] + (1 << k_prev), idx_mx[:, bnd])
+            grp['mean'][:, idx:idx + bnd.size] = \
+                np.add.reduceat(avg * wt, bnd, axis=-1) / np.add.reduceat(wt, bnd)
+
+    def get_level(self, step):
+        """
+        :return: The coarsest level that still has at least 1 bucket per `step` samples, None if not stored
+        """
+        k = int(step).bit_length() - 1
+        if k < self.lvls[0]:
+            return None
+        return min(k, self.lvls[-1])
+
+    def get_samples(self, idx_lead, strt, end, step):
+        """ Same number of values as `EcgRecord.get_ecg_samples`, each value summarizes `step` samples
+
+        The extreme value further away from the mean is kept, so that peaks survive the decimation
+
+        :param idx_lead: Index of the lead, or increasing list of indices
+        :return: 1D array of ecg values, or 2D array of #leads * #values if list of indices
+        """
+        k = self.get_level(step)
+        grp = self.file[str(k)]
+        n = (end - strt) // step + 1
+        # The first bucket of each output value, strictly increasing since `step` >= bucket size
+        bnd = (strt + np.arange(n) * step) >> k
+        b_strt, b_end = bnd[0], (end >> k) + 1
+        bnd -= b_strt
+        mn = np.minimum.reduceat(self._read(k, 'min', idx_lead, b_strt, b_end), bnd, axis=-1)
+        mx = np.maximum.reduceat(self._read(k, 'max', idx_lead, b_strt, b_end), bnd, axis=-1)
+        avg = np.add.reduceat(self._read(k, 'mean', idx_lead, b_strt, b_end), bnd, axis=-1) / \
+            np.diff(bnd, append=b_end - b_strt)
+        return np.where(mx - avg >= avg - mn, mx, mn)
+
+    def get_envelope(self, idx_lead, strt, end, step):
+        """ Minimum & maximum of each bucket over the range, at the level per `get_level`
+
+        Each extreme is at its exact sample count, the pair of a bucket in time order,
+        so the sample counts differ across leads
+
+        :param idx_lead: Index of the lead, or increasing list of indices
+        :param strt: Start sample count, the whole bucket containing it is covered
+        :param end: End sample count, inclusive, the whole bucket containing it is covered
+        :return: 2-tuple of arrays of non-decreasing sample counts, and of ecg values, of the same shape,
+            2 per bucket, per lead if list of indices
+        """
+        k = self.get_level(step)
+        b_strt, b_end = strt >> k, (end >> k) + 1
+        mn = self._read(k, 'min', idx_lead, b_strt, b_end)
+        mx = self._read(k, 'max', idx_lead, b_strt, b_end)
+        base = np.arange(b_strt, b_end, dtype=np.int64) << k
+        c_mn = base + self._read(k, 'idx_min', idx_lead, b_strt, b_end)
+        c_mx = base + self._read(k, 'idx_max', idx_lead, b_strt, b_end)
+        is_mn_first = c_mn <= c_mx
+        counts = np.stack([np.where(is_mn_first, c_mn, c_mx), np.where(is_mn_first, c_mx, c_mn)], axis=-1)
+        vals = np.stack([np.where(is_mn_first, mn, mx), np.where(is_mn_first, mx, mn)], axis=-1)
+        return counts.reshape(*mn.shape[:-1], -1), vals.reshape(*mn.shape[:-1], -1)
+
+    def _read(self, k, nm, idx_lead, strt, end):
+        dset = self.file[str(k)][nm]
+        if self.cache is None:
+            return dset[idx_lead, strt:end]
+        else:
+            return self.cache.read(dset, (self.key, self.POSTFIX, k, nm), idx_lead, strt, end)
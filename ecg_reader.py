@@ -0,0 +1,116 @@
+import threading
+import multiprocessing as mp
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+_recs = OrderedDict()  # Path => Record opened by each worker process, least recently used first
+
+
+def _init_worker():
+    from ecg_record import EcgRecord  # Deferred, for `ecg_record` imports this module
+    EcgRecord.N_PROC = 0  # Workers read in-process
+    EcgRecord.USE_PYR = False  # Reads are strided, the pyramid is left to the parent process
+
+
+def _get_record(path_rec):
+    if path_rec not in _recs:
+        from ecg_record import EcgRecord
+        _recs[path_rec] = EcgRecord(path_rec, None)
+        while len(_recs) > EcgReader.N_REC:
+            _recs.popitem(last=False)[1].close()
+    _recs.move_to_end(path_rec)
+    return _recs[path_rec]
+
+
+def _read(path_rec, nm_shm, shape, dtype, row, idx_lead, strt, end, step, idx_strt):
+    """ Writes the values read into row `row` of the shared output array, starting at column `idx_strt`
+
+    :return: Number of values written
+    """
+    vals = _get_record(path_rec).get_ecg_samples(idx_lead, strt, end, step)
+    shm = SharedMemory(name=nm_shm)
+    try:
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf)[row, idx_strt:idx_strt + vals.size] = vals
+    finally:
+        shm.close()
+    return vals.size
+
+
+class EcgReader:
+    """Reads a record on a persistent pool of processes, each with its own open file.
+
+    `h5py` serializes all calls behind a global lock, so threads give almost no parallelism across leads.
+    Reads are split by lead and by range, and results are written to shared memory instead of pickled back.
+
+    A single pool is shared by the readers of all records in the process, started on first use,
+    each worker opens the records it reads, up to `N_REC`.
+    """
+
+    N_MIN_TASK = 2 ** 16  # Minimum number of values read by a task, below which IPC overhead dominates
+    N_REC = 8  # Maximum number of records kept open by each worker, least recently used are closed beyond
+
+    _pool = None
+    _n_proc = 0
+    _lock = threading.Lock()
+
+    def __init__(self, path_rec, n_proc):
+        """
+        :param path_rec: Path to the record, opened by each worker
+        :param n_proc: Number of worker processes, of the pool shared, as of the first reader
+        """
+        self.path_rec = path_rec
+        self.pool, self.n_proc = self._get_pool(n_proc)
+
+    @classmethod
+    def _get_pool(cls, n_proc):
+        with cls._lock:
+            if cls._pool is None:
+                # Spawn instead of fork, as HDF5 state in the parent process isn't safe to inherit
+                cls._pool = ProcessPoolExecutor(
+                    max_workers=n_proc, mp_context=mp.get_context('spawn'), initializer=_init_worker
+                )
+                cls._n_proc = n_proc
+            return cls._pool, cls._n_proc
+
+    def close(self):
+        """ The pool is shared, see `shutdown` """
+        pass
+
+    @classmethod
+    def shutdown(cls):
+        with cls._lock:
+            if cls._pool is not None:
+                cls._pool.shutdown(wait=False, cancel_futures=True)
+                cls._pool = None
+
+    def get_ecg_block(self, rows, strt, end, step, n, dtype):
+        """ Same values as `EcgRecord.get_ecg_block` on the increasing lead indices `rows`
+
+        :param n: Upper bound on the number of values per lead
+        :param dtype: Data type of the record values
+        """
+        n_task = max(1, min(-(-n // self.N_MIN_TASK), 2 * self.n_proc // len(rows)))
+        sz_task = -(-n // n_task)  # Number of values per task, each task reads a contiguous part of the range
+        shape = (len(rows), n)
+        shm = SharedMemory(create=True, size=max(1, len(rows) * n * np.dtype(dtype).itemsize))
+        try:
+            futures = []
+            for row, idx_lead in enumerate(rows):
+                for idx_strt in range(0, n, sz_task):
+                    # Counts are taken at `strt + i * step`
+                    strt_task = strt + idx_strt * step
+                    end_task = min(strt + (idx_strt + sz_task - 1) * step, end)
+                    futures.append((idx_strt, self.pool.submit(
+                        _read, self.path_rec, shm.name, shape, dtype, row, idx_lead, strt_task, end_task, step, idx_strt
+                    )))
+            wait([f for _, f in futures])
+            # The last task of each lead determines the actual number of values
+            n_val = max(idx_strt + f.result() for idx_strt, f in futures)
+            return np.ndarray(shape, dtype=dtype, buffer=shm.buf)[:, :n_val].copy()
+        finally:
+            shm.close()
+            shm.unlink()
@@ -1,9 +1,12 @@
 import h5py
 import json
+import os
+import threading
 import numpy as np
 import pandas as pd
 
 from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from math import floor
 from random import randint
 
@@ -12,6 +15,12 @@ from icecream import ic
 
 from data_link import *
 from dev_helper import *
+from ecg_pyramid import EcgPyramid
+from ecg_cache import EcgCache
+from ecg_store import EcgStore
+from ecg_manifest import EcgManifest
+from ecg_reader import EcgReader
+from ecg_metrics import EcgMetrics
 
 
 class EcgRecord:
@@ -23,6 +32,8 @@ class EcgRecord:
     and it's one Segment of signal taken, artificially sliced.
 
     All .log files joined sequentially will form the entire sampling of all ECG data in the surgery.
+
+    Alternatively reads from a consolidated copy of the .h5 file as a single segment, see `EcgStore`.
     """
 
     EPOCH_START = pd.Timestamp('1970-01-01')
@@ -30,57 +41,122 @@ class EcgRecord:
     UNIT_1US = pd.Timedelta(1, unit='us')
     FMT_TMLB = '%H:%M:%S.%f'
 
+    USE_PYR = True  # Answer zoomed-out reads from the min/max pyramid sidecar, see `EcgPyramid`
+    AGGS = [None, 'extreme']  # Aggregation of `step` samples into a value, see `get_ecg_samples`
+    # Build the pyramid in the background if missing or outdated, reads are strided meanwhile;
+    # if `SHARED`, built by `prepare` instead
+    BUILD_PYR = True
+    # Byte budget for decoded sample blocks kept in memory, shared by all records of the process, see `EcgCache`;
+    # 0 to disable
+    SZ_CACHE = 2 ** 28
+    STEP_MAX_CACHE = 4  # Largest step read through the cache, at full resolution, then strided
+    N_PROC = 0  # Number of processes for reading large ranges in parallel, see `EcgReader`; 0 to read in-process
+    # For several worker processes: records, pyramids and thumbnails are read from memory-mapped sidecars,
+    # built once and attached by all workers, see `EcgSidecar`
+    SHARED = False
+    _pool_pyr = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ecg-pyramid')  # One build at a time
+    _cache = None  # Created on first open, see `_get_cache`
+    _lock_cache = threading.Lock()
+
     # @profile
     def __init__(self, path_rec, path_rec_processed):
-        self.record = h5py.File(path_rec, 'r')
+        """
+        :param path_rec: Path to the .h5 record, or the `.npy` array of its `EcgStore`
+        """
+        self.path, self.path_p = path_rec, path_rec_processed
+        self.is_store = path_rec.suffix == '.npy'
+        self.record = EcgStore(path_rec) if self.is_store else h5py.File(path_rec, 'r')
         # self.record_p = h5py.File(path_rec_processed, 'r')
         # self.idxs_rpeak = self.record_p['r-peak-idxs']
         # self.vals_rpeak = self.record_p['r-peak-vals']  # Synchronized by index
-        self.nm = path_rec.stem  # By pathlib Path, gets the file name without last extension
-        self._seg_keys = list(self.record.keys())  # keys to each segment compiled in the .h5 file
-        self.tags, self.tags_tm = self._get_tags()  # `_ann_tm` to make bisect easy
+        # By pathlib Path, gets the file name without last extension
+        self.nm = self.record.nm if self.is_store else path_rec.stem
+        # Index of the record, without walking all segments on a warm reopen
+        mnf = EcgManifest.get(path_rec, self.record)
+        self._seg_keys = mnf['seg_keys'].tolist()  # keys to each segment compiled in the .h5 file
+        # A List which is compatible to JavaScript clientside function
+        self.tags = [list(t) for t in zip(
+            mnf['tag_types'].tolist(), mnf['tag_tms'].tolist(), mnf['tag_txts'].tolist()
+        )]
+        self.tags_tm = mnf['tag_tms'].tolist()  # Just the time, for finding tags in time range, bisect easy
         self.N_TAG = len(self.tags_tm)
 
         # Following properties are the same across different segments, as far as EcgApp is concerned.
-        metadata = self._get_seg(self._seg_keys[0]).get_metadata()
-        self.spl_rate = metadata['sample_rate']
+        spl_rate = float(mnf['spl_rate'])
+        if not spl_rate.is_integer():  # Sample counts & times are converted with integer arithmetic
+            raise ValueError(f'Sample rate of {path_rec} should be a whole number of Hz, got {spl_rate}')
+        self.spl_rate = int(spl_rate)
         # Multiplying factor for converting to time in microseconds
         self.FAC_TO_US = 10 ** 6 / self.spl_rate
-        self.lead_nms = [lead['name'] for lead in metadata['sigheader']]
+        self.FAC_TO_MS = 10 ** 3 / self.spl_rate
+        self._ramp = np.arange(0)  # Cached base for time axis, grows on demand
+        self.lead_nms = mnf['lead_nms'].tolist()
         self.n_lead = len(self.lead_nms)
-        self.is_negative = [lead['isNegative'] for lead in metadata['sigheader']]
+        self.is_negative = mnf['is_negative'].tolist()
+        self.dtype = self._get_dset_by_idx(0).dtype  # Of the samples as stored
 
-        self._sample_counts = self._get_sample_counts()
-        self._sample_counts_acc = self._get_sample_counts_acc()  # Accumulated
+        # Helps to check which segment(s) is a time range located in
+        self._sample_counts = mnf['sample_counts'].tolist()
+        self._sample_counts_acc = mnf['sample_counts_acc'].tolist()  # Accumulated
         self.COUNT_END = self._sample_counts_acc[-1] - 1  # Inclusive
         self.TIME_END = str(self.count_to_pd_time(self.COUNT_END))
+        # Memory-mapped reads are already served from the page cache
+        self.cache = EcgRecord._get_cache() if self.SZ_CACHE > 0 and not self.is_store else None
+        # Blocks of a copy reopened after the file changed are never served stale
+        self.key_cache = (str(path_rec), os.stat(path_rec).st_mtime_ns)
+        self.pyr = EcgPyramid.get(self, path_rec, mmap=self.SHARED, build=False) if self.USE_PYR else None
+        if self.USE_PYR and self.pyr is None and self.BUILD_PYR and not self.SHARED:
+            EcgRecord._pool_pyr.submit(self._build_pyramid)
+        self.reader = EcgReader(path_rec, self.N_PROC) if self.N_PROC > 0 else None
+
+    def _build_pyramid(self):
+        try:
+            self.pyr = EcgPyramid.get(self, self.path, mmap=self.SHARED)
+        except Exception as e:  # e.g. Record closed meanwhile, reads stay strided
+            print(f'Failed to build the pyramid of {self.path}: {type(e).__name__}: {e}')
+
+    @classmethod
+    def _get_cache(cls):
+        """ The block cache shared by all records of the process, so that `SZ_CACHE` bounds the total """
+        with EcgRecord._lock_cache:
+            if EcgRecord._cache is None:
+                EcgRecord._cache = EcgCache(cls.SZ_CACHE)
+            return EcgRecord._cache
+
+    def __reduce__(self):
+        """ Pickled by path, unpickled into the record shared by the process """
+        from ecg_session import EcgRecords  # Deferred, for `ecg_session` imports this module
+        return EcgRecords.get_record, (self.path, self.path_p)
 
-    def _get_tags(self):
-        annotations = json.loads(self.record.attrs['annotations'])
-        tags = []
-        tags_tm = []  # Just the time, for finding tags in time range
-        strt_ms = annotations[0]['time_ms']
-        for ann in annotations[2:]:  # Skip the first 2 rows, header and protocol respectively
-            text = ann['data']['text'] if 'text' in ann['data'] else ''
-            # A List which is compatible to JavaScript clientside function
-            t = ann['time_ms'] - strt_ms
-            tags.append([ann['type'], t, text])
-            tags_tm.append(t)
-        return tags, tags_tm
-
-    def _get_sample_counts(self):
-        """ Helps to check which segment(s) is a time range located in """
-        sample_counts = []
-        for key in self._seg_keys:
-            sample_counts.append(self.record[key].shape[1])
-        return sample_counts
-
-    def _get_sample_counts_acc(self):
-        lst = [self._sample_counts[0]]
-        for i, v in enumerate(self._sample_counts[1:]):
-            val = v + lst[i]
-            lst.append(val)
-        return lst
+    @staticmethod
+    def is_prepared(path_rec):
+        """ Whether the sidecars `SHARED` records attach to are up to date, see `prepare` """
+        return EcgStore.is_valid(path_rec) and (
+            not EcgRecord.USE_PYR or EcgPyramid.is_built(EcgStore.get_path(path_rec), mmap=EcgRecord.SHARED)
+        )
+
+    @staticmethod
+    def prepare(path_rec):
+        """ Builds the store of the .h5 record, and the manifest & pyramid of the store, e.g. ahead of time
+
+        :return: Path to the store
+        """
+        path = EcgStore.get(path_rec)
+        rec = EcgRecord(path, None)  # The manifest is built on open
+        try:
+            if EcgRecord.USE_PYR:
+                EcgPyramid.get(rec, path, mmap=EcgRecord.SHARED)
+        finally:
+            rec.close()
+        return path
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.drop(self.key_cache)
+        if self.reader is not None:
+            self.reader.close()
+        if not self.is_store:
+            self.record.close()
 
     def _get_seg(self, key):
         """
@@ -97,6 +173,17 @@ class EcgRecord:
         """
         return self.record[self._seg_keys[idx_seg]]
 
+    def _read_seg(self, idx_seg, sel, strt, end, step):
+        """ Same values as `dset[sel, strt:end:step]` for the segment's dataset `dset`, through the block cache
+
+        Reads of large steps are strided by `h5py`, instead of reading the blocks in full
+        """
+        dset = self._get_dset_by_idx(idx_seg)
+        if self.cache is None or step > self.STEP_MAX_CACHE:
+            return dset[sel, strt:end:step]
+        else:
+            return self.cache.read(dset, (self.key_cache, idx_seg), sel, strt, end, step)
+
     def get_tag_header(self):
         """
         :return: Information on all annotations
@@ -129,7 +216,7 @@ class EcgRecord:
         return bisect_left(self._sample_counts_acc, strt), bisect_right(self._sample_counts_acc, end)
 
     # @profile
-    def get_ecg_samples(self, idx_lead, strt=-1, end=-1, step=1):
+    def get_ecg_samples(self, idx_lead, strt=-1, end=-1, step=1, agg=None):
         """ Continuous samples of ecg magnitudes, specified by counted range
 
         If strt and end unspecified, the entire record will be returned
@@ -138,38 +225,104 @@ class EcgRecord:
         :param strt: start sample count
         :param end: end sample count
         :param step: every `step`-th value in the data sample is included
+        :param agg: If `extreme` and `step` is large enough, each value is instead the extreme of `step` samples,
+            per `EcgPyramid`, intended for display
         :return: 1D array of ecg values
 
         .. note:: optimized for large sample_range
         .. seealso:: `EcgApp._Plot.get_fig()`
         """
+        with EcgMetrics.phase('read'):
+            return self._get_samples(idx_lead, strt, end, step, agg)
+
+    def get_ecg_block(self, idxs_lead, strt=-1, end=-1, step=1, agg=None):
+        """ Continuous samples of multiple leads at once, per `get_ecg_samples`
+
+        A single read per segment covers all the leads requested
+
+        :param idxs_lead: List of lead indices, in any order
+        :return: 2D array of ecg values, #leads * #values, rows in the order of `idxs_lead`
+        """
+        rows = sorted(set(idxs_lead))  # h5py requires increasing indices
+        if not rows:
+            return np.empty((0, 0))
+        with EcgMetrics.phase('read'):
+            vals = self._get_samples(rows, strt, end, step, agg)
+        if rows != list(idxs_lead):  # e.g. `idxs_lead` an array
+            vals = vals[[rows.index(idx) for idx in idxs_lead]]
+        return vals
+
+    def get_ecg_envelope(self, idxs_lead, strt, end, step):
+        """ Minimum & maximum of every `step` samples or so, for decimation that keeps the extremes
+
+        Raw samples if `step` is below the finest pyramid level.
+        Buckets only partly in range are read as raw samples too, so that no value outside the range is kept.
+        Every `step`-th sample if the pyramid isn't built, e.g. while built in the background
+
+        :param idxs_lead: List of lead indices, in any order
+        :return: 2-tuple of non-decreasing sample counts, 1D array if shared across leads or 2D array per lead,
+        and 2D array of ecg values, #leads * #values, rows in the order of `idxs_lead`
+        .. seealso:: `EcgPyramid.get_envelope`, `EcgPlot.decimate_m4`
+        """
+        if self.pyr is None and step > 1:
+            return np.arange(strt, end + 1, step), self.get_ecg_block(idxs_lead, strt, end, step)
+        k = self.pyr.get_level(step) if self.pyr is not None else None
+        if k is not None:
+            strt_bkt, end_bkt = -(-strt >> k) << k, ((end + 1) >> k << k) - 1  # Range of the buckets entirely in range
+        if k is None or strt_bkt > end_bkt:
+            return np.arange(strt, end + 1), self.get_ecg_block(idxs_lead, strt, end)
+        rows = sorted(set(idxs_lead))
+        with EcgMetrics.phase('read'):
+            counts, vals = self.pyr.get_envelope(rows, strt_bkt, end_bkt, step)
+            if strt < strt_bkt:
+                counts = np.concatenate([np.tile(np.arange(strt, strt_bkt), (len(rows), 1)), counts], axis=-1)
+                vals = np.concatenate([self.get_ecg_block(rows, strt, strt_bkt - 1), vals], axis=-1)
+            if end_bkt < end:
+                counts = np.concatenate([counts, np.tile(np.arange(end_bkt + 1, end + 1), (len(rows), 1))], axis=-1)
+                vals = np.concatenate([vals, self.get_ecg_block(rows, end_bkt + 1, end)], axis=-1)
+        if rows != list(idxs_lead):  # e.g. `idxs_lead` an array
+            order = [rows.index(idx) for idx in idxs_lead]
+            counts, vals = counts[order], vals[order]
+        return counts, vals
+
+    def _get_samples(self, sel, strt, end, step, agg=None):
+        """
+        :param sel: Index of the lead, or increasing list of indices
+        """
+        if agg not in self.AGGS:
+            raise ValueError(f'Aggregation should be one of {self.AGGS}, got {agg!r}')
         if strt == -1 and end == -1:
             strt, end = 0, self.COUNT_END
+        if agg == 'extreme' and self.pyr is not None and step >= self.pyr.step_min:
+            return self.pyr.get_samples(sel, strt, end, step)
+        if self.reader is not None:
+            n = self.count_n_sample(strt, end, step)
+            rows = [sel] if np.isscalar(sel) else sel
+            if n * len(rows) >= self.reader.N_MIN_TASK:
+                vals = self.reader.get_ecg_block(rows, strt, end, step, n, self.dtype)
+                return vals[0] if np.isscalar(sel) else vals
         idx_strt, idx_end = self._locate_seg_idx(strt, end)
         if idx_strt != 0:
             strt = strt - self._sample_counts_acc[idx_strt - 1]
         if idx_end != 0:
             end = end - self._sample_counts_acc[idx_end - 1]
-        if end < self.COUNT_END:
-            end += 1  # for inclusive end
+        end += 1  # for inclusive end
 
         if idx_strt == idx_end:
-            return self._get_dset_by_idx(idx_strt)[idx_lead, strt:end:step]
+            return self._read_seg(idx_strt, sel, strt, end, step)
         else:
-            dset = self._get_dset_by_idx(idx_strt)
-            parts = [dset[idx_lead, strt::step]]
+            parts = [self._read_seg(idx_strt, sel, strt, None, step)]
             # e.g. Shape is 20 so indices [0, 19], strt is 2 and step is 7
             # => returns values at indices 2, 9, 16 with 3 elements remaining
-            offset_prev = self._get_prev_remaining_offset(dset.shape[1], strt, step)
+            offset_prev = self._get_prev_remaining_offset(self._sample_counts[idx_strt], strt, step)
             for i in range(idx_strt + 1, idx_end):  # for range()'s exclusive end
-                dset = self._get_dset_by_idx(i)
                 # The new start index relative to this segment, note 0-indexing
                 strt = step - 1 - offset_prev  # Sanity check: the new `strt` is in the range [0, step)
-                parts.append(dset[idx_lead, strt::step])
-                offset_prev = self._get_prev_remaining_offset(dset.shape[1], strt, step)
+                parts.append(self._read_seg(i, sel, strt, None, step))
+                offset_prev = self._get_prev_remaining_offset(self._sample_counts[i], strt, step)
             strt = step - 1 - offset_prev
-            parts.append(self._get_dset_by_idx(idx_end)[idx_lead, strt:end:step])
-            return np.concatenate(parts)
+            parts.append(self._read_seg(idx_end, sel, strt, end, step))
+            return np.concatenate(parts, axis=-1)
 
     @staticmethod
     def _get_prev_remaining_offset(sz_arr, strt, step):
@@ -185,8 +338,8 @@ class EcgRecord:
     def get_global_samples(self, idx_lead, step):
         """ For plot global thumbnail, data taken at large samples """
         parts = []
-        for k in self._seg_keys:
-            parts.append(self.record[k][idx_lead, ::step])
+        for i in range(len(self._seg_keys)):
+            parts.append(self._read_seg(i, idx_lead, 0, None, step))
         return np.concatenate(parts)
 
     def get_time_values(self, strt, end, step=1):
@@ -212,6 +365,25 @@ class EcgRecord:
         else:
             return (counts * self.FAC_TO_US).astype(np.int64)
 
+    def get_time_values_ms(self, strt, end, step=1):
+        """ Time stamps of the samples per `get_ecg_samples`, as milliseconds since epoch
+
+        Plotly shows numeric values on a date axis as such, no pandas objects are created.
+        Computed by slicing a cached base axis.
+
+        :return: Array of int64, or float64 if a sample doesn't fall on a whole millisecond
+        """
+        n = self.count_n_sample(strt, end, step)
+        if self._ramp.size < n:
+            self._ramp = np.arange(max(n, 2 * self._ramp.size), dtype=np.int64)
+        return self._counts_to_ms(strt + self._ramp[:n] * step)
+
+    def _counts_to_ms(self, counts):
+        if floor(self.FAC_TO_MS) == self.FAC_TO_MS:
+            return counts * int(self.FAC_TO_MS)
+        else:
+            return counts * self.FAC_TO_MS
+
     def get_time_values_delta(self, strt, end, step):
         """ For external export """
         counts = np.linspace(strt, end, num=self.count_n_sample(strt, end, step))
@@ -0,0 +1,363 @@
+import os
+import re
+import time
+import pickle
+import hashlib
+import threading
+from copy import deepcopy
+from contextlib import contextmanager, nullcontext, ExitStack
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # e.g. Windows, callbacks of a session aren't serialized across processes
+    fcntl = None
+
+from ecg_record import EcgRecord
+from ecg_store import EcgStore
+from ecg_plot import EcgPlot
+from ecg_ui import EcgUi
+from ecg_comment import EcgComment
+from ecg_export import EcgExport
+from ecg_metrics import EcgMetrics
+
+
+class EcgRecords:
+    """Records opened by the process, shared read-only across sessions, keyed by path.
+
+    Each record comes with its `EcgPlot`, which holds no session state.
+    Records pickle by path, see `EcgRecord.__reduce__`, so that a session stored on disk reopens the shared copy.
+    """
+
+    parn = None  # The `EcgApp` the plots serve, set on app creation
+    _recs = dict()  # Path to record => (`EcgRecord`, `EcgPlot`, modification time of the record as opened)
+    _lock = threading.Lock()
+    # Builds sidecars in the background, one record at a time, see `get_shared_path`
+    _pool_prep = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ecg-prepare')
+    _paths_prep = set()  # Paths to records being prepared by the process
+
+    @classmethod
+    def get(cls, path_rec, path_rec_processed):
+        """
+        :return: 2-tuple of the shared record and its plot
+        """
+        mtime = os.stat(path_rec).st_mtime_ns
+        with cls._lock:
+            if path_rec not in cls._recs or cls._recs[path_rec][2] != mtime:  # e.g. Store reconverted
+                if path_rec in cls._recs:  # The previous copy is left to sessions on it, its blocks are stale
+                    rec_prev = cls._recs[path_rec][0]
+                    if rec_prev.cache is not None:
+                        rec_prev.cache.drop(rec_prev.key_cache)
+                rec = EcgRecord(path_rec, path_rec_processed)
+                cls._recs[path_rec] = rec, EcgPlot(rec, cls.parn), mtime
+            return cls._recs[path_rec][:2]
+
+    @classmethod
+    def get_shared_path(cls, path_rec):
+        """ For `EcgRecord.SHARED`, the path to open for the .h5 record: its store once prepared by any process,
+        otherwise the .h5 file itself, while the store & its sidecars are built in the background
+
+        So that a record select never waits on the build, which may outlast the request timeout of the server,
+        see `EcgRecord.prepare`
+        """
+        if EcgRecord.is_prepared(path_rec):
+            return EcgStore.get_path(path_rec)
+        with cls._lock:
+            if path_rec not in cls._paths_prep:
+                cls._paths_prep.add(path_rec)
+                cls._pool_prep.submit(cls._prepare, path_rec)
+        return path_rec
+
+    @classmethod
+    def _prepare(cls, path_rec):
+        try:
+            EcgRecord.prepare(path_rec)
+        except Exception as e:  # e.g. Read-only data folder, the .h5 file is read instead
+            print(f'Failed to prepare {path_rec}: {type(e).__name__}: {e}')
+        finally:
+            with cls._lock:
+                cls._paths_prep.discard(path_rec)
+
+    @classmethod
+    def get_record(cls, path_rec, path_rec_processed):
+        return cls.get(path_rec, path_rec_processed)[0]
+
+    @classmethod
+    def get_plot(cls, path_rec, path_rec_processed):
+        return cls.get(path_rec, path_rec_processed)[1]
+
+    @classmethod
+    def close(cls):
+        with cls._lock:
+            for rec, plt, _ in cls._recs.values():
+                plt.close()
+                rec.close()
+            cls._recs = dict()
+
+
+class EcgSession:
+    """State of `EcgApp` for a single browser session, i.e. a page load, see `ID_STOR_SID`
+
+    Attributes are accessed through `EcgApp`, on the session the current callback serves.
+    """
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.rec = None  # Current record, shared, see `EcgRecords`
+        self.plt = None
+        self.ui = EcgUi(None)
+        self.cmts = EcgComment(None)
+        self.exp = EcgExport()
+        self.idxs_lead = []
+        self.disp_rng = deepcopy(EcgPlot.DISP_RNG_INIT)  # Modified in place
+        self.fig_tmb = None
+        self.plots = []  # Div list of lead on display, per `EcgApp.get_fig_layout`, modified in place
+        self._yaxis_fixed = False
+        self._marking_on = False
+        self.idx_ann_clicked = None
+        self._shapes = []  # Current shapes drawn, to be synchronized across new leads added
+        self._track_cmt_on = False
+        self._idx_cmt_t = None  # Index of the tracked comment stored internally
+
+        self.move_offset_counts = None  # Runtime optimization, semi-constants dependent to record
+        self.no_update_add_opns = None
+
+
+class EcgSessions:
+    """Sessions kept in memory, keyed by session ID
+
+    Concurrent callbacks of a session share the same `EcgSession` object.
+    Sessions not used for `TTL` seconds expire, e.g. closed browser tabs.
+    """
+
+    TTL = 24 * 3600  # Seconds a session is kept since its last callback
+    ITV_EXPIRE = 60  # Seconds between checks for expired sessions
+    PATN_SID = re.compile(r'[0-9a-f]{32}')  # Per `EcgFigures.new_session_id`
+
+    def __init__(self):
+        self._sessions = OrderedDict()  # Session ID => Session, least recently used first
+        self._ts_used = dict()  # Session ID => Time of last use
+        self._t_expire = time.time()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @staticmethod
+    def is_valid_id(sid):
+        """ Session IDs come from the browser, and name files, see `EcgSessionsOnDisk` """
+        return isinstance(sid, str) and EcgSessions.PATN_SID.fullmatch(sid) is not None
+
+    def get(self, sid):
+        """
+        :return: The session, a new one if not found
+        :raises ValueError: If `sid` is not a valid session ID
+        """
+        if not self.is_valid_id(sid):
+            raise ValueError(f'Invalid session ID: {sid!r}')
+        with self._lock:
+            if sid not in self._sessions:
+                self._sessions[sid] = EcgSession(sid)
+            self._sessions.move_to_end(sid)
+            self._ts_used[sid] = time.time()
+            sess = self._sessions[sid]
+        self._expire()
+        return sess
+
+    def find(self, sid):
+        """
+        :return: The session, None if not found, without creating one, e.g. for requests outside of callbacks
+        """
+        return self.get(sid) if self.is_valid_id(sid) and self._exists(sid) else None
+
+    def _exists(self, sid):
+        with self._lock:
+            return sid in self._sessions
+
+    def _expire(self):
+        t = time.time()
+        if t - self._t_expire < self.ITV_EXPIRE:
+            return
+        self._t_expire = t
+        with self._lock:
+            while self._sessions and t - self._ts_used[next(iter(self._sessions))] > self.TTL:
+                self._evict(self._sessions.popitem(last=False)[0])
+
+    def _evict(self, sid):
+        self._ts_used.pop(sid, None)
+
+    def lock(self, sid):
+        return nullcontext()
+
+    def put(self, sess):
+        """ Called after each callback that may have modified the session """
+        pass
+
+    @contextmanager
+    def use(self, sid):
+        with ExitStack() as stack:
+            with EcgMetrics.phase('session'):
+                stack.enter_context(self.lock(sid))
+                sess = self.get(sid)
+            try:
+                yield sess
+            finally:  # Including `PreventUpdate`, which may follow changes
+                with EcgMetrics.phase('session'):
+                    self.put(sess)
+
+
+class EcgSessionsOnDisk(EcgSessions):
+    """Sessions pickled into a directory, one file per session, e.g. to be shared by several worker processes
+
+    Callbacks of a session are serialized across processes by an exclusive lock on `<session ID>.lock`,
+    each reloads the session if the file was written by another process, and writes it back only if changed,
+    so that concurrent callbacks of a session, served by different processes, never overwrite each other's changes.
+
+    The last `N_SESSION` sessions used are cached in memory; files of sessions expired are removed.
+    """
+
+    N_SESSION = 64  # Maximum number of sessions cached in memory, least recently used sessions are dropped beyond
+    EXT = '.pkl'
+    EXT_LOCK = '.lock'
+
+    def __init__(self, path_dir):
+        """
+        :param path_dir: Directory of the session files, as `pathlib.Path`
+        """
+        super().__init__()
+        self.path_dir = path_dir
+        os.makedirs(path_dir, exist_ok=True)
+        self._mtimes = dict()  # Session ID => Modification time of the file as of the copy in memory
+        self._digests = dict()  # Session ID => Digest of the pickle as of the copy in memory
+        self._locks = dict()
+        self._local = threading.local()  # Session IDs locked by the thread, as the file lock isn't reentrant
+
+    def _get_path(self, sid, ext=EXT):
+        if not self.is_valid_id(sid):
+            raise ValueError(f'Invalid session ID: {sid!r}')
+        return self.path_dir.joinpath(f'{sid}{ext}')
+
+    @contextmanager
+    def lock(self, sid, blocking=True):
+        """ Exclusive across threads & processes
+
+        :param blocking: If False, yields False without waiting if the session is locked
+        """
+        with self._lock:
+            lock = self._locks.setdefault(sid, threading.RLock())
+        if not lock.acquire(blocking=blocking):
+            yield False
+            return
+        sids = self._local.__dict__.setdefault('sids', set())
+        try:
+            if sid in sids or fcntl is None:
+                yield True
+                return
+            path = self._get_path(sid, self.EXT_LOCK)
+            while True:
+                f = open(path, 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    f.close()
+                    yield False
+                    return
+                try:  # The file may have been removed on expiry while waiting, then the lock is on a stale file
+                    if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                        break
+                except FileNotFoundError:
+                    pass
+                f.close()
+            sids.add(sid)
+            try:
+                yield True
+            finally:
+                sids.discard(sid)
+                f.close()  # Releases the file lock
+        finally:
+            lock.release()
+
+    def get(self, sid):
+        path = self._get_path(sid)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        with self._lock:
+            if st is not None and self._mtimes.get(sid) != st.st_mtime_ns:
+                with open(path, 'rb') as f:
+                    b = f.read()
+                self._sessions[sid] = pickle.loads(b)
+                self._mtimes[sid] = st.st_mtime_ns
+                self._digests[sid] = hashlib.sha1(b).digest()
+            if sid in self._sessions:
+                self._sessions.move_to_end(sid)
+            while len(self._sessions) > self.N_SESSION:  # Still on disk
+                self._evict(self._sessions.popitem(last=False)[0])
+        return super().get(sid)
+
+    def _exists(self, sid):
+        return super()._exists(sid) or self._get_path(sid).exists()
+
+    def _evict(self, sid):  # From memory only
+        super()._evict(sid)
+        self._mtimes.pop(sid, None)
+        self._digests.pop(sid, None)
+
+    def _expire(self):
+        """ Removes files of sessions not used for `TTL`, per access time, see `put` """
+        t = time.time()
+        if t - self._t_expire < self.ITV_EXPIRE:
+            return
+        self._t_expire = t
+        for e in os.scandir(self.path_dir):
+            if not e.name.endswith(self.EXT):
+                continue
+            sid = e.name[:-len(self.EXT)]
+            if not self.is_valid_id(sid) or sid in self._local.__dict__.get('sids', ()):  # Served by this thread
+                continue
+            try:
+                if t - e.stat().st_atime <= self.TTL:
+                    continue
+            except FileNotFoundError:
+                continue
+            with self.lock(sid, blocking=False) as locked:
+                if not locked:  # In use
+                    continue
+                try:
+                    if t - os.stat(e.path).st_atime > self.TTL:  # Not used since
+                        # Along with files of the session by others, e.g. `EcgFigures`, the lock last
+                        for path in sorted(self.path_dir.glob(f'{sid}.*'), key=lambda p: p.suffix == self.EXT_LOCK):
+                            os.remove(path)
+                except FileNotFoundError:
+                    pass
+                with self._lock:
+                    if sid in self._sessions:
+                        del self._sessions[sid]
+                        self._evict(sid)
+            with self._lock:
+                self._locks.pop(sid, None)
+
+    def put(self, sess):
+        path = self._get_path(sess.sid)
+        b = pickle.dumps(sess, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha1(b).digest()
+        if digest == self._digests.get(sess.sid):  # Unchanged, e.g. a read-only callback
+            try:  # Marks as used, see `_expire`, keeping the modification time so other processes don't reload
+                os.utime(path, ns=(time.time_ns(), self._mtimes[sess.sid]))
+                return
+            except FileNotFoundError:
+                pass
+        path_tmp = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            with open(path_tmp, 'wb') as f:
+                f.write(b)
+            os.replace(path_tmp, path)  # Atomic, readers see either the previous or the new session
+        except BaseException:
+            if path_tmp.exists():
+                os.remove(path_tmp)
+            raise
+        with self._lock:
+            self._mtimes[sess.sid] = os.stat(path).st_mtime_ns
+            self._digests[sess.sid] = digest
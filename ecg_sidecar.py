@@ -0,0 +1,79 @@
+import os
+import json
+import shutil
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # e.g. Windows, builds aren't serialized across processes
+    fcntl = None
+
+
+class EcgSidecar:
+    """Files derived from a record and written next to it, built once by whichever process gets there first,
+    then attached read-only, e.g. through `np.memmap`, by all worker processes.
+
+    Builds are serialized across processes by an exclusive lock on `<sidecar>.lock`,
+    and written to a temporary path first, renamed into place on completion, so a partial build is never attached.
+
+    Validity is keyed by a JSON dictionary stored in `<sidecar>.key.json`, see `get_key`.
+    """
+
+    @staticmethod
+    def get_key(path_src, **kwargs):
+        """
+        :param path_src: Path to the source the sidecar is derived from
+        :param kwargs: Parameters of the build
+        :return: Dictionary that changes when the source or the parameters change
+        """
+        stat = os.stat(path_src)
+        return dict(src_size=stat.st_size, src_mtime=stat.st_mtime_ns, **kwargs)
+
+    @staticmethod
+    def _get_path_key(path):
+        return path.with_name(f'{path.name}.key.json')
+
+    @staticmethod
+    def is_valid(path, key):
+        path_key = EcgSidecar._get_path_key(path)
+        if not (path.exists() and path_key.exists()):
+            return False
+        with open(path_key, 'r') as f:
+            return json.load(f) == key
+
+    @staticmethod
+    @contextmanager
+    def lock(path):
+        """ Exclusive across processes, for the duration of a build """
+        with open(path.with_name(f'{path.name}.lock'), 'w') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def get(path, key, build):
+        """ Builds the sidecar if missing or outdated, waiting on another process building it already
+
+        :param path: Path to the sidecar, a file or a directory
+        :param key: Per `get_key`
+        :param build: Function that writes the sidecar into the temporary path given
+        :return: `path`
+        """
+        if EcgSidecar.is_valid(path, key):
+            return path
+        with EcgSidecar.lock(path):
+            if not EcgSidecar.is_valid(path, key):  # Not built by another process meanwhile
+                path_tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+                build(path_tmp)
+                if path.is_dir():  # `os.replace` doesn't overwrite a non-empty directory
+                    shutil.rmtree(path)
+                os.replace(path_tmp, path)
+                path_key = EcgSidecar._get_path_key(path)
+                with open(f'{path_key}.tmp', 'w') as f:
+                    json.dump(key, f)
+                os.replace(f'{path_key}.tmp', path_key)
+        return path
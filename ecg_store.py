@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+
+import h5py
+import numpy as np
+
+from data_link import *
+from ecg_sidecar import EcgSidecar
+
+
+class EcgStore:
+    """A record consolidated into a single contiguous array, read through `np.memmap`.
+
+    The one-time conversion of an ABLDB .h5 file writes next to it
+        - `<record>_store.npy`, lead-major, #leads * #samples, all segments joined sequentially
+        - `<record>_store.json`, the record attributes and the segment metadata
+
+    Opened in place of the `h5py.File` by `EcgRecord`, exposing the same interface with a single segment,
+    so reads are zero-copy slices with no segment stitching.
+    Pages are shared across processes through the OS page cache.
+
+    Keyed by the size & modification time of the record, reconverted if the record changes, see `EcgSidecar`.
+    Run `python ecg_store.py <record.h5>...` to convert ahead of time, along with the sidecars of the store,
+    see `EcgRecord.prepare`
+    """
+
+    POSTFIX = 'store'
+    KEY_SEG = 'all'  # Key to the only segment
+    SZ_CHUNK = 2 ** 20  # Number of samples copied at a time on conversion
+
+    def __init__(self, path):
+        """
+        :param path: Path to the `.npy` array
+        """
+        with open(path.with_suffix('.json'), 'r') as f:
+            header = json.load(f)
+        self.nm = header['nm']
+        self.attrs = header['attrs']
+        self._dsets = {self.KEY_SEG: self.Dataset(np.load(path, mmap_mode='r'), header['metadata'])}
+
+    def keys(self):
+        return self._dsets.keys()
+
+    def __getitem__(self, key):
+        return self._dsets[key]
+
+    class Dataset:
+        """ Mirrors the subset of `h5py.Dataset` used by `EcgRecord` """
+
+        def __init__(self, arr, metadata):
+            self.arr = arr
+            self.attrs = dict(metadata=metadata)
+            self.shape = arr.shape
+            self.dtype = arr.dtype
+
+        def __getitem__(self, key):
+            return self.arr[key]
+
+    @staticmethod
+    def get_path(path_rec):
+        return path_rec.with_name(f'{path_rec.stem}_{EcgStore.POSTFIX}.npy')
+
+    @staticmethod
+    def is_valid(path_rec):
+        """ Whether converted from the record as it is, see `EcgSidecar.get_key` """
+        return EcgSidecar.is_valid(EcgStore.get_path(path_rec), EcgSidecar.get_key(path_rec))
+
+    @staticmethod
+    def get(path_rec):
+        """ Converts the record unless converted already from its current version, once across processes
+
+        :return: Path to the `.npy` array
+        """
+        return EcgSidecar.get(
+            EcgStore.get_path(path_rec), EcgSidecar.get_key(path_rec), lambda p: EcgStore.convert(path_rec, p)
+        )
+
+    @staticmethod
+    def convert(path_rec, path):
+        """ Writes the consolidated copy of an ABLDB .h5 record
+
+        :param path: Path to write the array to, the header is written next to the path per `get_path`
+        """
+        with h5py.File(path_rec, 'r') as rec:
+            keys = list(rec.keys())
+            dset = rec[keys[0]]
+            n = sum(rec[k].shape[1] for k in keys)
+            arr = np.lib.format.open_memmap(path, mode='w+', dtype=dset.dtype, shape=(dset.shape[0], n))
+            offset = 0
+            for k in keys:
+                dset = rec[k]
+                for strt in range(0, dset.shape[1], EcgStore.SZ_CHUNK):
+                    vals = dset[:, strt:strt + EcgStore.SZ_CHUNK]
+                    arr[:, offset:offset + vals.shape[1]] = vals
+                    offset += vals.shape[1]
+            arr.flush()
+            del arr
+            header = dict(
+                nm=path_rec.stem,
+                attrs={k: EcgStore._to_json(v) for k, v in rec.attrs.items()},
+                metadata=EcgStore._to_json(rec[keys[0]].attrs['metadata'])
+            )
+        path_json = EcgStore.get_path(path_rec).with_suffix('.json')
+        with open(f'{path_json}.{os.getpid()}.tmp', 'w') as f:
+            json.dump(header, f)
+        os.replace(f'{path_json}.{os.getpid()}.tmp', path_json)
+
+    @staticmethod
+    def _to_json(v):
+        """ h5py attributes may be bytes or numpy types """
+        if isinstance(v, bytes):
+            return v.decode('utf-8')
+        elif isinstance(v, np.generic) or isinstance(v, np.ndarray):
+            return v.tolist()
+        else:
+            return v
+
+
+if __name__ == "__main__":
+    from ecg_record import EcgRecord  # Deferred, for `ecg_record` imports this module
+
+    EcgRecord.SHARED = True
+    for p in sys.argv[1:] or [DATA_PATH.joinpath(record_nm)]:
+        print(f'Prepared {EcgRecord.prepare(pathlib.Path(p))}')
@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import threading
+
+import dash
+
+
+class EcgTrace:
+    """Optional log of the interactions of each session, to replay against any build, see `dev_replay.py`
+
+    A trace is a JSON lines file per session, `<session ID>.jsonl`, each line a prop set by the user,
+    `t` in ms since the first line, `id`, `p` for the property and `v` for the value, e.g. a `relayoutData` or
+    `n_clicks`.
+
+    Logged from the callbacks on session state: their triggers, except props output by such callbacks,
+    which are set again on replay by the props they follow from, e.g. by record selection;
+    and their states of input values, e.g. comment text.
+    Static tag clicks are logged as the clientside store they write to, `ID_STOR_TG_IDX`.
+
+    .. note:: A change is logged once per process, i.e. per worker serving the session
+    """
+
+    EXT = '.jsonl'
+    PROPS_INPUT = ['value']  # Properties of states set by the user
+
+    def __init__(self, path_dir):
+        """
+        :param path_dir: Directory of the trace files, as `pathlib.Path`
+        """
+        self.path_dir = path_dir
+        os.makedirs(path_dir, exist_ok=True)
+        self.keys_sess = set()  # Props output by callbacks on session state
+        self._last = dict()  # Session ID => Last value logged, by prop
+        self._t_strt = dict()  # Session ID => Time of the first line
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(id_, prop):
+        """ Props of pattern-matching IDs are told apart by type only """
+        return f'{id_["type"] if isinstance(id_, dict) else id_}.{prop}'
+
+    @staticmethod
+    def _parse_prop_id(prop_id):
+        id_, prop = prop_id.rsplit('.', 1)
+        return (json.loads(id_) if id_.startswith('{') else id_), prop
+
+    def add_session_outputs(self, outputs):
+        """
+        :param outputs: `Output` or list of `Output`s of a callback on session state
+        """
+        for o in (outputs if isinstance(outputs, list) else [outputs]):
+            self.keys_sess.add(self.get_key(o.component_id, o.component_property))
+
+    def log(self, sid):
+        """ Called within a callback on session state, for the session """
+        ctx = dash.callback_context
+        lines = []
+        for s in ctx.states_list[:-1]:  # User input read on trigger, e.g. comment text; the last is the session ID
+            if isinstance(s, dict) and s['property'] in self.PROPS_INPUT:
+                lines.append((s['id'], s['property'], s.get('value')))
+        for t in ctx.triggered:
+            if t['prop_id'] != '.':  # Initial call
+                id_, prop = self._parse_prop_id(t['prop_id'])
+                if self.get_key(id_, prop) not in self.keys_sess:
+                    lines.append((id_, prop, t['value']))
+        with self._lock:
+            last = self._last.setdefault(sid, dict())
+            t_strt = self._t_strt.setdefault(sid, time.time())
+            # A change triggers all the callbacks depending on it, it's logged once
+            lines = [(id_, prop, v) for id_, prop, v in lines if last.get(json.dumps([id_, prop])) != v]
+            if not lines:
+                return
+            t = round((time.time() - t_strt) * 1e3)
+            with open(self.path_dir.joinpath(f'{sid}{self.EXT}'), 'a') as f:
+                for id_, prop, v in lines:
+                    last[json.dumps([id_, prop])] = v
+                    f.write(json.dumps(dict(t=t, id=id_, p=prop, v=v), separators=(',', ':')) + '\n')
@@ -0,0 +1,17 @@
+""" Entry point for a multi-process WSGI server, e.g. `gunicorn -w 4 -b 0.0.0.0:8050 wsgi:server`
+
+Sessions are kept on disk, so that any worker serves any callback of a session, see `EcgSessionsOnDisk`.
+Records, pyramids and thumbnails are memory-mapped sidecars, so that workers share their pages, see `EcgSidecar`
+"""
+
+from ecg_app import *
+
+
+EcgApp.SESS_DIR = CURR.joinpath('sessions')
+EcgApp.EXP_DIR = CURR.joinpath('exports')  # Export jobs are polled & served by any worker
+EcgRecord.SHARED = True
+EcgRecord.N_PROC = 0  # Workers are the parallelism
+
+ecg_app = EcgApp(__name__)
+ecg_app.app.title = 'ECG Signal Viewer'
+server = ecg_app.app.server